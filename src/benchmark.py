@@ -0,0 +1,416 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import platform
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterator, List
+
+import main
+
+MODES = ("sequential", "parallel-cycles", "scheduler", "async")
+
+WORDS = (
+    "album studio release record live compilation artist career decade single "
+    "chart music history sales tour label producer genre influence style era"
+).split()
+
+def percentile(values: List[float], pct: float) -> float:
+    """Returns the nearest-rank percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+class MockBackend:
+    """
+    Deterministic model behaviour shared by the sync and async mocks.
+
+    Output text and token counts depend only on the prompt. Each call
+    waits latency_ms, then generates response_tokens (capped by the
+    num_predict option) at
+    tokens_per_second in chunks of chunk_tokens. At most slots calls are
+    served at once, like OLLAMA_NUM_PARALLEL on a real server.
+
+    Like the llama.cpp runner, each slot keeps the tokens of its last
+    prompt per model; a new prompt only evaluates the tokens after its
+    longest common prefix with a cached one. keep_alive=0 unloads the
+    model and drops its cache.
+    """
+
+    def __init__(self, latency_ms: float = 20, tokens_per_second: float = 400,
+                 response_tokens: int = 60, chunk_tokens: int = 4, slots: int = 4,
+                 jitter: float = 0.0, load_ms: float = 0.0, seed: int = 0,
+                 prefix_cache: bool = True):
+        """
+        :param latency_ms: Fixed time before the first token (prompt evaluation)
+        :param tokens_per_second: Simulated generation speed
+        :param response_tokens: Tokens generated per call
+        :param chunk_tokens: Tokens per streamed chunk
+        :param slots: Calls served in parallel
+        :param jitter: Relative random variation of the latency (0.1 = +-10%)
+        :param load_ms: Model load time added to the first call
+        :param seed: Seed mixed into the per-prompt random generator
+        :param prefix_cache: Simulate KV prefix reuse between calls
+        """
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.slots = slots
+        self.jitter = jitter
+        self.load_ms = load_ms
+        self.seed = seed
+        self.prefix_cache = prefix_cache
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.prompt_eval_tokens = 0
+        self.eval_tokens = 0
+        self._loaded = False
+        self._cached_prompts = {}
+        self._lock = threading.Lock()
+
+    def _evaluate_prompt(self, model: str, tokens: List[str], keep_alive) -> int:
+        """Returns the prompt tokens left to evaluate after prefix reuse."""
+        if not self.prefix_cache or keep_alive in (0, "0", "0s"):
+            self._cached_prompts.pop(model, None)
+            return len(tokens)
+
+        cached = self._cached_prompts.setdefault(model, [])
+        reused = 0
+        for previous in cached:
+            common = 0
+            for a, b in zip(tokens, previous):
+                if a != b:
+                    break
+                common += 1
+            reused = max(reused, common)
+        cached.append(tokens)
+        del cached[:-self.slots]
+        return len(tokens) - reused
+
+    def plan(self, prompt: str, json_format: bool = False, model: str = '',
+             keep_alive=None, options: Dict[str, Any] = None) -> Dict[str, Any]:
+        """Works out the text and timings of one call."""
+        digest = hashlib.sha256(f"{self.seed}:{prompt}".encode("utf-8")).digest()
+        rng = random.Random(digest)
+        response_tokens = self.response_tokens
+        num_predict = (options or {}).get("num_predict")
+        if num_predict and num_predict > 0:
+            response_tokens = min(response_tokens, num_predict)
+        words = [rng.choice(WORDS) for _ in range(response_tokens)]
+        text = " ".join(words).capitalize() + "."
+        if json_format:
+            text = json.dumps({"intent": text, "prompt": text})
+
+        prompt_tokens = prompt.split()
+        with self._lock:
+            self.calls += 1
+            load_ms = 0.0 if self._loaded else self.load_ms
+            self._loaded = True
+            prompt_eval_count = self._evaluate_prompt(model, prompt_tokens, keep_alive)
+            self.prompt_tokens += len(prompt_tokens)
+            self.prompt_eval_tokens += prompt_eval_count
+            self.eval_tokens += response_tokens
+
+        latency_ms = self.latency_ms * (1 + rng.uniform(-self.jitter, self.jitter))
+        tokens = text.split(" ")
+        return {
+            "chunks": [
+                " ".join(tokens[i:i + self.chunk_tokens]) + " "
+                for i in range(0, len(tokens), self.chunk_tokens)
+            ],
+            "text": text,
+            "first_token_delay": (latency_ms + load_ms) / 1000,
+            "chunk_delay": self.chunk_tokens / self.tokens_per_second,
+            "stats": {
+                "done": True,
+                "context": [],
+                "prompt_eval_count": prompt_eval_count,
+                "prompt_eval_duration": int(latency_ms * 1e6),
+                "eval_count": len(tokens),
+                "eval_duration": int(len(tokens) / self.tokens_per_second * 1e9),
+                "load_duration": int(load_ms * 1e6)
+            }
+        }
+
+    def embedding(self, prompt: str, dim: int = 64) -> List[float]:
+        """Bag-of-words hash embedding, so paraphrases land close together."""
+        vector = [0.0] * dim
+        for word in prompt.lower().split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % dim] += 1.0
+        return vector
+
+class MockOllamaClient:
+    """Stand-in for ollama.Client backed by a MockBackend."""
+
+    def __init__(self, backend: MockBackend):
+        self.backend = backend
+        self._slots = threading.BoundedSemaphore(backend.slots)
+
+    def generate(self, model: str = '', prompt: str = '', stream: bool = False,
+                 format: str = '', keep_alive=None, options=None, **kwargs):
+        plan = self.backend.plan(prompt, format == 'json', model, keep_alive, options)
+        if stream:
+            return self._stream(model, plan)
+        with self._slots:
+            time.sleep(plan["first_token_delay"] + plan["chunk_delay"] * len(plan["chunks"]))
+        return dict(plan["stats"], model=model, response=plan["text"])
+
+    def _stream(self, model: str, plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        with self._slots:
+            time.sleep(plan["first_token_delay"])
+            for chunk in plan["chunks"]:
+                time.sleep(plan["chunk_delay"])
+                yield {"model": model, "response": chunk, "done": False}
+        yield dict(plan["stats"], model=model, response="")
+
+    def embeddings(self, model: str = '', prompt: str = '', **kwargs) -> Dict[str, Any]:
+        return {"embedding": self.backend.embedding(prompt)}
+
+class MockAsyncOllamaClient:
+    """Stand-in for ollama.AsyncClient backed by a MockBackend."""
+
+    def __init__(self, backend: MockBackend):
+        self.backend = backend
+        self._slots = asyncio.Semaphore(backend.slots)
+
+    async def generate(self, model: str = '', prompt: str = '', stream: bool = False,
+                       format: str = '', keep_alive=None, options=None, **kwargs):
+        plan = self.backend.plan(prompt, format == 'json', model, keep_alive, options)
+        if stream:
+            return self._stream(model, plan)
+        async with self._slots:
+            await asyncio.sleep(plan["first_token_delay"] + plan["chunk_delay"] * len(plan["chunks"]))
+        return dict(plan["stats"], model=model, response=plan["text"])
+
+    async def _stream(self, model: str, plan: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        async with self._slots:
+            await asyncio.sleep(plan["first_token_delay"])
+            for chunk in plan["chunks"]:
+                await asyncio.sleep(plan["chunk_delay"])
+                yield {"model": model, "response": chunk, "done": False}
+        yield dict(plan["stats"], model=model, response="")
+
+    async def embeddings(self, model: str = '', prompt: str = '', **kwargs) -> Dict[str, Any]:
+        return {"embedding": self.backend.embedding(prompt)}
+
+def make_queries(count: int) -> List[str]:
+    """Builds a deterministic set of distinct queries."""
+    topics = ["Madonna", "The Beatles", "Queen", "ABBA", "Metallica", "Adele", "Prince"]
+    return [
+        f"How many albums has {topics[i % len(topics)]} released? (benchmark query {i})"
+        for i in range(count)
+    ]
+
+def run_threaded(mode: str, queries: List[str], concurrency: int, slots: int) -> List[float]:
+    """Runs queries through process_user_input on a thread pool."""
+    if mode == "scheduler":
+        main.enable_scheduler(slots)
+    max_cycles = 1 if mode == "sequential" else 3
+
+    def timed(query: str) -> float:
+        started = time.perf_counter()
+        main.process_user_input(query, max_cycles, verbose=False)
+        return time.perf_counter() - started
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(timed, queries))
+    finally:
+        main.disable_scheduler()
+
+def run_async(queries: List[str], concurrency: int, backend: MockBackend) -> List[float]:
+    """Runs queries through AsyncDeepChain with bounded concurrency."""
+    async def run() -> List[float]:
+        semaphore = asyncio.Semaphore(concurrency)
+        chain = main.AsyncDeepChain(max_concurrency=3, client=MockAsyncOllamaClient(backend))
+
+        async def timed(query: str) -> float:
+            async with semaphore:
+                started = time.perf_counter()
+                await chain.process_user_input(query)
+                return time.perf_counter() - started
+
+        async with chain:
+            return list(await asyncio.gather(*(timed(q) for q in queries)))
+
+    return asyncio.run(run())
+
+def run_case(mode: str, size: int, concurrency: int, backend: MockBackend,
+             track_memory: bool = True) -> Dict[str, Any]:
+    """
+    Measures one (mode, query-set size, concurrency) combination.
+
+    :return: Latency percentiles, throughput, model calls, prompt tokens and peak memory
+    """
+    queries = make_queries(size)
+    calls_before = backend.calls
+    prompt_before = backend.prompt_tokens
+    prompt_eval_before = backend.prompt_eval_tokens
+    eval_before = backend.eval_tokens
+    if track_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+
+    if mode == "async":
+        latencies = run_async(queries, concurrency, backend)
+    else:
+        latencies = run_threaded(mode, queries, concurrency, backend.slots)
+
+    wall = time.perf_counter() - started
+    peak = 0
+    if track_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "mode": mode,
+        "queries": size,
+        "concurrency": concurrency,
+        "wall_seconds": round(wall, 4),
+        "throughput_qps": round(size / wall, 4) if wall else 0.0,
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "model_calls": backend.calls - calls_before,
+        "prompt_tokens_per_query": round((backend.prompt_tokens - prompt_before) / size, 1),
+        "prompt_eval_tokens_per_query": round((backend.prompt_eval_tokens - prompt_eval_before) / size, 1),
+        "generated_tokens_per_query": round((backend.eval_tokens - eval_before) / size, 1),
+        "peak_memory_mb": round(peak / 2 ** 20, 3)
+    }
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any],
+                    tolerance: float) -> List[str]:
+    """
+    Lists regressions of p95 latency or throughput beyond tolerance.
+
+    :param current: Results of this run
+    :param baseline: Results loaded from an earlier run
+    :param tolerance: Allowed relative change (0.1 = 10%)
+    :return: Human-readable regression descriptions
+    """
+    def key(result: Dict[str, Any]):
+        return result["mode"], result["queries"], result["concurrency"]
+
+    previous = {key(r): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        label = "{} queries={} concurrency={}".format(*key(result))
+        if old["p95_ms"] and result["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {old['p95_ms']}ms -> {result['p95_ms']}ms")
+        if old["throughput_qps"] and result["throughput_qps"] < old["throughput_qps"] * (1 - tolerance):
+            regressions.append(
+                f"{label}: throughput {old['throughput_qps']} -> {result['throughput_qps']} q/s"
+            )
+    return regressions
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Parses command line arguments."""
+    def int_list(value: str) -> List[int]:
+        return [int(v) for v in value.split(",") if v]
+
+    parser = argparse.ArgumentParser(description="Offline DeepChain benchmark on a mock Ollama backend")
+    parser.add_argument("--modes", default=",".join(MODES), help=f"Comma-separated subset of {', '.join(MODES)}")
+    parser.add_argument("--sizes", type=int_list, default=[1, 8, 32], help="Query-set sizes (default: 1,8,32)")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16],
+                        help="Queries in flight (default: 1,4,16)")
+    parser.add_argument("--latency-ms", type=float, default=20, help="Simulated time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="Simulated generation speed")
+    parser.add_argument("--response-tokens", type=int, default=60, help="Tokens generated per call")
+    parser.add_argument("--chunk-tokens", type=int, default=4, help="Tokens per streamed chunk")
+    parser.add_argument("--slots", type=int, default=4, help="Calls the mock serves in parallel")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Relative latency variation")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the mock output")
+    parser.add_argument("--no-prefix-cache", action="store_true",
+                        help="Evaluate every prompt in full (no simulated KV prefix reuse)")
+    parser.add_argument("--no-stage-options", action="store_true",
+                        help="Send no per-stage generation options (no num_predict caps)")
+    parser.add_argument("--no-memory", action="store_true", help="Skip tracemalloc peak memory tracking")
+    parser.add_argument("--out", default="benchmark.json", help="Results file (default: benchmark.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="Earlier results file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative regression (default: 0.1)")
+    return parser.parse_args(argv)
+
+def main_benchmark(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    modes = [m for m in args.modes.split(",") if m]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        print(f"Unknown modes: {', '.join(sorted(unknown))}")
+        return 2
+
+    backend = MockBackend(
+        latency_ms=args.latency_ms,
+        tokens_per_second=args.tokens_per_second,
+        response_tokens=args.response_tokens,
+        chunk_tokens=args.chunk_tokens,
+        slots=args.slots,
+        jitter=args.jitter,
+        seed=args.seed,
+        prefix_cache=not args.no_prefix_cache
+    )
+    main.set_client(MockOllamaClient(backend))
+    if args.no_stage_options:
+        main.STAGE_OPTIONS = {}
+
+    results = []
+    print(f"{'mode':<16}{'queries':>8}{'conc':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'q/s':>9}{'calls':>7}{'prompt/q':>10}{'eval/q':>9}{'gen/q':>8}{'MB':>8}")
+    for mode in modes:
+        for size in args.sizes:
+            for concurrency in args.concurrency:
+                result = run_case(mode, size, concurrency, backend, not args.no_memory)
+                results.append(result)
+                print(f"{mode:<16}{size:>8}{concurrency:>6}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+                      f"{result['p99_ms']:>10}{result['throughput_qps']:>9}{result['model_calls']:>7}"
+                      f"{result['prompt_tokens_per_query']:>10}{result['prompt_eval_tokens_per_query']:>9}"
+                      f"{result['generated_tokens_per_query']:>8}{result['peak_memory_mb']:>8}")
+
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": {
+                "latency_ms": args.latency_ms,
+                "tokens_per_second": args.tokens_per_second,
+                "response_tokens": args.response_tokens,
+                "chunk_tokens": args.chunk_tokens,
+                "slots": args.slots,
+                "jitter": args.jitter,
+                "seed": args.seed,
+                "prefix_cache": not args.no_prefix_cache,
+                "stage_options": not args.no_stage_options
+            }
+        },
+        "results": results
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_results(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nNo regressions against baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_benchmark())
@@ -1,7 +1,114 @@
+import argparse
+import json
 import ollama
 import re
 from datetime import datetime, timedelta
-from typing import List, Tuple, Dict
+from typing import Any, List, Optional, Tuple, Dict
+
+MODEL_NAME = 'gemma2:27b'
+
+# Этапы конвейера
+STAGE_INTENT = "intent"
+STAGE_PROMPT = "prompt"
+STAGE_RESPONSE = "response"
+STAGE_SYNTHESIS = "synthesis"
+
+# Маршрутизация моделей по этапам (см. load_config). Ключ STAGE_*
+# соответствует имени модели или словарю {номер цикла: имя модели};
+# для остальных этапов и циклов используется MODEL_NAME. FALLBACK_MODEL
+# (MODEL_NAME, если None) перегенерирует промпты, испорченные малой моделью.
+STAGE_MODELS = {}
+FALLBACK_MODEL = None
+
+# Параметры генерации по этапам, передаются в Ollama как "options" (см.
+# get_stage_options). Служебные этапы ограничены реальной длиной вывода:
+# намерение - предложение или короткий абзац, промпт - несколько
+# предложений; более глубокие циклы получают больше места через "cycles".
+# Запись "default" действует на все этапы. Длину ответа и синтеза
+# определяет модель. num_ctx лучше задавать в "default": Ollama
+# перезагружает модель при смене размера контекста.
+STAGE_OPTIONS = {
+    STAGE_INTENT: {"temperature": 0.3, "cycles": {1: {"num_predict": 64},
+                                                  2: {"num_predict": 160},
+                                                  3: {"num_predict": 256}}},
+    STAGE_PROMPT: {"temperature": 0.5, "cycles": {1: {"num_predict": 128},
+                                                  2: {"num_predict": 256},
+                                                  3: {"num_predict": 384}}}
+}
+
+def get_stage_model(stage: str, cycle_num: int = 0) -> str:
+    """
+    Возвращает модель, назначенную этапу и циклу.
+    
+    :param stage: Этап конвейера (константа STAGE_*)
+    :param cycle_num: Номер цикла (0 для синтеза)
+    :return: Имя модели
+    """
+    route = STAGE_MODELS.get(stage)
+    if isinstance(route, dict):
+        route = route.get(cycle_num) or route.get(str(cycle_num))
+    return route or MODEL_NAME
+
+def get_stage_options(stage: str, cycle_num: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    Возвращает параметры генерации Ollama для этапа и цикла: профиль
+    "default", переопределённый профилем этапа и его записью "cycles".
+    Параметры со значением None не передаются.
+    
+    :param stage: Этап конвейера (константа STAGE_*)
+    :param cycle_num: Номер цикла (0 для синтеза)
+    :return: Словарь параметров или None, если их нет
+    """
+    options = {}
+    for profile in (STAGE_OPTIONS.get("default") or {}, STAGE_OPTIONS.get(stage) or {}):
+        cycles = profile.get("cycles") or {}
+        options.update((name, value) for name, value in profile.items() if name != "cycles")
+        options.update(cycles.get(cycle_num) or cycles.get(str(cycle_num)) or {})
+    return {name: value for name, value in options.items() if value is not None} or None
+
+def merge_stage_options(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Объединяет профиль этапа из конфигурации со встроенным.
+    
+    Параметр, заданный для всего этапа, заменяет и встроенные
+    значения этого параметра по циклам.
+    """
+    cycles = {
+        str(cycle): {name: value for name, value in options.items() if name not in override}
+        for cycle, options in (base.get("cycles") or {}).items()
+    }
+    for cycle, options in (override.get("cycles") or {}).items():
+        cycles[str(cycle)] = dict(cycles.get(str(cycle), {}), **options)
+    merged = dict(base, **override)
+    if cycles:
+        merged["cycles"] = cycles
+    return merged
+
+def get_fallback_model(stage: str, cycle_num: int = 0) -> Optional[str]:
+    """Возвращает модель для повтора этапа или None, если этап уже использует её."""
+    fallback = FALLBACK_MODEL or MODEL_NAME
+    return fallback if fallback != get_stage_model(stage, cycle_num) else None
+
+def load_config(path: str) -> Dict[str, Any]:
+    """
+    Загружает настройки конвейера из JSON-файла (формат как у main.py).
+    
+    :param path: Путь к файлу конфигурации
+    :return: Разобранная конфигурация
+    """
+    global MODEL_NAME, STAGE_MODELS, FALLBACK_MODEL, STAGE_OPTIONS
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+
+    models = config.get("models", {})
+    MODEL_NAME = models.get("default", MODEL_NAME)
+    STAGE_MODELS = models.get("stages", STAGE_MODELS)
+    FALLBACK_MODEL = models.get("fallback", FALLBACK_MODEL)
+
+    STAGE_OPTIONS = dict(STAGE_OPTIONS)
+    for stage, profile in config.get("generation", {}).items():
+        STAGE_OPTIONS[stage] = merge_stage_options(STAGE_OPTIONS.get(stage) or {}, profile)
+    return config
 
 def get_current_date():
     """Возвращает текущую дату в формате ГГГГ-ММ-ДД."""
@@ -70,14 +177,15 @@ def analyze_user_intent(input_text: str, cycle_num: int) -> str:
     
     try:
         intent_response = ollama.generate(
-            model='gemma2:27b', 
-            prompt=prompts[cycle_num]
+            model=get_stage_model(STAGE_INTENT, cycle_num), 
+            prompt=prompts[cycle_num],
+            options=get_stage_options(STAGE_INTENT, cycle_num)
         )
         return intent_response['response'].strip()
     except Exception:
         return None
 
-def generate_llm_prompt(input_text: str, user_intent: str, cycle_num: int) -> str:
+def generate_llm_prompt(input_text: str, user_intent: str, cycle_num: int, model: str = None) -> str:
     """
     Генерирует эффективный промпт для LLM.
     Разные подходы к генерации для разных циклов.
@@ -141,8 +249,9 @@ def generate_llm_prompt(input_text: str, user_intent: str, cycle_num: int) -> st
     
     try:
         prompt_response = ollama.generate(
-            model='gemma2:27b',
-            prompt=templates[cycle_num]
+            model=model or get_stage_model(STAGE_PROMPT, cycle_num),
+            prompt=templates[cycle_num],
+            options=get_stage_options(STAGE_PROMPT, cycle_num)
         )
         return prompt_response['response'].strip()
     except Exception:
@@ -168,8 +277,9 @@ def get_llm_response(prompt: str, cycle_num: int) -> str:
         full_prompt = f"{cycle_instructions[cycle_num]}\n\n{prompt}"
         
         response = ollama.generate(
-            model='gemma2:27b',
-            prompt=full_prompt
+            model=get_stage_model(STAGE_RESPONSE, cycle_num),
+            prompt=full_prompt,
+            options=get_stage_options(STAGE_RESPONSE, cycle_num)
         )
         return response['response'].strip()
     except Exception as e:
@@ -206,9 +316,14 @@ def process_single_cycle(user_input: str, cycle_num: int) -> Dict[str, str]:
     # Генерация промпта
     print("Генерация промпта...")
     llm_prompt = generate_llm_prompt(user_input, intent, cycle_num)
+    final_prompt = post_process_prompt(llm_prompt) if llm_prompt else ""
+    fallback = get_fallback_model(STAGE_PROMPT, cycle_num)
+    if not validate_prompt(final_prompt) and fallback:
+        # Малая модель не справилась, повторяем с основной
+        llm_prompt = generate_llm_prompt(user_input, intent, cycle_num, fallback)
+        final_prompt = post_process_prompt(llm_prompt) if llm_prompt else ""
     if not llm_prompt:
         raise Exception("Не удалось сгенерировать промпт")
-    final_prompt = post_process_prompt(llm_prompt)
     if not validate_prompt(final_prompt):
         raise Exception("Сгенерированный промпт некорректен")
     print(f"Промпт: {final_prompt}")
@@ -277,7 +392,11 @@ def synthesize_final_answer(cycles: List[Dict[str, str]], original_query: str) -
     """
 
     try:
-        synthesis_response = ollama.generate(model='gemma2:27b', prompt=synthesis_prompt)
+        synthesis_response = ollama.generate(
+            model=get_stage_model(STAGE_SYNTHESIS),
+            prompt=synthesis_prompt,
+            options=get_stage_options(STAGE_SYNTHESIS)
+        )
         return synthesis_response['response'].strip()
     except Exception as e:
         return f"Ошибка при синтезе финального ответа: {str(e)}"
@@ -305,6 +424,13 @@ def process_user_input(user_input: str) -> Tuple[List[Dict[str, str]], str]:
 
 def main():
     """Основная функция программы."""
+    parser = argparse.ArgumentParser(description="DeepChain Refinement LLM")
+    parser.add_argument("--config", metavar="PATH",
+                        help="JSON-файл конфигурации (маршрутизация моделей, параметры генерации)")
+    args = parser.parse_args()
+    if args.config:
+        load_config(args.config)
+
     print("\nDeepChain Refinement LLM v1.0.0:")
     print("Using chain-of-thought, multi-step prompting,")
     print("progressive refinement and response synthesis")
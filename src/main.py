@@ -1,335 +1,5215 @@
+import argparse
+import asyncio
+import contextvars
+import gzip
+import hashlib
+import heapq
+import httpx
+import json
+import math
 import ollama
+import os
+import queue
+import random
 import re
+import sqlite3
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from pathlib import Path
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
-from typing import List, Tuple, Dict
+from typing import Any, AsyncIterator, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional, only needed by the semantic cache
+    np = None
+
+MODEL_NAME = 'gemma2:9b'
+
+# Per-stage model routing (see load_config). Each STAGE_* key maps to a
+# model name or to a {cycle number: model name} mapping; stages and
+# cycles not listed use MODEL_NAME. FALLBACK_MODEL (MODEL_NAME when None)
+# regenerates prompts that a smaller model got wrong.
+STAGE_MODELS = {}
+FALLBACK_MODEL = None
+
+# Ollama server address; None falls back to the OLLAMA_HOST environment
+# variable and then to the library default (http://localhost:11434).
+OLLAMA_HOST = None
+
+# Maximum number of refinement cycles executed at the same time.
+# 1 keeps the sequential behaviour; raise it when the Ollama server
+# can serve parallel requests (OLLAMA_NUM_PARALLEL).
+MAX_CONCURRENT_CYCLES = 1
+
+# How long Ollama keeps a model loaded after a call. A loaded model keeps
+# the evaluated tokens of recent prompts, so the shared prompt prefix of
+# the next call is not evaluated again.
+KEEP_ALIVE = "30m"
+
+# Fixed start of every response-stage prompt
+RESPONSE_PREAMBLE = "Answer the request below accurately and completely, using well-established facts."
+
+# Connection pool shared by every model call. Keep-alive connections
+# are reused between stages instead of reconnecting for each request.
+CONNECTION_LIMITS = httpx.Limits(
+    max_connections=16,
+    max_keepalive_connections=8,
+    keepalive_expiry=60.0
+)
+
+# Pipeline stages, used as keys by the caching layer
+STAGE_INTENT = "intent"
+STAGE_PROMPT = "prompt"
+STAGE_RESPONSE = "response"
+STAGE_SYNTHESIS = "synthesis"
+STAGE_RATING = "rating"
+STAGE_FUSED = "intent_prompt"
+
+# Generation options per stage, passed to Ollama as "options" (see
+# get_stage_options). The meta stages are capped to their real output:
+# an intent is a sentence or a short paragraph, a prompt a few
+# sentences, a rating one number; deeper cycles get more room through
+# "cycles". A "default" entry applies to every stage. Response and
+# synthesis are left to the model's own length. Set num_ctx in
+# "default" rather than per stage: Ollama reloads a model whose
+# context size changes between calls.
+STAGE_OPTIONS = {
+    STAGE_INTENT: {"temperature": 0.3, "cycles": {1: {"num_predict": 64},
+                                                  2: {"num_predict": 160},
+                                                  3: {"num_predict": 256}}},
+    STAGE_PROMPT: {"temperature": 0.5, "cycles": {1: {"num_predict": 128},
+                                                  2: {"num_predict": 256},
+                                                  3: {"num_predict": 384}}},
+    STAGE_FUSED: {"temperature": 0.3, "cycles": {1: {"num_predict": 192},
+                                                 2: {"num_predict": 384},
+                                                 3: {"num_predict": 640}}},
+    STAGE_RATING: {"num_predict": 8, "temperature": 0.0}
+}
+
+# Fused stage mode: one JSON-format call per cycle returns both the
+# intent and the prompt (7 model calls per query instead of 10).
+FUSED_STAGES = False
+
+# Stage cache defaults (see enable_stage_cache)
+CACHE_PATH = "deepchain_cache.sqlite3"
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 10000
+# Dates embedded in prompts are replaced by a bucket of this many days,
+# so the daily date change doesn't invalidate every entry.
+CACHE_DATE_BUCKET_DAYS = 1
+
+# Semantic query cache defaults (see enable_semantic_cache)
+EMBEDDING_MODEL = 'nomic-embed-text'
+SEMANTIC_CACHE_DIR = "deepchain_semantic_cache"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+# Result retention defaults (see enable_result_retention). Results older
+# than the RESULT_KEEP_LAST most recent ones lose their cycle intents,
+# prompts and responses from memory: "spill" moves them to a gzip log
+# at RESULT_LOG_PATH (read back on access), "synthesis" drops them.
+RESULT_RETENTION_MODES = ("spill", "synthesis")
+RESULT_KEEP_LAST = 100
+RESULT_LOG_PATH = "deepchain_results.log.gz"
+RESULT_LOG_COMPRESSION = 6
+
+# Stage scheduler defaults (see enable_scheduler). Costs are relative
+# stage durations used to find the critical path of a query graph;
+# one cost unit is assumed to take SCHEDULER_COST_UNIT_SECONDS.
+SCHEDULER_WORKERS = 4
+SCHEDULER_COST_UNIT_SECONDS = 1.0
+STAGE_COSTS = {
+    STAGE_INTENT: 1,
+    STAGE_PROMPT: 1,
+    STAGE_RESPONSE: 3,
+    STAGE_SYNTHESIS: 4,
+    STAGE_RATING: 1,
+    STAGE_FUSED: 1.5
+}
+
+# Adaptive refinement defaults (see enable_adaptive_refinement).
+# Word overlap between the cycle 1 and cycle 2 answers at or above the
+# agreement threshold means the answer has converged; a self-rating at
+# or above the rating threshold (1-10) accepts cycle 1 on its own.
+ADAPTIVE_AGREEMENT_THRESHOLD = 0.5
+ADAPTIVE_RATING_THRESHOLD = 8
+
+# Pre-synthesis compression (see compress_cycle_responses). The cycle
+# responses passed to synthesis are cut to about this many tokens
+# (0 disables compression); sentences whose word shingles overlap an
+# already kept sentence by at least the dedup threshold are dropped.
+SYNTHESIS_TOKEN_BUDGET = 1500
+SYNTHESIS_DEDUP_THRESHOLD = 0.6
+SHINGLE_SIZE = 3
+
+# Conversation sessions (see Session). A follow-up question reruns one
+# cycle (the deep one if it asks for detail) on the question and a
+# compact context: the last SESSION_TURNS questions and the previous
+# intent and answer cut to SESSION_CONTEXT_TOKENS. A short question
+# counts as a follow-up when it opens with a continuation word, or
+# when it uses a pronoun, names nothing itself and adds at most
+# FOLLOW_UP_MAX_NEW_TERMS content words (stopwords excluded) to the
+# previous turn.
+SESSION_TURNS = 3
+SESSION_CONTEXT_TOKENS = 300
+FOLLOW_UP_MAX_WORDS = 12
+FOLLOW_UP_MAX_NEW_TERMS = 2
+FOLLOW_UP_OPENERS = ("and", "but", "also", "so", "then", "what about", "how about", "what else")
+FOLLOW_UP_PRONOUNS = ("it", "its", "they", "them", "their", "theirs", "those", "these",
+                      "he", "him", "his", "she", "her", "hers")
+FOLLOW_UP_STOPWORDS = frozenset("""
+    a an the and or but so then than if of in on at to for from by with about as into over
+    is are was were be been being am do does did done have has had having can could will would
+    shall should may might must not no yes very just also too only more most much many some any
+    all each every few other such own same what which who whom whose when where why how
+    i me my we us our you your it its they them their he him his she her this that these those
+    there here tell give show please get got make know like well one ones
+""".split())
+FOLLOW_UP_DETAIL_WORDS = ("why", "explain", "detail", "details", "elaborate", "more", "compare")
+
+# Backend pool defaults (see enable_backend_pool). "least-outstanding"
+# picks the host with the fewest calls in flight, "latency" weighs that
+# by each host's recent call latency. Hosts are probed every
+# BACKEND_HEALTH_INTERVAL seconds; a failed host is skipped until a
+# probe succeeds again.
+BACKEND_HOSTS = []
+BACKEND_STRATEGY = "least-outstanding"
+BACKEND_STRATEGIES = ("least-outstanding", "latency")
+BACKEND_HEALTH_INTERVAL = 10.0
+
+# Model residency (see enable_residency). The pipeline's models are
+# loaded on every host at start and pinged every RESIDENCY_PING_INTERVAL
+# seconds (keep it below KEEP_ALIVE) so that no query pays for a model
+# load. The stage scheduler may run a task of a loaded model before a
+# task of an unloaded one that is due up to RESIDENCY_REORDER_SECONDS
+# earlier.
+RESIDENCY = True
+RESIDENCY_PING_INTERVAL = 300.0
+RESIDENCY_LOAD_SECONDS = 1.0
+RESIDENCY_REORDER_SECONDS = 2.0
+
+# Resilience of model calls (see call_model). Each stage call must
+# finish within its timeout; transient failures (connection errors,
+# timeouts, 429/5xx responses) are retried with exponential backoff and
+# full jitter. After BREAKER_FAILURE_THRESHOLD consecutive failures the
+# circuit breaker fails calls immediately for BREAKER_RESET_SECONDS,
+# then lets one trial call through.
+STAGE_TIMEOUTS = {
+    STAGE_INTENT: 60.0,
+    STAGE_PROMPT: 60.0,
+    STAGE_FUSED: 90.0,
+    STAGE_RESPONSE: 180.0,
+    STAGE_SYNTHESIS: 300.0,
+    STAGE_RATING: 30.0
+}
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30.0
+# HTTP timeouts of the Ollama clients: the read timeout bounds a stalled
+# connection (e.g. a call abandoned after its stage timeout)
+CONNECTION_TIMEOUT = httpx.Timeout(300.0, connect=10.0)
+
+# Single-flight coalescing (see SingleFlight): identical queries and
+# identical stage calls in flight at the same time share one execution.
+COALESCE_CALLS = True
+
+# Hedged requests (see enable_hedging). A call of a listed stage that has
+# not completed (a stream: produced its first chunk) within the given
+# percentile of its recent latencies gets a duplicate - on another host
+# when a backend pool is enabled, else in another server slot. The first
+# result wins and the other call is cancelled. Each finished call earns
+# HEDGE_MAX_RATE of a hedge, so at most that share of calls (plus a
+# burst of HEDGE_BURST) is duplicated.
+HEDGE_PERCENTILES = {
+    STAGE_INTENT: 95,
+    STAGE_PROMPT: 95,
+    STAGE_FUSED: 95,
+    STAGE_RESPONSE: 95,
+    STAGE_SYNTHESIS: 95
+}
+HEDGE_MAX_RATE = 0.05
+HEDGE_BURST = 5
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+HEDGE_MIN_DELAY = 0.05
+HEDGING = False
+
+# Cross-query micro-batching (see enable_micro_batching). Intent and
+# prompt calls of concurrent queries for the same stage and cycle that
+# arrive within MICRO_BATCH_WAIT_SECONDS of the first one are sent as one
+# JSON-format call of up to MICRO_BATCH_SIZE items, which evaluates the
+# shared instructions once. MICRO_BATCH_ITEM_TOKENS is added to each
+# item's num_predict for its JSON wrapping.
+MICRO_BATCH_SIZE = 8
+MICRO_BATCH_WAIT_SECONDS = 0.01
+MICRO_BATCH_ITEM_TOKENS = 24
+MICRO_BATCHING = False
+
+# Priority classes of model calls (see call_priority), most urgent first.
+# With a call queue (see enable_call_queue) at most CALL_CAPACITY model
+# calls run at once. Waiting calls start strictly by class; within a
+# class, tenants take turns in proportion to their TENANT_WEIGHTS
+# (unlisted tenants weigh 1). The stage scheduler also runs ready
+# stages of a more urgent class first.
+PRIORITY_CLASSES = ("interactive", "batch")
+DEFAULT_PRIORITY = "interactive"
+BATCH_PRIORITY = "batch"
+DEFAULT_TENANT = "default"
+TENANT_WEIGHTS = {}
+CALL_CAPACITY = 4
+CALL_QUEUE = False
+
+# Histogram buckets of the exported metrics
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Event types produced by the streaming pipeline
+EVENT_CYCLE_STARTED = "cycle_started"
+EVENT_INTENT_READY = "intent_ready"
+EVENT_PROMPT_READY = "prompt_ready"
+EVENT_RESPONSE_TOKEN = "response_token"
+EVENT_RESPONSE_READY = "response_ready"
+EVENT_CYCLE_FAILED = "cycle_failed"
+EVENT_SYNTHESIS_STARTED = "synthesis_started"
+EVENT_SYNTHESIS_TOKEN = "synthesis_token"
+EVENT_DONE = "done"
+
+class PipelineEvent(NamedTuple):
+    """
+    Progress event emitted by the streaming pipeline.
+    
+    cycle is 0 for events not tied to a cycle (synthesis, done).
+    data holds the text for the event; for EVENT_DONE it is the
+    PipelineResult returned by process_user_input.
+    """
+    type: str
+    cycle: int = 0
+    data: Any = None
+
+class ResultLog:
+    """
+    Append-only gzip log of JSON records.
+    
+    Each record is written as a gzip member of its own, so the file is a
+    valid gzip stream and any record can be read back from its
+    (offset, length) without decompressing the others.
+    """
+
+    def __init__(self, path: str = RESULT_LOG_PATH, compression: int = RESULT_LOG_COMPRESSION):
+        """
+        :param path: Path to the log file (appended to if it exists)
+        :param compression: gzip compression level (1-9)
+        """
+        self.path = Path(path)
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a+b")
+
+    def append(self, record: Any) -> Tuple[int, int]:
+        """
+        Writes a record to the end of the log.
+        
+        :param record: JSON-serializable record
+        :return: Tuple[offset, length] locating the record
+        """
+        data = gzip.compress(json.dumps(record, ensure_ascii=False).encode("utf-8"), self.compression)
+        with self._lock:
+            offset = self._file.seek(0, 2)
+            self._file.write(data)
+            self._file.flush()
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> Any:
+        """Reads back the record written at offset."""
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return json.loads(gzip.decompress(data).decode("utf-8"))
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+class CycleResult(Mapping):
+    """
+    Result of one cycle.
+    
+    Reads like a {"intent", "prompt", "response"} dict, with an "error"
+    key when the cycle failed (see failed_cycle). The texts live in a
+    single slot; after spill() only their location in a ResultLog is
+    kept and they are read back on access.
+    """
+
+    __slots__ = ("_texts", "_log", "_ref", "error")
+
+    FIELDS = ("intent", "prompt", "response")
+
+    def __init__(self, intent: str = "", prompt: str = "", response: str = "", error: str = None):
+        self._texts = (intent or "", prompt or "", response or "")
+        self._log = None
+        self._ref = None
+        self.error = error or None
+
+    @property
+    def texts(self) -> Tuple[str, str, str]:
+        """Returns (intent, prompt, response), empty strings once dropped."""
+        texts = self._texts
+        if texts is not None:
+            return texts
+        log, ref = self._log, self._ref
+        return tuple(log.read(*ref)) if log is not None else ("", "", "")
+
+    @property
+    def intent(self) -> str:
+        return self.texts[0]
+
+    @property
+    def prompt(self) -> str:
+        return self.texts[1]
+
+    @property
+    def response(self) -> str:
+        return self.texts[2]
+
+    @property
+    def resident(self) -> bool:
+        """Tells whether the texts are held in memory."""
+        return self._texts is not None
+
+    def spill(self, log: ResultLog) -> None:
+        """Moves the texts to the log, keeping only their location."""
+        texts = self._texts
+        if texts is None:
+            return
+        self._ref = log.append(list(texts))
+        self._log = log
+        self._texts = None
+
+    def drop(self) -> None:
+        """Forgets the texts; the error, if any, is kept."""
+        self._texts = None
+
+    def __getitem__(self, key: str) -> str:
+        if key == "error" and self.error:
+            return self.error
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return self.texts[self.FIELDS.index(key)]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.FIELDS
+        if self.error:
+            yield "error"
+
+    def __len__(self) -> int:
+        return len(self.FIELDS) + bool(self.error)
+
+    def __repr__(self) -> str:
+        return f"CycleResult({dict(self)!r})"
+
+    def to_dict(self) -> Dict[str, str]:
+        return dict(self)
+
+class PipelineResult(NamedTuple):
+    """
+    Result of one query; unpacks as the (cycles, final_synthesis)
+    tuple that process_user_input used to return.
+    """
+    cycles: List[CycleResult]
+    synthesis: str
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"cycles": [dict(cycle) for cycle in self.cycles], "synthesis": self.synthesis}
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> ollama.Client:
+    """Returns the shared Ollama client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ollama.Client(host=OLLAMA_HOST, limits=CONNECTION_LIMITS,
+                                        timeout=CONNECTION_TIMEOUT)
+    return _client
+
+def set_client(client) -> None:
+    """Replaces the shared Ollama client (e.g. to point at another host)."""
+    global _client
+    with _client_lock:
+        _client = client
+
+def is_backend_failure(error: Exception) -> bool:
+    """Tells whether an error means the host, not the request, failed."""
+    if isinstance(error, (httpx.TransportError, ConnectionError)):
+        return True
+    return isinstance(error, ollama.ResponseError) and error.status_code >= 500
+
+class Backend:
+    """One Ollama host of a BackendPool and its load statistics."""
+
+    def __init__(self, host: str, limits: httpx.Limits = None):
+        self.host = host
+        self.limits = limits or CONNECTION_LIMITS
+        self.client = ollama.Client(host=host, limits=self.limits, timeout=CONNECTION_TIMEOUT)
+        self.outstanding = 0
+        self.latency = None
+        self.healthy = True
+        self.calls = 0
+        self.failures = 0
+
+    def load(self, strategy: str) -> float:
+        """Returns the load score used for balancing (lower is better)."""
+        if strategy == "latency":
+            # Hosts without measurements yet are tried first
+            return (self.outstanding + 1) * (self.latency or 0.0)
+        return self.outstanding
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "host": self.host, "healthy": self.healthy, "outstanding": self.outstanding,
+            "latency": self.latency, "calls": self.calls, "failures": self.failures
+        }
+
+class BackendPool:
+    """
+    Spreads model calls over several Ollama hosts.
+    
+    Used in place of ollama.Client (see enable_backend_pool). Each call
+    goes to the healthy host with the lowest load; calls of one query
+    stick to the host its first call went to, so they reuse its loaded
+    model and prompt cache. A call that fails because its host is down
+    is retried on the next host (streams only before the first chunk).
+    """
+
+    def __init__(self, hosts: List[str], strategy: str = BACKEND_STRATEGY,
+                 health_interval: float = BACKEND_HEALTH_INTERVAL, sticky: bool = True,
+                 limits: httpx.Limits = None):
+        """
+        :param hosts: Ollama server addresses
+        :param strategy: Balancing strategy (one of BACKEND_STRATEGIES)
+        :param health_interval: Seconds between health probes (0 disables probing)
+        :param sticky: Keep all calls of a query on one host
+        :param limits: Connection pool limits per host (defaults to CONNECTION_LIMITS)
+        """
+        if not hosts:
+            raise Exception("Backend pool needs at least one host")
+        if strategy not in BACKEND_STRATEGIES:
+            raise Exception(f"Unknown balancing strategy: {strategy}")
+        self.backends = [Backend(host, limits) for host in hosts]
+        self.strategy = strategy
+        self.sticky = sticky
+        self.health_interval = health_interval
+        self._assignments = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._prober = None
+        if health_interval:
+            self._prober = threading.Thread(target=self._probe_loop, daemon=True)
+            self._prober.start()
+
+    def select(self, exclude: Tuple[Backend, ...] = ()) -> Backend:
+        """
+        Picks the host for the next call and counts the call as outstanding.
+        
+        :param exclude: Hosts that already failed this call
+        :return: The chosen backend (release it with finish)
+        """
+        trace = _current_trace.get() if self.sticky else None
+        hedge = _hedging.get()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                raise Exception("All Ollama backends failed")
+            backend = self._assignments.get(trace) if trace is not None else None
+            if hedge:
+                # A hedged duplicate goes to another host than the query's own
+                candidates = [b for b in candidates if b is not backend] or candidates
+                backend = None
+            if backend is None or backend in exclude or not backend.healthy:
+                # If every host is marked down, still try them: the marks may be stale
+                healthy = [b for b in candidates if b.healthy] or candidates
+                backend = min(healthy, key=lambda b: b.load(self.strategy))
+                if trace is not None and not hedge:
+                    self._assignments[trace] = backend
+            backend.outstanding += 1
+            backend.calls += 1
+        return backend
+
+    def finish(self, backend: Backend, started: float, error: Exception = None) -> None:
+        """
+        Records the end of a call started on backend.
+        
+        :param started: time.monotonic() at the start of the call
+        :param error: Exception the call failed with, if any
+        """
+        with self._lock:
+            backend.outstanding -= 1
+            if error is not None and is_backend_failure(error):
+                backend.failures += 1
+                backend.healthy = False
+            elif error is None:
+                elapsed = time.monotonic() - started
+                backend.latency = elapsed if backend.latency is None else 0.8 * backend.latency + 0.2 * elapsed
+                backend.healthy = True
+
+    def generate(self, stream: bool = False, **kwargs):
+        """Runs ollama.Client.generate on the selected host, failing over on host errors."""
+        if stream:
+            return self._stream(kwargs)
+        return self._call(lambda client: client.generate(**kwargs))
+
+    def embeddings(self, **kwargs) -> Dict[str, Any]:
+        """Runs ollama.Client.embeddings on the selected host, failing over on host errors."""
+        return self._call(lambda client: client.embeddings(**kwargs))
+
+    def _call(self, fn):
+        failed = ()
+        while True:
+            backend = self.select(failed)
+            started = time.monotonic()
+            try:
+                result = fn(backend.client)
+            except BaseException as e:
+                self.finish(backend, started, e)
+                if not is_backend_failure(e) or len(failed) + 1 >= len(self.backends):
+                    raise
+                failed += (backend,)
+                continue
+            self.finish(backend, started)
+            return result
+
+    def _stream(self, kwargs: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        failed = ()
+        while True:
+            backend = self.select(failed)
+            started = time.monotonic()
+            chunks = backend.client.generate(stream=True, **kwargs)
+            try:
+                first = next(chunks)
+            except StopIteration:
+                self.finish(backend, started)
+                return
+            except BaseException as e:
+                self.finish(backend, started, e)
+                if not is_backend_failure(e) or len(failed) + 1 >= len(self.backends):
+                    raise
+                failed += (backend,)
+                continue
+            break
+
+        error = None
+        try:
+            yield first
+            yield from chunks
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.finish(backend, started, error)
+
+    def check_health(self) -> None:
+        """Probes every host with a model list request."""
+        for backend in self.backends:
+            try:
+                backend.client.list()
+                healthy = True
+            except Exception:
+                healthy = False
+            with self._lock:
+                backend.healthy = healthy
+
+    def _probe_loop(self) -> None:
+        while not self._stopped.wait(self.health_interval):
+            self.check_health()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [backend.to_dict() for backend in self.backends]
+
+    def close(self) -> None:
+        """Stops health probing."""
+        self._stopped.set()
+
+class AsyncBackendPool:
+    """
+    ollama.AsyncClient counterpart of BackendPool.
+    
+    Shares host selection, load and health state with a BackendPool but
+    has its own async clients, which are bound to one event loop.
+    """
+
+    def __init__(self, pool: BackendPool):
+        self.pool = pool
+        self.clients = {
+            backend: ollama.AsyncClient(host=backend.host, limits=backend.limits,
+                                        timeout=CONNECTION_TIMEOUT)
+            for backend in pool.backends
+        }
+
+    async def generate(self, stream: bool = False, **kwargs):
+        if stream:
+            return self._stream(kwargs)
+        return await self._call(lambda client: client.generate(**kwargs))
+
+    async def embeddings(self, **kwargs) -> Dict[str, Any]:
+        return await self._call(lambda client: client.embeddings(**kwargs))
+
+    async def _call(self, fn):
+        failed = ()
+        while True:
+            backend = self.pool.select(failed)
+            started = time.monotonic()
+            try:
+                result = await fn(self.clients[backend])
+            except BaseException as e:
+                self.pool.finish(backend, started, e)
+                if not is_backend_failure(e) or len(failed) + 1 >= len(self.pool.backends):
+                    raise
+                failed += (backend,)
+                continue
+            self.pool.finish(backend, started)
+            return result
+
+    async def _stream(self, kwargs: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        failed = ()
+        while True:
+            backend = self.pool.select(failed)
+            started = time.monotonic()
+            try:
+                chunks = await self.clients[backend].generate(stream=True, **kwargs)
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                self.pool.finish(backend, started)
+                return
+            except BaseException as e:
+                self.pool.finish(backend, started, e)
+                if not is_backend_failure(e) or len(failed) + 1 >= len(self.pool.backends):
+                    raise
+                failed += (backend,)
+                continue
+            break
+
+        error = None
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.pool.finish(backend, started, error)
+
+    async def aclose(self) -> None:
+        """Closes the pooled connections of every host."""
+        for client in self.clients.values():
+            await client._client.aclose()
+
+_backend_pool = None
+
+def enable_backend_pool(hosts: List[str] = None, **kwargs) -> BackendPool:
+    """
+    Routes all model calls through a pool of Ollama hosts.
+    
+    :param hosts: Ollama server addresses (defaults to BACKEND_HOSTS)
+    :param kwargs: BackendPool arguments (strategy and health_interval
+        default to BACKEND_STRATEGY and BACKEND_HEALTH_INTERVAL)
+    :return: The active pool
+    """
+    global _backend_pool
+    disable_backend_pool()
+    kwargs.setdefault("strategy", BACKEND_STRATEGY)
+    kwargs.setdefault("health_interval", BACKEND_HEALTH_INTERVAL)
+    _backend_pool = BackendPool(hosts or BACKEND_HOSTS, **kwargs)
+    set_client(_backend_pool)
+    return _backend_pool
+
+def disable_backend_pool() -> None:
+    """Returns to the single default host."""
+    global _backend_pool
+    if _backend_pool is not None:
+        _backend_pool.close()
+        _backend_pool = None
+        set_client(None)
+
+def get_backend_pool() -> Optional[BackendPool]:
+    return _backend_pool
+
+def _model_tag(name: str) -> str:
+    """Returns a model name with its tag (Ollama reports "llama3" as "llama3:latest")."""
+    return name if ":" in name else f"{name}:latest"
+
+class ModelResidency:
+    """
+    Keeps the pipeline's models loaded on every Ollama host.
+    
+    preload loads each model with an empty generate call, which makes
+    Ollama load a model without generating. A background thread repeats
+    that every interval seconds for the models still loaded, so they are
+    not unloaded while the pipeline is idle (after KEEP_ALIVE). Models
+    unloaded to make room for others are not reloaded by the pings.
+    Which models are loaded where is read from /api/ps after every
+    preload or ping, and whenever a call reports a model load.
+    """
+
+    def __init__(self, models: List[str] = None, interval: float = RESIDENCY_PING_INTERVAL):
+        """
+        :param models: Models to keep loaded (defaults to pipeline_models())
+        :param interval: Seconds between keep-alive pings (0 disables them)
+        """
+        self.models = list(models or pipeline_models())
+        self.interval = interval
+        self.resident = {}
+        self.load_seconds = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._changed = threading.Event()
+        self._thread = None
+
+    def hosts(self) -> List[Tuple[str, Any]]:
+        """Returns (host, client) of every Ollama host the pipeline calls."""
+        pool = _backend_pool
+        if pool is not None:
+            return [(backend.host, backend.client) for backend in pool.backends]
+        return [(OLLAMA_HOST or "default", get_client())]
+
+    def preload(self, verbose: bool = True) -> None:
+        """Loads every model on every host, the hosts in parallel."""
+        hosts = self.hosts()
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            list(executor.map(lambda host: self._load(*host, self.models, verbose), hosts))
+        self.refresh()
+
+    def ping(self) -> None:
+        """
+        Extends the keep-alive of the models loaded on each host (of all
+        models on a host whose loaded models are not known).
+        """
+        self.refresh()
+        for host, client in self.hosts():
+            with self._lock:
+                loaded = self.resident.get(host)
+            models = self.models if loaded is None else [m for m in self.models if _model_tag(m) in loaded]
+            self._load(host, client, models, verbose=False)
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Reads the loaded models of each host from /api/ps."""
+        for host, client in self.hosts():
+            try:
+                response = client.ps()
+            except Exception:
+                # Unreachable host or a server without /api/ps: keep what is known
+                continue
+            loaded = {_model_tag(entry.get('name') or entry.get('model')) for entry in response['models']}
+            with self._lock:
+                self.resident[host] = loaded
+
+    def is_resident(self, model: str, host: str = None) -> bool:
+        """Tells whether a model is known to be loaded (on host, or on any host)."""
+        model = _model_tag(model)
+        with self._lock:
+            if host is not None:
+                return model in self.resident.get(host, ())
+            return any(model in loaded for loaded in self.resident.values())
+
+    def note_load(self) -> None:
+        """Records that a call had to load a model, which may have unloaded another."""
+        self._changed.set()
+
+    def stats(self) -> Dict[str, List[str]]:
+        """Returns the loaded models by host."""
+        with self._lock:
+            return {host: sorted(loaded) for host, loaded in self.resident.items()}
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        """Stops the keep-alive pings."""
+        self._stopped.set()
+        self._changed.set()
+
+    def _load(self, host: str, client, models: List[str], verbose: bool) -> None:
+        # One model at a time, so that the loads do not compete for memory
+        for model in models:
+            started = time.monotonic()
+            try:
+                client.generate(model=model, prompt="", keep_alive=KEEP_ALIVE)
+            except Exception as e:
+                if verbose:
+                    print(f"Could not load {model} on {host}: {e}")
+                continue
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.resident.setdefault(host, set()).add(_model_tag(model))
+                self.load_seconds[(host, model)] = elapsed
+            if verbose:
+                print(f"Loaded {model} on {host} in {elapsed:.1f}s")
+
+    def _loop(self) -> None:
+        next_ping = time.monotonic() + self.interval if self.interval else None
+        while not self._stopped.is_set():
+            self._changed.wait(None if next_ping is None else max(0.0, next_ping - time.monotonic()))
+            if self._stopped.is_set():
+                return
+            if self._changed.is_set():
+                self._changed.clear()
+                self.refresh()
+            if next_ping is not None and time.monotonic() >= next_ping:
+                self.ping()
+                next_ping = time.monotonic() + self.interval
+
+_residency = None
+
+def enable_residency(preload: bool = True, verbose: bool = True, **kwargs) -> ModelResidency:
+    """
+    Loads the pipeline's models and keeps them loaded (see ModelResidency).
+    Also has the stages ordered so that models are swapped less often
+    (see run_cycles_by_stage and StageScheduler._pop).
+    
+    :param preload: Load every model on every host now
+    :param verbose: Report each model load
+    :return: The active residency manager
+    """
+    global _residency
+    disable_residency()
+    residency = ModelResidency(**kwargs)
+    if preload:
+        residency.preload(verbose)
+    residency.start()
+    _residency = residency
+    return residency
+
+def disable_residency() -> None:
+    global _residency
+    if _residency is not None:
+        _residency.close()
+        _residency = None
+
+def get_residency() -> Optional[ModelResidency]:
+    return _residency
+
+class StageCache:
+    """
+    Persistent content-addressed cache of stage outputs backed by SQLite.
+    
+    Entries are keyed by a hash of (stage, cycle, model, options, prompt)
+    and evicted when older than ttl_seconds or, least recently used
+    first, when the table grows past max_entries.
+    """
+
+    _DATE_PATTERN = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+
+    def __init__(self, path: str = CACHE_PATH, ttl_seconds: float = CACHE_TTL_SECONDS,
+                 max_entries: int = CACHE_MAX_ENTRIES,
+                 date_bucket_days: int = CACHE_DATE_BUCKET_DAYS):
+        """
+        :param path: SQLite database file (":memory:" for a process-local cache)
+        :param ttl_seconds: Entry lifetime; 0 keeps entries until evicted by size
+        :param max_entries: Maximum number of stored entries
+        :param date_bucket_days: Width of the date bucket used in keys
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.date_bucket_days = max(1, date_bucket_days)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS stage_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS stage_cache_accessed ON stage_cache (accessed)")
+        self._db.commit()
+
+    def _date_bucket(self) -> int:
+        return datetime.now().toordinal() // self.date_bucket_days
+
+    def make_key(self, stage: str, cycle_num: int, model: str, options: Optional[Dict], prompt: str) -> str:
+        """
+        Builds the cache key for a model call.
+        
+        Dates in the prompt are masked and the current date bucket is
+        added to the key instead.
+        """
+        normalized = self._DATE_PATTERN.sub("{date}", prompt)
+        material = json.dumps(
+            [stage, cycle_num, model, options or {}, self._date_bucket(), normalized],
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached value or None, updating hit/miss counters."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM stage_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._db.execute("DELETE FROM stage_cache WHERE key = ?", (key,))
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE stage_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def contains(self, key: str) -> bool:
+        """Tells whether a live value is cached, without touching counters or recency."""
+        with self._lock:
+            row = self._db.execute("SELECT created FROM stage_cache WHERE key = ?", (key,)).fetchone()
+        return row is not None and not (self.ttl_seconds and time.time() - row[0] > self.ttl_seconds)
+
+    def put(self, key: str, value: str) -> None:
+        """Stores a value and applies TTL and size eviction."""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO stage_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            if self.ttl_seconds:
+                self._db.execute("DELETE FROM stage_cache WHERE created < ?", (now - self.ttl_seconds,))
+            count = self._db.execute("SELECT COUNT(*) FROM stage_cache").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                    "DELETE FROM stage_cache WHERE key IN "
+                    "(SELECT key FROM stage_cache ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._db.commit()
+
+    def clear(self) -> None:
+        """Removes all entries and resets counters."""
+        with self._lock:
+            self._db.execute("DELETE FROM stage_cache")
+            self._db.commit()
+            self.hits = self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss counters and the current number of entries."""
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM stage_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+_stage_cache = None
+
+def enable_stage_cache(path: str = CACHE_PATH, **kwargs) -> StageCache:
+    """
+    Turns on the persistent stage cache for every model call.
+    
+    :param path: SQLite database file
+    :param kwargs: Extra StageCache arguments (ttl_seconds, max_entries, date_bucket_days)
+    :return: The active cache
+    """
+    global _stage_cache
+    disable_stage_cache()
+    _stage_cache = StageCache(path, **kwargs)
+    return _stage_cache
+
+def disable_stage_cache() -> None:
+    """Turns off the stage cache."""
+    global _stage_cache
+    if _stage_cache is not None:
+        _stage_cache.close()
+        _stage_cache = None
+
+def get_stage_cache() -> Optional[StageCache]:
+    """Returns the active stage cache, or None when caching is off."""
+    return _stage_cache
+
+class StageSpan:
+    """Measurements of one model call."""
+
+    __slots__ = ("stage", "cycle", "model", "offset", "wall_seconds", "prompt_tokens",
+                 "eval_tokens", "tokens_per_second", "load_seconds", "cached", "coalesced")
+
+    def __init__(self, stage: str, cycle: int, model: str, offset: float, wall_seconds: float,
+                 response: Optional[Dict] = None, cached: bool = False, coalesced: bool = False):
+        """
+        :param stage: Pipeline stage (STAGE_* constant)
+        :param cycle: Cycle number (0 for synthesis)
+        :param model: Model name
+        :param offset: Start of the call in seconds since the start of the request
+        :param wall_seconds: Wall time of the call
+        :param response: Final Ollama response carrying the timing fields
+        :param cached: The result came from the stage cache
+        :param coalesced: The result was shared by an identical in-flight call
+        """
+        response = response or {}
+        self.stage = stage
+        self.cycle = cycle
+        self.model = model
+        self.offset = offset
+        self.wall_seconds = wall_seconds
+        self.prompt_tokens = response.get('prompt_eval_count') or 0
+        self.eval_tokens = response.get('eval_count') or 0
+        eval_seconds = (response.get('eval_duration') or 0) / 1e9
+        self.tokens_per_second = self.eval_tokens / eval_seconds if eval_seconds else 0.0
+        self.load_seconds = (response.get('load_duration') or 0) / 1e9
+        self.cached = cached
+        self.coalesced = coalesced
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class RequestTrace:
+    """Structured trace of one query: a span per model call."""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.started_at = time.time()
+        self.spans = []
+        self.total_seconds = None
+        self.coalesced = False
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, cycle: int, model: str, started: float,
+                 response: Optional[Dict] = None, cached: bool = False,
+                 coalesced: bool = False) -> StageSpan:
+        """
+        Records a finished model call.
+        
+        :param started: time.monotonic() at the start of the call
+        """
+        now = time.monotonic()
+        span = StageSpan(stage, cycle, model, started - self._started, now - started,
+                         response, cached, coalesced)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def finish(self) -> None:
+        self.total_seconds = time.monotonic() - self._started
+
+    @property
+    def prompt_tokens(self) -> int:
+        return sum(span.prompt_tokens for span in self.spans)
+
+    @property
+    def eval_tokens(self) -> int:
+        return sum(span.eval_tokens for span in self.spans)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "query": self.query,
+            "started_at": self.started_at,
+            "total_seconds": self.total_seconds,
+            "coalesced": self.coalesced,
+            "model_calls": len(self.spans),
+            "prompt_tokens": self.prompt_tokens,
+            "eval_tokens": self.eval_tokens,
+            "spans": [span.to_dict() for span in self.spans]
+        }
+
+class Histogram:
+    """Cumulative histogram in the Prometheus sense."""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        sep = "," if labels else ""
+        lines = [
+            f'{name}_bucket{{{labels}{sep}le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.total}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class PipelineMetrics:
+    """Process-wide aggregates of stage spans and request traces."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stage_latency = {}
+            self.stage_tokens_per_second = {}
+            self.stage_counters = {}
+            self.request_latency = Histogram(LATENCY_BUCKETS)
+            self.coalesced_queries = 0
+            self.call_retries = {}
+            self.call_failures = {}
+            self.call_hedges = {}
+            self.hedge_wins = {}
+            self.batches = {}
+            self.batched_calls = {}
+            self.queue_wait = {}
+
+    def observe_span(self, span: StageSpan) -> None:
+        with self._lock:
+            counters = self.stage_counters.setdefault(span.stage, {
+                "calls": 0, "cache_hits": 0, "coalesced": 0, "prompt_tokens": 0,
+                "eval_tokens": 0, "load_seconds": 0.0
+            })
+            if span.cached:
+                counters["cache_hits"] += 1
+                return
+            if span.coalesced:
+                counters["coalesced"] += 1
+                return
+            counters["calls"] += 1
+            counters["prompt_tokens"] += span.prompt_tokens
+            counters["eval_tokens"] += span.eval_tokens
+            counters["load_seconds"] += span.load_seconds
+            self.stage_latency.setdefault(span.stage, Histogram(LATENCY_BUCKETS)).observe(span.wall_seconds)
+            if span.tokens_per_second:
+                self.stage_tokens_per_second.setdefault(
+                    span.stage, Histogram(TOKENS_PER_SECOND_BUCKETS)
+                ).observe(span.tokens_per_second)
+
+    def observe_call_error(self, stage: str, retried: bool) -> None:
+        """Counts a failed model call attempt, retried or final."""
+        with self._lock:
+            counters = self.call_retries if retried else self.call_failures
+            counters[stage] = counters.get(stage, 0) + 1
+
+    def observe_hedge(self, stage: str, won: bool) -> None:
+        """Counts a hedged duplicate call and whether it beat the original."""
+        with self._lock:
+            self.call_hedges[stage] = self.call_hedges.get(stage, 0) + 1
+            if won:
+                self.hedge_wins[stage] = self.hedge_wins.get(stage, 0) + 1
+
+    def observe_batch(self, stage: str, size: int) -> None:
+        """Counts a micro-batch and the stage calls it replaced."""
+        with self._lock:
+            self.batches[stage] = self.batches.get(stage, 0) + 1
+            self.batched_calls[stage] = self.batched_calls.get(stage, 0) + size
+
+    def observe_queue_wait(self, priority: str, seconds: float) -> None:
+        """Records how long a model call waited in the call queue."""
+        with self._lock:
+            self.queue_wait.setdefault(priority, Histogram(QUEUE_WAIT_BUCKETS)).observe(seconds)
+
+    def observe_request(self, trace: RequestTrace) -> None:
+        with self._lock:
+            self.request_latency.observe(trace.total_seconds)
+            if trace.coalesced:
+                self.coalesced_queries += 1
+
+    def to_prometheus(self) -> str:
+        """Renders all metrics in the Prometheus text exposition format."""
+        counter_help = {
+            "calls": "Model calls sent to Ollama",
+            "cache_hits": "Model calls answered by the stage cache",
+            "coalesced": "Model calls that shared the result of an identical in-flight call",
+            "prompt_tokens": "Prompt tokens evaluated",
+            "eval_tokens": "Tokens generated",
+            "load_seconds": "Seconds spent loading models"
+        }
+        lines = []
+        with self._lock:
+            for key, help_text in counter_help.items():
+                name = f"deepchain_stage_{key}_total"
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for stage, counters in sorted(self.stage_counters.items()):
+                    lines.append(f'{name}{{stage="{stage}"}} {counters[key]}')
+
+            for name, help_text, histograms in (
+                ("deepchain_stage_latency_seconds", "Wall time of model calls", self.stage_latency),
+                ("deepchain_stage_tokens_per_second", "Generation speed of model calls",
+                 self.stage_tokens_per_second)
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for stage, histogram in sorted(histograms.items()):
+                    lines += histogram.render(name, f'stage="{stage}"')
+
+            name = "deepchain_call_queue_wait_seconds"
+            lines += [f"# HELP {name} Time model calls waited for a call slot",
+                      f"# TYPE {name} histogram"]
+            for priority, histogram in sorted(self.queue_wait.items()):
+                lines += histogram.render(name, f'class="{priority}"')
+
+            name = "deepchain_request_latency_seconds"
+            lines += [f"# HELP {name} End-to-end wall time of queries", f"# TYPE {name} histogram"]
+            lines += self.request_latency.render(name, "")
+
+            name = "deepchain_coalesced_queries_total"
+            lines += [f"# HELP {name} Queries that shared the result of an identical in-flight query",
+                      f"# TYPE {name} counter", f"{name} {self.coalesced_queries}"]
+
+            for name, help_text, counters in (
+                ("deepchain_stage_retries_total", "Model call attempts retried after a transient failure",
+                 self.call_retries),
+                ("deepchain_stage_failures_total", "Model calls that failed for good", self.call_failures),
+                ("deepchain_stage_hedges_total", "Hedged duplicates of slow model calls", self.call_hedges),
+                ("deepchain_stage_hedge_wins_total", "Hedged duplicates that finished first", self.hedge_wins),
+                ("deepchain_stage_batches_total", "Micro-batched calls of several queries", self.batches),
+                ("deepchain_stage_batched_calls_total", "Stage calls answered by micro-batches",
+                 self.batched_calls)
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for stage, count in sorted(counters.items()):
+                    lines.append(f'{name}{{stage="{stage}"}} {count}')
+
+        name = "deepchain_circuit_open"
+        lines += [f"# HELP {name} Whether the circuit breaker rejects model calls",
+                  f"# TYPE {name} gauge", f"{name} {int(_breaker.state != 'closed')}"]
+        return "\n".join(lines) + "\n"
+
+_metrics = PipelineMetrics()
+_current_trace = contextvars.ContextVar("deepchain_trace", default=None)
+_trace_file = None
+_trace_file_lock = threading.Lock()
+
+def get_metrics() -> PipelineMetrics:
+    """Returns the process-wide metrics."""
+    return _metrics
+
+def enable_trace_file(path: str) -> None:
+    """Appends every finished request trace to a JSONL file."""
+    global _trace_file
+    _trace_file = path
+
+def disable_trace_file() -> None:
+    global _trace_file
+    _trace_file = None
+
+def _finish_trace(trace: RequestTrace) -> None:
+    trace.finish()
+    _metrics.observe_request(trace)
+    path = _trace_file
+    if path:
+        with _trace_file_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + "\n")
+
+@contextmanager
+def trace_request(query: str) -> Iterator[RequestTrace]:
+    """
+    Collects the model calls made inside the block into a RequestTrace.
+    
+    Nested blocks reuse the outer trace, so wrapping process_user_input
+    gives the caller access to its trace.
+    
+    :param query: User's text
+    :return: The active trace
+    """
+    current = _current_trace.get()
+    if current is not None:
+        yield current
+        return
+
+    trace = RequestTrace(query)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        _finish_trace(trace)
+
+def _bind_context(fn):
+    """Wraps fn to run in a copy of the caller's context (for worker threads)."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def _record_call(stage: str, cycle_num: int, model: str, started: float,
+                 response: Optional[Dict] = None, cached: bool = False,
+                 coalesced: bool = False) -> None:
+    """Adds a model call to the current trace and the aggregated metrics."""
+    trace = _current_trace.get()
+    if trace is not None:
+        span = trace.add_span(stage, cycle_num, model, started, response, cached, coalesced)
+    else:
+        span = StageSpan(stage, cycle_num, model, 0.0, time.monotonic() - started,
+                         response, cached, coalesced)
+    _metrics.observe_span(span)
+    residency = _residency
+    if residency is not None and span.load_seconds >= RESIDENCY_LOAD_SECONDS:
+        residency.note_load()
+
+def get_stage_model(stage: str, cycle_num: int = 0) -> str:
+    """
+    Returns the model routed to a stage and cycle.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param cycle_num: Cycle number (0 for synthesis)
+    :return: Model name
+    """
+    route = STAGE_MODELS.get(stage)
+    if isinstance(route, dict):
+        route = route.get(cycle_num) or route.get(str(cycle_num))
+    return route or MODEL_NAME
+
+def get_stage_options(stage: str, cycle_num: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    Returns the Ollama generation options of a stage and cycle:
+    the "default" profile, overridden by the stage's profile and then
+    by its "cycles" entry. Options set to None are left out.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param cycle_num: Cycle number (0 for synthesis)
+    :return: Options dictionary, or None when there are none
+    """
+    options = {}
+    for profile in (STAGE_OPTIONS.get("default") or {}, STAGE_OPTIONS.get(stage) or {}):
+        cycles = profile.get("cycles") or {}
+        options.update((name, value) for name, value in profile.items() if name != "cycles")
+        options.update(cycles.get(cycle_num) or cycles.get(str(cycle_num)) or {})
+    return {name: value for name, value in options.items() if value is not None} or None
+
+def merge_stage_options(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Merges a stage profile from the config over the built-in one.
+    
+    An option set for the whole stage also replaces the built-in
+    per-cycle values of that option.
+    """
+    cycles = {
+        str(cycle): {name: value for name, value in options.items() if name not in override}
+        for cycle, options in (base.get("cycles") or {}).items()
+    }
+    for cycle, options in (override.get("cycles") or {}).items():
+        cycles[str(cycle)] = dict(cycles.get(str(cycle), {}), **options)
+    merged = dict(base, **override)
+    if cycles:
+        merged["cycles"] = cycles
+    return merged
+
+def pipeline_models() -> List[str]:
+    """Returns every model the stages are routed to, the fallback model included."""
+    models = [MODEL_NAME]
+    for route in STAGE_MODELS.values():
+        models += list(route.values()) if isinstance(route, dict) else [route]
+    models.append(FALLBACK_MODEL or MODEL_NAME)
+    return list(dict.fromkeys(model for model in models if model))
+
+def stages_swap_models() -> bool:
+    """Tells whether a cycle's response uses another model than its intent and prompt."""
+    meta_stages = (STAGE_FUSED,) if FUSED_STAGES else (STAGE_INTENT, STAGE_PROMPT)
+    return any(
+        get_stage_model(stage, cycle_num) != get_stage_model(STAGE_RESPONSE, cycle_num)
+        for cycle_num in (1, 2, 3) for stage in meta_stages
+    )
+
+def get_fallback_model(stage: str, cycle_num: int = 0) -> Optional[str]:
+    """Returns the model to retry a stage with, or None if it already uses it."""
+    fallback = FALLBACK_MODEL or MODEL_NAME
+    return fallback if fallback != get_stage_model(stage, cycle_num) else None
+
+def load_config(path: str) -> Dict[str, Any]:
+    """
+    Loads pipeline settings from a JSON file.
+    
+    The "models" section sets the default model ("default"), the
+    fallback model ("fallback"), how long models stay loaded
+    ("keep_alive"), whether they are loaded at start ("preload") and
+    pinged every "ping_interval" seconds (see enable_residency), and
+    per-stage routing ("stages"), e.g.
+    {"models": {"stages": {"intent": "gemma2:2b",
+                           "prompt": {"1": "gemma2:2b", "2": "gemma2:2b"}}}}
+    
+    The "backends" section lists Ollama hosts to balance over ("hosts"),
+    the balancing strategy ("strategy") and the health probe interval
+    ("health_interval"); see enable_backend_pool.
+    
+    The "generation" section sets Ollama generation options per stage
+    (num_predict, num_ctx, temperature, stop, ...), merged over
+    STAGE_OPTIONS stage by stage, e.g.
+    {"generation": {"default": {"num_ctx": 4096},
+                    "intent": {"num_predict": 48, "stop": ["\\n\\n"]},
+                    "response": {"cycles": {"3": {"num_predict": 2048}}}}}
+    
+    The "resilience" section overrides per-stage call timeouts in
+    seconds ("timeouts"), the number of attempts ("retries") and the
+    circuit breaker ("breaker_threshold", "breaker_reset_seconds").
+    
+    The "hedging" section turns on hedged requests ("enabled") and sets
+    the latency percentile per hedged stage ("percentiles") and the
+    share of calls that may be duplicated ("max_rate"), e.g.
+    {"hedging": {"enabled": true, "percentiles": {"response": 90}, "max_rate": 0.1}}
+    
+    The "priorities" section sets the model calls run at once
+    ("call_limit", which enables the call queue) and the share of each
+    tenant within a priority class ("tenant_weights"), e.g.
+    {"priorities": {"call_limit": 4, "tenant_weights": {"nightly": 0.5}}}
+    
+    The "batching" section turns on cross-query micro-batching of the
+    intent and prompt stages ("enabled") and sets the batch size
+    ("max_batch") and how long a call waits for others ("max_wait_ms").
+    
+    :param path: Path to the config file
+    :return: Parsed config
+    """
+    global MODEL_NAME, STAGE_MODELS, FALLBACK_MODEL, KEEP_ALIVE
+    global BACKEND_HOSTS, BACKEND_STRATEGY, BACKEND_HEALTH_INTERVAL
+    global STAGE_TIMEOUTS, RETRY_ATTEMPTS, STAGE_OPTIONS
+    global HEDGING, HEDGE_PERCENTILES, HEDGE_MAX_RATE
+    global RESIDENCY, RESIDENCY_PING_INTERVAL
+    global MICRO_BATCHING, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_SECONDS
+    global CALL_QUEUE, CALL_CAPACITY, TENANT_WEIGHTS
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+
+    models = config.get("models", {})
+    MODEL_NAME = models.get("default", MODEL_NAME)
+    STAGE_MODELS = models.get("stages", STAGE_MODELS)
+    FALLBACK_MODEL = models.get("fallback", FALLBACK_MODEL)
+    KEEP_ALIVE = models.get("keep_alive", KEEP_ALIVE)
+    RESIDENCY = models.get("preload", RESIDENCY)
+    RESIDENCY_PING_INTERVAL = models.get("ping_interval", RESIDENCY_PING_INTERVAL)
+
+    backends = config.get("backends", {})
+    BACKEND_HOSTS = backends.get("hosts", BACKEND_HOSTS)
+    BACKEND_STRATEGY = backends.get("strategy", BACKEND_STRATEGY)
+    BACKEND_HEALTH_INTERVAL = backends.get("health_interval", BACKEND_HEALTH_INTERVAL)
+
+    STAGE_OPTIONS = dict(STAGE_OPTIONS)
+    for stage, profile in config.get("generation", {}).items():
+        STAGE_OPTIONS[stage] = merge_stage_options(STAGE_OPTIONS.get(stage) or {}, profile)
+
+    resilience = config.get("resilience", {})
+    STAGE_TIMEOUTS = dict(STAGE_TIMEOUTS, **resilience.get("timeouts", {}))
+    RETRY_ATTEMPTS = max(1, resilience.get("retries", RETRY_ATTEMPTS))
+    _breaker.failure_threshold = resilience.get("breaker_threshold", _breaker.failure_threshold)
+    _breaker.reset_seconds = resilience.get("breaker_reset_seconds", _breaker.reset_seconds)
+
+    hedging = config.get("hedging", {})
+    HEDGING = hedging.get("enabled", HEDGING)
+    HEDGE_PERCENTILES = hedging.get("percentiles", HEDGE_PERCENTILES)
+    HEDGE_MAX_RATE = hedging.get("max_rate", HEDGE_MAX_RATE)
+
+    priorities = config.get("priorities", {})
+    CALL_CAPACITY = priorities.get("call_limit", CALL_CAPACITY)
+    TENANT_WEIGHTS = priorities.get("tenant_weights", TENANT_WEIGHTS)
+    CALL_QUEUE = bool(priorities.get("call_limit", CALL_QUEUE))
+
+    batching = config.get("batching", {})
+    MICRO_BATCHING = batching.get("enabled", MICRO_BATCHING)
+    MICRO_BATCH_SIZE = batching.get("max_batch", MICRO_BATCH_SIZE)
+    MICRO_BATCH_WAIT_SECONDS = batching.get("max_wait_ms", MICRO_BATCH_WAIT_SECONDS * 1000) / 1000
+    return config
+
+def _cache_key(stage: str, cycle_num: int, model: str, options: Optional[Dict],
+               prompt: str) -> Optional[str]:
+    cache = _stage_cache
+    if cache is None:
+        return None
+    return cache.make_key(stage, cycle_num, model, options, prompt)
+
+def _cache_get(key: Optional[str]) -> Optional[str]:
+    cache = _stage_cache
+    return cache.get(key) if cache is not None and key else None
+
+def _cache_has(key: Optional[str]) -> bool:
+    cache = _stage_cache
+    return cache is not None and bool(key) and cache.contains(key)
+
+def _cache_put(key: Optional[str], value: str) -> None:
+    cache = _stage_cache
+    if cache is not None and key and value:
+        cache.put(key, value)
+
+class SingleFlight:
+    """
+    Runs a function once per key among concurrent callers: callers that
+    arrive while a call with the same key is in flight wait for it and
+    share its result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, fn) -> Tuple[Any, bool]:
+        """
+        :param key: Identity of the call
+        :param fn: Function computing the result
+        :return: Tuple[result, whether it was shared from another caller]
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"], True
+
+        try:
+            call["result"] = fn()
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
+        return call["result"], False
+
+class AsyncSingleFlight:
+    """
+    Asyncio counterpart of SingleFlight.
+    
+    The shared call runs as a task in the context of the first caller.
+    It is cancelled only once every caller waiting on it is cancelled,
+    so one caller's deadline doesn't fail the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key: Any, factory) -> Tuple[Any, bool]:
+        """
+        :param key: Identity of the call
+        :param factory: Function returning the coroutine computing the result
+        :return: Tuple[result, whether it was shared from another caller]
+        """
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+            call["task"].add_done_callback(
+                lambda _: self._calls.pop(key) if self._calls.get(key) is call else None
+            )
+
+        call["waiters"] += 1
+        try:
+            return await asyncio.shield(call["task"]), not leader
+        finally:
+            call["waiters"] -= 1
+            if not call["waiters"] and not call["task"].done():
+                call["task"].cancel()
+
+class MicroBatcher:
+    """
+    Packs requests that arrive close together into batches. The first
+    request of a batch waits up to max_wait seconds (less once max_batch
+    requests with its key have arrived), runs the whole batch and hands
+    every request its result.
+    """
+
+    def __init__(self, max_batch: int = MICRO_BATCH_SIZE, max_wait: float = MICRO_BATCH_WAIT_SECONDS):
+        """
+        :param max_batch: Most requests in one batch
+        :param max_wait: Seconds the first request of a batch waits for others
+        """
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._open = {}
+        self._cond = threading.Condition()
+
+    def do(self, key: Any, item: Any, run) -> Any:
+        """
+        :param key: Requests with the same key can share a batch
+        :param item: The caller's request
+        :param run: Function mapping a list of requests to the list of their results
+        :return: The caller's result
+        """
+        future = Future()
+        with self._cond:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._open[key] = []
+            batch.append((item, future))
+            if len(batch) >= self.max_batch:
+                del self._open[key]
+                self._cond.notify_all()
+
+        if leader:
+            deadline = time.monotonic() + self.max_wait
+            with self._cond:
+                while self._open.get(key) is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        del self._open[key]
+                        break
+                    self._cond.wait(remaining)
+            try:
+                results = run([request for request, _ in batch])
+            except BaseException as e:
+                for _, waiter in batch:
+                    waiter.set_exception(e)
+            else:
+                for (_, waiter), result in zip(batch, results):
+                    waiter.set_result(result)
+        return future.result()
+
+class AsyncMicroBatcher:
+    """
+    Asyncio counterpart of MicroBatcher.
+    
+    A batch runs as a task of its own, so cancelling the request that
+    opened it does not fail the others.
+    """
+
+    def __init__(self, max_batch: int = MICRO_BATCH_SIZE, max_wait: float = MICRO_BATCH_WAIT_SECONDS):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self._open = {}
+
+    async def do(self, key: Any, item: Any, run) -> Any:
+        """
+        :param key: Requests with the same key can share a batch
+        :param item: The caller's request
+        :param run: Coroutine function mapping a list of requests to the list of their results
+        :return: The caller's result
+        """
+        future = asyncio.get_event_loop().create_future()
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = {"items": [], "full": asyncio.Event()}
+            asyncio.ensure_future(self._run(key, batch, run))
+        batch["items"].append((item, future))
+        if len(batch["items"]) >= self.max_batch:
+            del self._open[key]
+            batch["full"].set()
+        return await asyncio.shield(future)
+
+    async def _run(self, key: Any, batch: Dict[str, Any], run) -> None:
+        try:
+            await asyncio.wait_for(batch["full"].wait(), self.max_wait)
+        except asyncio.TimeoutError:
+            pass
+        if self._open.get(key) is batch:
+            del self._open[key]
+        try:
+            results = await run([request for request, _ in batch["items"]])
+        except BaseException as e:
+            for _, waiter in batch["items"]:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            for (_, waiter), result in zip(batch["items"], results):
+                if not waiter.done():
+                    waiter.set_result(result)
+
+_micro_batcher = None
+
+def enable_micro_batching(max_batch: int = MICRO_BATCH_SIZE,
+                          max_wait: float = MICRO_BATCH_WAIT_SECONDS) -> MicroBatcher:
+    """
+    Sends the intent and prompt calls of concurrent queries in batches
+    (see run_meta_batch). AsyncDeepChain instances created afterwards
+    batch their calls the same way.
+    
+    :param max_batch: Most calls in one batch
+    :param max_wait: Seconds a call waits for others to join its batch
+    :return: The active batcher
+    """
+    global _micro_batcher
+    _micro_batcher = MicroBatcher(max_batch, max_wait)
+    return _micro_batcher
+
+def disable_micro_batching() -> None:
+    global _micro_batcher
+    _micro_batcher = None
+
+def get_micro_batcher() -> Optional[MicroBatcher]:
+    return _micro_batcher
+
+_call_priority = contextvars.ContextVar("deepchain_priority", default=None)
+
+@contextmanager
+def call_priority(priority: str = DEFAULT_PRIORITY, tenant: str = DEFAULT_TENANT) -> Iterator[None]:
+    """
+    Makes the model calls made inside the block (and in tasks and stage
+    tasks started from it) wait in a priority class, on behalf of a tenant.
+    
+    :param priority: One of PRIORITY_CLASSES
+    :param tenant: Name the fair share of the class is kept for
+    """
+    if priority not in PRIORITY_CLASSES:
+        raise Exception(f"Unknown priority class: {priority}")
+    token = _call_priority.set((priority, tenant or DEFAULT_TENANT))
+    try:
+        yield
+    finally:
+        _call_priority.reset(token)
+
+def current_priority() -> Tuple[str, str]:
+    """Returns (priority class, tenant) of the calls made by the caller."""
+    return _call_priority.get() or (DEFAULT_PRIORITY, DEFAULT_TENANT)
+
+class FairShare:
+    """
+    Order in which waiting calls start: strictly by priority class, so a
+    queued call of a lower class is passed over by every call of a
+    higher one; within a class, tenants take turns by deficit round
+    robin, each call costing one unit and each turn earning the
+    tenant's weight.
+    """
+
+    def __init__(self, weights: Dict[str, float] = None):
+        """
+        :param weights: Share of each tenant (defaults to TENANT_WEIGHTS; unlisted tenants get 1)
+        """
+        self.weights = TENANT_WEIGHTS if weights is None else weights
+        self._queues = {priority: OrderedDict() for priority in PRIORITY_CLASSES}
+        self._deficits = {}
+
+    def __len__(self) -> int:
+        return sum(len(waiters) for tenants in self._queues.values() for waiters in tenants.values())
+
+    def push(self, priority: str, tenant: str, waiter: Any) -> None:
+        self._queues[priority].setdefault(tenant, deque()).append(waiter)
+
+    def remove(self, priority: str, tenant: str, waiter: Any) -> None:
+        """Takes a waiter out of the queue (e.g. a cancelled call)."""
+        waiters = self._queues[priority].get(tenant)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._queues[priority][tenant]
+                self._deficits.pop((priority, tenant), None)
+
+    def pop(self) -> Any:
+        """Returns the waiter to start next, or None if none is waiting."""
+        for priority in PRIORITY_CLASSES:
+            tenants = self._queues[priority]
+            while tenants:
+                tenant = next(iter(tenants))
+                key = (priority, tenant)
+                deficit = self._deficits.get(key, 0.0)
+                if deficit < 1:
+                    deficit += max(0.01, self.weights.get(tenant, 1))
+                    self._deficits[key] = deficit
+                    if deficit < 1:
+                        tenants.move_to_end(tenant)
+                        continue
+                waiters = tenants[tenant]
+                waiter = waiters.popleft()
+                self._deficits[key] = deficit - 1
+                if not waiters:
+                    del tenants[tenant]
+                    del self._deficits[key]
+                elif deficit - 1 < 1:
+                    tenants.move_to_end(tenant)
+                return waiter
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the number of waiting calls by priority class."""
+        return {
+            priority: sum(len(waiters) for waiters in tenants.values())
+            for priority, tenants in self._queues.items()
+        }
+
+class CallQueue:
+    """
+    Lets at most capacity model calls run at once; the others wait and
+    start in FairShare order as running calls finish.
+    """
+
+    def __init__(self, capacity: int = CALL_CAPACITY, weights: Dict[str, float] = None):
+        """
+        :param capacity: Model calls running at once
+        :param weights: Tenant shares (see FairShare)
+        """
+        self.capacity = max(1, capacity)
+        self.active = 0
+        self._order = FairShare(weights)
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Waits for a call slot; every acquire() needs one release()."""
+        priority, tenant = current_priority()
+        started = time.monotonic()
+        waiter = None
+        with self._lock:
+            if self.active < self.capacity and not len(self._order):
+                self.active += 1
+            else:
+                waiter = threading.Event()
+                self._order.push(priority, tenant, waiter)
+        if waiter is not None:
+            # The slot of the call that finished is handed over as is
+            waiter.wait()
+        _metrics.observe_queue_wait(priority, time.monotonic() - started)
+
+    def try_acquire(self) -> bool:
+        """Takes a slot only if one is free and no call is waiting for it."""
+        with self._lock:
+            if self.active < self.capacity and not len(self._order):
+                self.active += 1
+                return True
+            return False
+
+    def release(self) -> None:
+        """Frees a slot (may be called from any thread)."""
+        with self._lock:
+            waiter = self._order.pop()
+            if waiter is None:
+                self.active -= 1
+        if waiter is not None:
+            waiter.set()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Holds a call slot for the duration of the block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"capacity": self.capacity, "active": self.active, "waiting": self._order.stats()}
+
+class AsyncCallQueue:
+    """Asyncio counterpart of CallQueue; a cancelled call leaves the queue."""
+
+    def __init__(self, capacity: int = CALL_CAPACITY, weights: Dict[str, float] = None):
+        self.capacity = max(1, capacity)
+        self.active = 0
+        self._order = FairShare(weights)
+
+    async def acquire(self) -> None:
+        """Waits for a call slot; every acquire() needs one release()."""
+        priority, tenant = current_priority()
+        started = time.monotonic()
+        if self.active < self.capacity and not len(self._order):
+            self.active += 1
+        else:
+            waiter = asyncio.get_event_loop().create_future()
+            self._order.push(priority, tenant, waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Cancelled after being handed a slot: pass it on
+                    self.release()
+                else:
+                    self._order.remove(priority, tenant, waiter)
+                raise
+        _metrics.observe_queue_wait(priority, time.monotonic() - started)
+
+    def try_acquire(self) -> bool:
+        """Takes a slot only if one is free and no call is waiting for it."""
+        if self.active < self.capacity and not len(self._order):
+            self.active += 1
+            return True
+        return False
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Holds a call slot for the duration of the block."""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self) -> None:
+        """Frees a slot, handing it to the next waiting call."""
+        while True:
+            waiter = self._order.pop()
+            if waiter is None:
+                self.active -= 1
+                return
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {"capacity": self.capacity, "active": self.active, "waiting": self._order.stats()}
+
+_call_queue = None
+
+def enable_call_queue(capacity: int = CALL_CAPACITY, weights: Dict[str, float] = None) -> CallQueue:
+    """
+    Queues model calls beyond capacity by priority class and tenant
+    (see call_priority). AsyncDeepChain queues its calls the same way
+    when created with a call_limit.
+    
+    :return: The active queue
+    """
+    global _call_queue
+    _call_queue = CallQueue(capacity, weights)
+    return _call_queue
+
+def disable_call_queue() -> None:
+    global _call_queue
+    _call_queue = None
+
+def get_call_queue() -> Optional[CallQueue]:
+    return _call_queue
+
+def _acquire_call_slot():
+    """
+    Takes a slot of the call queue, if one is enabled.
+    
+    :return: Function releasing the slot, or None without a queue
+    """
+    queue = _call_queue
+    if queue is None:
+        return None
+    queue.acquire()
+    return queue.release
+
+def _try_call_slot(queue):
+    """
+    Takes a free slot of a CallQueue or AsyncCallQueue without waiting.
+    
+    :return: Function releasing the slot (a no-op without a queue), or
+        None when no slot is free
+    """
+    if queue is None:
+        return _no_release
+    return queue.release if queue.try_acquire() else None
+
+def _open_in_slot(open_stream) -> Iterator[Dict[str, Any]]:
+    """Opens a stream that holds a call slot until it ends or fails."""
+    release = _acquire_call_slot()
+    if release is None:
+        return open_stream()
+    try:
+        chunks = open_stream()
+    except BaseException:
+        release()
+        raise
+    return _release_after(chunks, release)
+
+def _release_after(chunks: Iterator, release) -> Iterator[Dict[str, Any]]:
+    try:
+        yield from chunks
+    finally:
+        release()
+
+# Keys of both include the priority class: a query joining an in-flight
+# one of a lower class would otherwise wait behind that class's calls
+_query_flight = SingleFlight()
+_call_flight = SingleFlight()
+
+def normalize_query(text: str) -> str:
+    """Returns the coalescing key of a query: case, spacing and final punctuation ignored."""
+    return " ".join(text.lower().split()).rstrip(" ?!.")
+
+class ModelCallError(Exception):
+    """A model call failed (after retries, if the failure was transient)."""
+
+class CircuitOpenError(ModelCallError):
+    """The circuit breaker is open: the backend is considered down."""
+
+class StageTimeoutError(ModelCallError):
+    """A model call exceeded its stage timeout."""
+
+def is_transient_error(error: BaseException) -> bool:
+    """Tells whether retrying a failed model call may succeed."""
+    if isinstance(error, (StageTimeoutError, httpx.TransportError, ConnectionError)):
+        return True
+    return isinstance(error, ollama.ResponseError) and (
+        error.status_code == 429 or error.status_code >= 500
+    )
+
+class CircuitBreaker:
+    """
+    Fails model calls fast while the backend is down.
+    
+    closed: calls pass; consecutive transient failures are counted.
+    open: calls fail with CircuitOpenError until reset_seconds pass.
+    half-open: one trial call passes; its outcome closes or reopens.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Raises CircuitOpenError unless a call may go to the backend."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half-open"
+                self._trial_running = False
+            if self.state == "open" or (self.state == "half-open" and self._trial_running):
+                raise CircuitOpenError("Ollama backend unavailable (circuit open)")
+            if self.state == "half-open":
+                self._trial_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def record_other(self) -> None:
+        """Records a call that ended without telling anything about the backend."""
+        with self._lock:
+            self._trial_running = False
+
+_breaker = CircuitBreaker()
+_call_executor = None
+_call_executor_lock = threading.Lock()
+
+def get_circuit_breaker() -> CircuitBreaker:
+    return _breaker
+
+def retry_delay(attempt: int) -> float:
+    """Returns the backoff before retry number attempt (1-based), with full jitter."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+def _run_with_timeout(fn, timeout: Optional[float], release=None):
+    """
+    Runs fn on a helper thread and waits at most timeout seconds.
+    
+    A call that times out keeps its thread until the HTTP read timeout
+    (CONNECTION_TIMEOUT) ends it; the caller is released right away.
+    
+    :param release: Called once fn has finished, even if the caller
+        stopped waiting (e.g. to free the call slot it was holding)
+    """
+    global _call_executor
+    if not timeout:
+        try:
+            return fn()
+        finally:
+            if release is not None:
+                release()
+    if _call_executor is None:
+        with _call_executor_lock:
+            if _call_executor is None:
+                _call_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="deepchain-call")
+    future = _call_executor.submit(_bind_context(fn))
+    if release is not None:
+        # An abandoned call keeps its slot until its thread is done
+        future.add_done_callback(lambda _: release())
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise StageTimeoutError(f"Model call exceeded {timeout:g}s")
+
+def _call_failed(stage: str, attempt: int, error: BaseException, retryable: bool = True) -> bool:
+    """
+    Updates the breaker and metrics after a failed attempt.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param attempt: Number of the failed attempt (1-based)
+    :param error: Exception the attempt failed with
+    :param retryable: The call may be repeated (False once a stream has produced output)
+    :return: Whether the call should be retried
+    """
+    if not is_transient_error(error):
+        _breaker.record_other()
+        _metrics.observe_call_error(stage, retried=False)
+        return False
+    _breaker.record_failure()
+    retry = retryable and attempt < RETRY_ATTEMPTS
+    _metrics.observe_call_error(stage, retried=retry)
+    return retry
+
+def _give_up(stage: str, attempt: int, error: Exception) -> None:
+    """Raises the error a call ends with once it is not retried any more."""
+    if is_transient_error(error):
+        raise ModelCallError(f"{stage} call failed after {attempt} attempt(s): {error}") from error
+    raise error
+
+def call_model(stage: str, fn):
+    """
+    Runs one model call under the resilience policy: the stage timeout,
+    retries of transient failures and the circuit breaker.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param fn: Function performing the call
+    :return: Result of fn
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        _breaker.before_call()
+        try:
+            # One slot per attempt, free during the retry delay
+            result = _run_with_timeout(fn, STAGE_TIMEOUTS.get(stage), _acquire_call_slot())
+        except Exception as e:
+            if not _call_failed(stage, attempt, e):
+                _give_up(stage, attempt, e)
+            time.sleep(retry_delay(attempt))
+            continue
+        _breaker.record_success()
+        return result
+
+def stream_model(stage: str, open_stream) -> Iterator[Dict[str, Any]]:
+    """
+    Streaming variant of call_model. Only opening the stream (up to the
+    first chunk) is retried; the stage timeout is checked between chunks.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param open_stream: Function returning an iterator of response chunks
+    :return: Iterator of response chunks
+    """
+    timeout = STAGE_TIMEOUTS.get(stage)
+    attempt = 0
+    while True:
+        attempt += 1
+        _breaker.before_call()
+        started = time.monotonic()
+        chunks = None
+        try:
+            # Each attempt holds a call slot until its stream ends
+            chunks = _open_in_slot(open_stream)
+            first = next(chunks, None)
+        except Exception as e:
+            if not _call_failed(stage, attempt, e):
+                _give_up(stage, attempt, e)
+            time.sleep(retry_delay(attempt))
+            continue
+        break
+
+    try:
+        if first is not None:
+            yield first
+            for chunk in chunks:
+                if timeout and time.monotonic() - started > timeout:
+                    raise StageTimeoutError(f"Model call exceeded {timeout:g}s")
+                yield chunk
+    except GeneratorExit:
+        _breaker.record_other()
+        raise
+    except Exception as e:
+        # Chunks were already passed on, so the call is not retried
+        _call_failed(stage, attempt, e, retryable=False)
+        _give_up(stage, attempt, e)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    _breaker.record_success()
+
+async def _aacquire_slot(call_queue: Optional[AsyncCallQueue]):
+    """
+    Takes a slot of an AsyncCallQueue, if one is given.
+    
+    :return: Function releasing the slot
+    """
+    if call_queue is None:
+        return _no_release
+    await call_queue.acquire()
+    return call_queue.release
+
+def _no_release() -> None:
+    pass
+
+async def acall_model(stage: str, factory, call_queue: AsyncCallQueue = None):
+    """
+    Async counterpart of call_model.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param factory: Function returning the coroutine performing the call
+    :param call_queue: Queue each attempt takes a slot of; the wait for
+        it is not part of the stage timeout
+    :return: Result of the coroutine
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        _breaker.before_call()
+        release = await _aacquire_slot(call_queue)
+        try:
+            timeout = STAGE_TIMEOUTS.get(stage)
+            try:
+                result = await asyncio.wait_for(factory(), timeout) if timeout else await factory()
+            except asyncio.TimeoutError:
+                raise StageTimeoutError(f"Model call exceeded {timeout:g}s")
+            finally:
+                # Free during the retry delay
+                release()
+        except asyncio.CancelledError:
+            _breaker.record_other()
+            raise
+        except Exception as e:
+            if not _call_failed(stage, attempt, e):
+                _give_up(stage, attempt, e)
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+        _breaker.record_success()
+        return result
+
+async def astream_model(stage: str, open_stream,
+                        call_queue: AsyncCallQueue = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async counterpart of stream_model.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param open_stream: Function returning a coroutine that resolves to
+        an async iterator of response chunks
+    :param call_queue: Queue each attempt takes a slot of until its stream
+        ends; the wait for it is not part of the stage timeout
+    :return: Async iterator of response chunks
+    """
+    timeout = STAGE_TIMEOUTS.get(stage)
+    attempt = 0
+    while True:
+        attempt += 1
+        _breaker.before_call()
+        release = await _aacquire_slot(call_queue)
+        started = time.monotonic()
+        try:
+            chunks = await asyncio.wait_for(open_stream(), timeout)
+            first = await asyncio.wait_for(chunks.__anext__(), timeout and max(0.0, started + timeout - time.monotonic()))
+        except StopAsyncIteration:
+            first = None
+        except asyncio.TimeoutError:
+            release()
+            error = StageTimeoutError(f"Model call exceeded {timeout:g}s")
+            if not _call_failed(stage, attempt, error):
+                _give_up(stage, attempt, error)
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+        except asyncio.CancelledError:
+            release()
+            _breaker.record_other()
+            raise
+        except Exception as e:
+            release()
+            if not _call_failed(stage, attempt, e):
+                _give_up(stage, attempt, e)
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+        break
+
+    if first is None:
+        release()
+        _breaker.record_success()
+        return
+    try:
+        yield first
+        while True:
+            remaining = timeout and started + timeout - time.monotonic()
+            if timeout and remaining <= 0:
+                raise StageTimeoutError(f"Model call exceeded {timeout:g}s")
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), remaining or None)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise StageTimeoutError(f"Model call exceeded {timeout:g}s")
+            yield chunk
+    except (GeneratorExit, asyncio.CancelledError):
+        _breaker.record_other()
+        raise
+    except Exception as e:
+        # Chunks were already passed on, so the call is not retried
+        _call_failed(stage, attempt, e, retryable=False)
+        _give_up(stage, attempt, e)
+    finally:
+        try:
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            release()
+    _breaker.record_success()
+
+class HedgeCancelled(Exception):
+    """A hedged call lost the race and was stopped."""
+
+class HedgePolicy:
+    """
+    Learns recent call latencies per stage and rations hedged calls.
+    
+    Latencies of whole calls and of streams (time to the first chunk)
+    are kept apart, the last window of each per stage.
+    """
+
+    def __init__(self, percentiles: Dict[str, float] = None, max_rate: float = HEDGE_MAX_RATE,
+                 burst: int = HEDGE_BURST, min_samples: int = HEDGE_MIN_SAMPLES,
+                 window: int = HEDGE_WINDOW):
+        """
+        :param percentiles: Latency percentile after which a call is hedged, by stage
+            (defaults to HEDGE_PERCENTILES; stages left out are never hedged)
+        :param max_rate: Hedges earned per finished call
+        :param burst: Largest number of hedges that can be saved up
+        :param min_samples: Latencies needed before a stage is hedged
+        :param window: Latencies kept per stage
+        """
+        self.percentiles = dict(HEDGE_PERCENTILES if percentiles is None else percentiles)
+        self.max_rate = max_rate
+        self.burst = burst
+        self.min_samples = min_samples
+        self.window = window
+        self._latencies = {}
+        self._budget = float(burst)
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, streaming: bool, seconds: float) -> None:
+        """Records the latency of a finished call (a stream: of its first chunk)."""
+        with self._lock:
+            self._latencies.setdefault((stage, streaming), deque(maxlen=self.window)).append(seconds)
+            self._budget = min(float(self.burst), self._budget + self.max_rate)
+
+    def delay(self, stage: str, streaming: bool) -> Optional[float]:
+        """
+        Returns how long a call may run before it is hedged, or None
+        while too few latencies of the stage are known.
+        """
+        percentile = self.percentiles.get(stage)
+        with self._lock:
+            samples = sorted(self._latencies.get((stage, streaming), ()))
+        if percentile is None or len(samples) < max(1, self.min_samples):
+            return None
+        rank = min(len(samples), max(1, math.ceil(percentile / 100 * len(samples))))
+        return max(HEDGE_MIN_DELAY, samples[rank - 1])
+
+    def acquire(self) -> bool:
+        """Takes one hedge from the budget; False if it is used up."""
+        with self._lock:
+            if self._budget < 1:
+                return False
+            self._budget -= 1
+            return True
+
+_hedge_policy = None
+_hedge_executor = None
+_hedging = contextvars.ContextVar("deepchain_hedging", default=False)
+
+def enable_hedging(**kwargs) -> HedgePolicy:
+    """
+    Duplicates model calls that run longer than usual (see HedgePolicy
+    for the arguments).
+    
+    :return: The active policy
+    """
+    global _hedge_policy
+    _hedge_policy = HedgePolicy(**kwargs)
+    return _hedge_policy
+
+def disable_hedging() -> None:
+    global _hedge_policy
+    _hedge_policy = None
+
+def get_hedge_policy() -> Optional[HedgePolicy]:
+    return _hedge_policy
+
+def _hedged_stage(stage: str) -> bool:
+    policy = _hedge_policy
+    return policy is not None and stage in policy.percentiles
+
+def _race(stage: str, streaming: bool, run, discard=None):
+    """
+    Runs run(cancelled) and, once it is slower than the stage's hedge
+    delay, a duplicate of it; the first successful result wins. The
+    duplicate takes its own call slot and is skipped when none is free.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param streaming: run returns as soon as the first chunk arrived
+    :param run: Function performing the call; it should stop with
+        HedgeCancelled once the threading.Event passed to it is set
+    :param discard: Called with the result of a losing call that finished anyway
+    :return: Result of the winning call
+    """
+    global _hedge_executor
+    policy = _hedge_policy
+    call_queue = _call_queue
+    delay = policy.delay(stage, streaming)
+    if delay is None:
+        started = time.monotonic()
+        result = run(threading.Event())
+        policy.observe(stage, streaming, time.monotonic() - started)
+        return result
+
+    # Own workers: the calls run while a worker of _call_executor waits for them
+    if _hedge_executor is None:
+        with _call_executor_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="deepchain-hedge")
+    calls = {}
+
+    def start(hedge: bool) -> None:
+        cancelled = threading.Event()
+        context = contextvars.copy_context()
+        context.run(_hedging.set, hedge)
+        calls[_hedge_executor.submit(context.run, run, cancelled)] = (cancelled, time.monotonic(), hedge)
+
+    def drop(future: Future) -> None:
+        if discard is not None and not future.cancelled() and future.exception() is None:
+            discard(future.result())
+
+    start(False)
+    done, _ = wait(calls, timeout=delay)
+    hedge_release = None
+    if not done:
+        hedge_release = _acquire_hedge_slot(policy, call_queue)
+        if hedge_release is not None:
+            start(True)
+    winner, error = None, None
+    pending = set(calls)
+    try:
+        while winner is None and pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = future
+                    break
+                error = error or future.exception()
+    finally:
+        for future, (cancelled, _, _) in calls.items():
+            if future is not winner:
+                cancelled.set()
+                future.cancel()
+                future.add_done_callback(drop)
+        if hedge_release is not None:
+            # The duplicate's slot covers the call left over until it stops
+            leftover = next(future for future in calls if future is not winner)
+            leftover.add_done_callback(lambda _: hedge_release())
+    if winner is None:
+        raise error
+    _, started, hedge = calls[winner]
+    policy.observe(stage, streaming, time.monotonic() - started)
+    if len(calls) > 1:
+        _metrics.observe_hedge(stage, won=hedge)
+    return winner.result()
+
+def _acquire_hedge_slot(policy: HedgePolicy, call_queue):
+    """
+    Lets a duplicate start if the hedge budget allows it and a call slot
+    is free: a duplicate never waits for a slot or exceeds the call limit.
+    
+    :return: Function releasing the duplicate's slot, or None to skip the hedge
+    """
+    release = _try_call_slot(call_queue)
+    if release is not None and not policy.acquire():
+        release()
+        return None
+    return release
+
+async def _arace(stage: str, streaming: bool, factory, discard=None,
+                 call_queue: AsyncCallQueue = None):
+    """
+    Async counterpart of _race: the losing call is cancelled.
+    
+    :param factory: Function returning the coroutine performing the call
+    :param discard: Coroutine function called with the result of a
+        losing call that finished anyway
+    :param call_queue: Queue the duplicate needs a free slot of
+    """
+    policy = _hedge_policy
+    delay = policy.delay(stage, streaming)
+    if delay is None:
+        started = time.monotonic()
+        result = await factory()
+        policy.observe(stage, streaming, time.monotonic() - started)
+        return result
+
+    calls = {}
+
+    def start(hedge: bool) -> None:
+        # The task copies the context, and with it the hedge mark, when created
+        token = _hedging.set(hedge)
+        try:
+            calls[asyncio.ensure_future(factory())] = (time.monotonic(), hedge)
+        finally:
+            _hedging.reset(token)
+
+    def drop(task: asyncio.Future) -> None:
+        if task.cancelled():
+            return
+        # Retrieved so that asyncio does not report it as unhandled
+        error = task.exception()
+        if error is None and discard is not None:
+            asyncio.ensure_future(discard(task.result()))
+
+    start(False)
+    winner, error = None, None
+    hedge_release = None
+    try:
+        done, _ = await asyncio.wait(list(calls), timeout=delay)
+        if not done:
+            hedge_release = _acquire_hedge_slot(policy, call_queue)
+            if hedge_release is not None:
+                start(True)
+        pending = set(calls)
+        while winner is None and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+                error = error or task.exception()
+    finally:
+        for task in calls:
+            if task is not winner:
+                task.cancel()
+                task.add_done_callback(drop)
+        if hedge_release is not None:
+            leftover = next(task for task in calls if task is not winner)
+            leftover.add_done_callback(lambda _: hedge_release())
+    if winner is None:
+        raise error
+    started, hedge = calls[winner]
+    policy.observe(stage, streaming, time.monotonic() - started)
+    if len(calls) > 1:
+        _metrics.observe_hedge(stage, won=hedge)
+    return winner.result()
+
+def _prepend_chunk(first: Optional[Dict[str, Any]], chunks: Iterator) -> Iterator[Dict[str, Any]]:
+    """Yields first (unless None), then the rest of chunks."""
+    try:
+        if first is not None:
+            yield first
+            yield from chunks
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+async def _aprepend_chunk(first: Optional[Dict[str, Any]], chunks: AsyncIterator) -> AsyncIterator[Dict[str, Any]]:
+    try:
+        if first is not None:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        aclose = getattr(chunks, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+def generate_hedged(stage: str, **kwargs) -> Dict[str, Any]:
+    """
+    client.generate(**kwargs) under the hedging policy.
+    
+    A hedged stage is generated as a stream, so that the losing call can
+    be stopped midway; the result is the final chunk with the whole text.
+    """
+    client = get_client()
+    if not _hedged_stage(stage):
+        return client.generate(**kwargs)
+
+    def run(cancelled: threading.Event) -> Dict[str, Any]:
+        chunks = client.generate(stream=True, **kwargs)
+        parts, final = [], {}
+        try:
+            for chunk in chunks:
+                if cancelled.is_set():
+                    raise HedgeCancelled()
+                parts.append(chunk['response'])
+                if chunk.get('done'):
+                    final = chunk
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return dict(final, response="".join(parts))
+
+    return _race(stage, False, run)
+
+def stream_hedged(stage: str, **kwargs) -> Iterator[Dict[str, Any]]:
+    """client.generate(stream=True, **kwargs) under the hedging policy."""
+    client = get_client()
+    if not _hedged_stage(stage):
+        return client.generate(stream=True, **kwargs)
+
+    def run(cancelled: threading.Event) -> Tuple[Optional[Dict[str, Any]], Iterator]:
+        chunks = client.generate(stream=True, **kwargs)
+        return next(chunks, None), chunks
+
+    def discard(result) -> None:
+        if hasattr(result[1], "close"):
+            result[1].close()
+
+    return _prepend_chunk(*_race(stage, True, run, discard))
+
+async def agenerate_hedged(client, stage: str, call_queue: AsyncCallQueue = None,
+                           **kwargs) -> Dict[str, Any]:
+    """
+    Async counterpart of generate_hedged; a losing call is simply cancelled.
+    A duplicate takes a free slot of call_queue, if given (see _arace).
+    """
+    if not _hedged_stage(stage):
+        return await client.generate(**kwargs)
+    return await _arace(stage, False, lambda: client.generate(**kwargs), call_queue=call_queue)
+
+async def astream_hedged(client, stage: str, call_queue: AsyncCallQueue = None,
+                         **kwargs) -> AsyncIterator[Dict[str, Any]]:
+    """Async counterpart of stream_hedged."""
+    if not _hedged_stage(stage):
+        return await client.generate(stream=True, **kwargs)
+
+    async def open_stream() -> Tuple[Optional[Dict[str, Any]], AsyncIterator]:
+        chunks = await client.generate(stream=True, **kwargs)
+        try:
+            return await chunks.__anext__(), chunks
+        except StopAsyncIteration:
+            return None, chunks
+
+    async def discard(result) -> None:
+        aclose = getattr(result[1], "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    return _aprepend_chunk(*await _arace(stage, True, open_stream, discard, call_queue))
+
+def generate_text(stage: str, cycle_num: int, prompt: str, model: str = None,
+                  format: str = '', options: Dict[str, Any] = None) -> str:
+    """
+    Runs one model call and returns the stripped response text.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param cycle_num: Cycle number (0 for synthesis)
+    :param prompt: Full prompt text
+    :param model: Model override (defaults to the stage's routed model)
+    :param format: Ollama output format ('' or 'json')
+    :param options: Generation options override (defaults to the stage's options)
+    :return: Model response
+    """
+    model = model or get_stage_model(stage, cycle_num)
+    if options is None:
+        options = get_stage_options(stage, cycle_num)
+    started = time.monotonic()
+    key = _cache_key(stage, cycle_num, model, options, prompt)
+    cached = _cache_get(key)
+    if cached is not None:
+        _record_call(stage, cycle_num, model, started, cached=True)
+        return cached
+
+    def call() -> str:
+        response = call_model(stage, lambda: generate_hedged(
+            stage, model=model, prompt=prompt, format=format, options=options, keep_alive=KEEP_ALIVE
+        ))
+        _record_call(stage, cycle_num, model, started, response)
+        text = response['response'].strip()
+        _cache_put(key, text)
+        return text
+
+    if not COALESCE_CALLS:
+        return call()
+    text, shared = _call_flight.do(
+        (current_priority()[0], model, format, json.dumps(options, sort_keys=True), prompt), call
+    )
+    if shared:
+        _record_call(stage, cycle_num, model, started, coalesced=True)
+    return text
+
+def stream_text(stage: str, cycle_num: int, prompt: str, model: str = None) -> Iterator[str]:
+    """
+    Streaming variant of generate_text.
+    
+    A cached response is yielded as a single chunk.
+    
+    :param stage: Pipeline stage (STAGE_* constant)
+    :param cycle_num: Cycle number (0 for synthesis)
+    :param prompt: Full prompt text
+    :param model: Model override (defaults to the stage's routed model)
+    :return: Iterator over response chunks
+    """
+    model = model or get_stage_model(stage, cycle_num)
+    options = get_stage_options(stage, cycle_num)
+    started = time.monotonic()
+    key = _cache_key(stage, cycle_num, model, options, prompt)
+    cached = _cache_get(key)
+    if cached is not None:
+        _record_call(stage, cycle_num, model, started, cached=True)
+        yield cached
+        return
+
+    chunks = []
+    for chunk in stream_model(stage, lambda: stream_hedged(
+        stage, model=model, prompt=prompt, options=options, keep_alive=KEEP_ALIVE
+    )):
+        if chunk['response']:
+            chunks.append(chunk['response'])
+            yield chunk['response']
+        if chunk.get('done'):
+            # The last chunk carries the timing and token counts
+            _record_call(stage, cycle_num, model, started, chunk)
+    _cache_put(key, "".join(chunks).strip())
+
+class SemanticCache:
+    """
+    Query-level cache that matches paraphrased questions by embedding similarity.
+    
+    Embeddings are L2-normalized and stored row by row in a memory-mapped
+    file (float32, or int8 when quantized); lookups are a brute-force
+    cosine search over all rows. Stored results live in a JSONL file with
+    one line per row; only the byte offset of each line is kept in
+    memory and the line is read back on a hit.
+    """
+
+    def __init__(self, directory: str = SEMANTIC_CACHE_DIR, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 model: str = EMBEDDING_MODEL, quantize: bool = False):
+        """
+        :param directory: Directory holding the index files
+        :param threshold: Minimum cosine similarity counted as a hit
+        :param model: Ollama embedding model
+        :param quantize: Store vectors as int8 (4x smaller, slightly less precise)
+        """
+        if np is None:
+            raise Exception("The semantic cache requires numpy (pip install numpy)")
+        self.threshold = threshold
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dir = Path(directory)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._meta_path = self._dir / "index.json"
+        self._entries_path = self._dir / "entries.jsonl"
+
+        if self._meta_path.exists():
+            meta = json.loads(self._meta_path.read_text())
+            self.dim, self.quantize = meta["dim"], meta["quantize"]
+        else:
+            self.dim, self.quantize = None, quantize
+        self._dtype = np.int8 if self.quantize else np.float32
+        self._vectors_path = self._dir / ("vectors.i8" if self.quantize else "vectors.f32")
+
+        self._offsets = array("q")
+        self._load_offsets()
+        self._vectors = None
+        self._map_vectors()
+
+    def _load_offsets(self) -> None:
+        """
+        Indexes the entries, repairing the files after a crash during add():
+        a partly written entry is cut off, and so is every entry or vector
+        row without a counterpart, so that row i stays entry i.
+        """
+        end = 0
+        if self._entries_path.exists():
+            with open(self._entries_path, "rb") as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    if line.strip():
+                        self._offsets.append(offset)
+                    offset += len(line)
+                    end = offset
+        row_size = self.dim * np.dtype(self._dtype).itemsize if self.dim else 0
+        rows = self._vectors_path.stat().st_size // row_size if row_size and self._vectors_path.exists() else 0
+        if rows < len(self._offsets):
+            # Entries are written first, so their vector may be missing
+            end = self._offsets[rows]
+            del self._offsets[rows:]
+        if self._entries_path.exists() and self._entries_path.stat().st_size != end:
+            os.truncate(self._entries_path, end)
+        if row_size and self._vectors_path.exists() and self._vectors_path.stat().st_size != len(self._offsets) * row_size:
+            os.truncate(self._vectors_path, len(self._offsets) * row_size)
+
+    def _map_vectors(self) -> None:
+        rows = len(self._offsets)
+        if self.dim is None or rows == 0:
+            self._vectors = None
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=self._dtype, mode="r", shape=(rows, self.dim))
+
+    def embed(self, text: str) -> "np.ndarray":
+        """Embeds text with the Ollama embedding model."""
+        return self.normalize(get_client().embeddings(model=self.model, prompt=text)['embedding'])
+
+    @staticmethod
+    def normalize(embedding) -> "np.ndarray":
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, vector: "np.ndarray") -> Optional[PipelineResult]:
+        """
+        Returns the stored (cycles, final_synthesis) of the most similar
+        query when its similarity reaches the threshold.
+        """
+        with self._lock:
+            if self._vectors is None or vector.shape[0] != self.dim:
+                self.misses += 1
+                return None
+            scores = self._vectors @ vector
+            if self.quantize:
+                scores = scores / 127.0
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            offset = self._offsets[best]
+        with open(self._entries_path, "rb") as f:
+            f.seek(offset)
+            entry = json.loads(f.readline().decode("utf-8"))
+        return PipelineResult([CycleResult(**cycle) for cycle in entry["cycles"]], entry["synthesis"])
+
+    def add(self, vector: "np.ndarray", query: str, cycles: List[Dict[str, str]], final_synthesis: str) -> None:
+        """Appends a query result to the index."""
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vector.shape[0])
+                self._meta_path.write_text(json.dumps({"dim": self.dim, "quantize": self.quantize}))
+            if vector.shape[0] != self.dim:
+                return
+            row = np.round(vector * 127).astype(np.int8) if self.quantize else vector.astype(np.float32)
+            # The entry goes first: a crash before its vector row is written
+            # leaves an entry without a row, which loading cuts off
+            entry = {"query": query, "cycles": [dict(cycle) for cycle in cycles], "synthesis": final_synthesis}
+            with open(self._entries_path, "ab") as f:
+                offset = f.seek(0, 2)
+                f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+            try:
+                with open(self._vectors_path, "ab") as f:
+                    f.write(row.tobytes())
+            except BaseException:
+                os.truncate(self._entries_path, offset)
+                raise
+            self._offsets.append(offset)
+            self._map_vectors()
+
+    def stats(self) -> Dict[str, int]:
+        """Returns hit/miss counters and the number of indexed queries."""
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._offsets)}
+
+_semantic_cache = None
+
+def enable_semantic_cache(directory: str = SEMANTIC_CACHE_DIR, **kwargs) -> SemanticCache:
+    """
+    Turns on the semantic query cache in front of process_user_input.
+    
+    :param directory: Directory holding the index files
+    :param kwargs: Extra SemanticCache arguments (threshold, model, quantize)
+    :return: The active cache
+    """
+    global _semantic_cache
+    _semantic_cache = SemanticCache(directory, **kwargs)
+    return _semantic_cache
+
+def disable_semantic_cache() -> None:
+    """Turns off the semantic query cache."""
+    global _semantic_cache
+    _semantic_cache = None
+
+def _is_complete_result(cycles: List[Dict[str, str]], final_synthesis: str) -> bool:
+    """Tells whether a pipeline result is free of failed cycles and model error messages."""
+    if any(is_failed_cycle(cycle) for cycle in cycles):
+        return False
+    texts = [final_synthesis] + [cycle['response'] for cycle in cycles]
+    return not any(text.startswith("Error ") for text in texts)
 
 def get_current_date():
     """Returns the current date in YYYY-MM-DD format."""
     return datetime.now().strftime("%Y-%m-%d")
 
-def analyze_user_intent(input_text: str, cycle_num: int) -> str:
+# Depth of each cycle, as named in the shared prefix
+CYCLE_DEPTHS = {1: "basic", 2: "deep", 3: "expanded"}
+
+def build_meta_instructions() -> str:
+    """Returns the instructions of the intent and prompt stages of all cycles."""
+    return """
+        You analyze user requests in three cycles of increasing depth.
+        
+        Intent analysis:
+        - basic: find key words, determine request type (informational, analytical,
+          creative) and main topic, formulate the goal in one sentence
+        - deep: consider the request from an expert's perspective: request context,
+          possible implicit goals, expected response format, level of detail,
+          potential related interests
+        - expanded: determine the broadest possible context: explicit and implicit
+          goals, possible request prerequisites, related topics, potential follow-up
+          questions, practical application of information
+        Don't repeat the request text, create a new intent formulation.
+        
+        Prompt generation:
+        - basic: a prompt for a direct answer: clear formulation of the main question,
+          specification of desired response format, minimum necessary clarifications
+        - deep: a prompt for an elaborate response: information structuring, request
+          for additional context, clarification of related aspects, indication of
+          need for explanations
+        - expanded: a prompt for complete topic analysis: coverage of all topic aspects,
+          examples and illustrations, practical application, connection with other
+          topics, perspectives and trends
+        The prompt must follow from the intent.
+        
+        Reply with the result of the task only.
+        
+        """
+
+def build_shared_prefix(input_text: str) -> str:
+    """
+    Builds the prompt head shared by the intent, prompt and fused stages
+    of every cycle: the instructions of all cycles first, then the user's
+    text. Only the short task line differs between these calls.
+    
+    Ollama keeps the evaluated tokens of recent prompts while the model
+    is loaded, so calls starting with the same text only evaluate what
+    follows it; the instructions are even shared between queries.
+    
+    :param input_text: User's text
+    :return: Prompt prefix
+    """
+    return build_meta_instructions() + f"""User text: {input_text}
+        Date: {get_current_date()}
+        """
+
+def build_intent_prompt(input_text: str, cycle_num: int) -> str:
+    """
+    Builds the intent analysis prompt for the given cycle.
+    
+    :param input_text: User's text
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: Prompt text
+    """
+    depth = CYCLE_DEPTHS[cycle_num]
+    return build_shared_prefix(input_text) + f"""
+        Task: {depth} intent analysis.
+        
+        {depth.capitalize()} intent:
+        """
+
+def analyze_user_intent(input_text: str, cycle_num: int) -> str:
+    """
+    Analyzes user intent based on input text.
+    Different approaches for different cycles.
+    
+    :param input_text: User's text
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: String with user intent
+    """
+    try:
+        prompt = build_intent_prompt(input_text, cycle_num)
+        return (_batched_meta_call(STAGE_INTENT, cycle_num, prompt, input_text)
+                or generate_text(STAGE_INTENT, cycle_num, prompt))
+    except ModelCallError:
+        raise
+    except Exception:
+        return None
+
+def build_generation_prompt(input_text: str, user_intent: str, cycle_num: int) -> str:
+    """
+    Builds the prompt-generation request for the given cycle.
+    
+    :param input_text: User's text
+    :param user_intent: User's intent
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: Prompt text
+    """
+    return build_shared_prefix(input_text) + f"""
+        Task: {CYCLE_DEPTHS[cycle_num]} prompt generation.
+        
+        Intent: {user_intent}
+        
+        Generate prompt:
+        """
+
+def generate_llm_prompt(input_text: str, user_intent: str, cycle_num: int, model: str = None) -> str:
+    """
+    Generates an effective prompt for LLM.
+    Different generation approaches for different cycles.
+    
+    :param input_text: User's text
+    :param user_intent: User's intent
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :param model: Model override (defaults to the stage's routed model)
+    :return: Generated prompt
+    """
+    try:
+        prompt = build_generation_prompt(input_text, user_intent, cycle_num)
+        if model is None:
+            batched = _batched_meta_call(STAGE_PROMPT, cycle_num, prompt, input_text, user_intent)
+            if batched:
+                return batched
+        return generate_text(STAGE_PROMPT, cycle_num, prompt, model)
+    except ModelCallError:
+        raise
+    except Exception:
+        return None
+
+def build_response_prompt(prompt: str, cycle_num: int) -> str:
+    """
+    Appends cycle-specific instructions to the generated prompt.
+    
+    The fixed preamble comes first so that its evaluation is reused
+    across cycles and queries.
+    
+    :param prompt: Prepared prompt
+    :param cycle_num: Cycle number
+    :return: Full prompt text
+    """
+    cycle_instructions = {
+        1: "Provide a direct and concise answer to the question.",
+        2: "Provide a detailed response with explanations.",
+        3: "Create a complete topic analysis with examples and context."
+    }
+    return f"{RESPONSE_PREAMBLE}\n\n{prompt}\n\n{cycle_instructions[cycle_num]}"
+
+def get_llm_response(prompt: str, cycle_num: int) -> str:
+    """
+    Gets response from the language model.
+    Different approaches for different cycles.
+    
+    :param prompt: Prepared prompt
+    :param cycle_num: Cycle number
+    :return: Model response (errors are raised, never returned as text)
+    """
+    return generate_text(STAGE_RESPONSE, cycle_num, build_response_prompt(prompt, cycle_num))
+
+def stream_llm_response(prompt: str, cycle_num: int) -> Iterator[str]:
+    """
+    Streaming variant of get_llm_response.
+    
+    :param prompt: Prepared prompt
+    :param cycle_num: Cycle number
+    :return: Iterator over response chunks as the model produces them
+    """
+    yield from stream_text(STAGE_RESPONSE, cycle_num, build_response_prompt(prompt, cycle_num))
+
+def post_process_prompt(prompt: str) -> str:
+    """Processes the received prompt."""
+    prompt = prompt.strip('"').strip("'")
+    prompt = re.sub(r'^(prompt:)\s*', '', prompt, flags=re.IGNORECASE)
+    prompt = re.sub(r'\s+', ' ', prompt)
+    return prompt.strip()
+
+def validate_prompt(prompt: str) -> bool:
+    """Checks prompt validity."""
+    return bool(prompt) and len(prompt.split()) >= 3
+
+def prepare_prompt(llm_prompt: str) -> str:
+    """
+    Post-processes and validates a generated prompt.
+    
+    :param llm_prompt: Raw prompt returned by the model
+    :return: Cleaned prompt
+    """
+    if not llm_prompt:
+        raise Exception("Failed to generate prompt")
+    final_prompt = post_process_prompt(llm_prompt)
+    if not validate_prompt(final_prompt):
+        raise Exception("Generated prompt is incorrect")
+    return final_prompt
+
+def generate_valid_prompt(input_text: str, user_intent: str, cycle_num: int) -> str:
+    """
+    Generates and prepares a prompt, regenerating it with the fallback
+    model when the routed model's output fails validation.
+    
+    :param input_text: User's text
+    :param user_intent: User's intent
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: Cleaned prompt
+    """
+    llm_prompt = generate_llm_prompt(input_text, user_intent, cycle_num)
+    try:
+        return prepare_prompt(llm_prompt)
+    except Exception:
+        fallback = get_fallback_model(STAGE_PROMPT, cycle_num)
+        if fallback is None:
+            raise
+    return prepare_prompt(generate_llm_prompt(input_text, user_intent, cycle_num, fallback))
+
+def build_fused_prompt(input_text: str, cycle_num: int) -> str:
+    """
+    Builds the single-call prompt that returns both intent and prompt.
+    
+    :param input_text: User's text
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: Prompt text
+    """
+    depth = CYCLE_DEPTHS[cycle_num]
+    return build_shared_prefix(input_text) + f"""
+        Task: {depth} intent analysis and {depth} prompt generation. Reply with
+        a JSON object with two string fields, "intent" and "prompt".
+        
+        JSON:
+        """
+
+def parse_fused_output(text: str) -> Tuple[str, str]:
+    """
+    Validates the fused stage output against its schema:
+    a JSON object with non-empty string fields "intent" and "prompt".
+    
+    :param text: Raw model output
+    :return: Tuple[intent, cleaned prompt]
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        raise Exception("Fused stage returned invalid JSON")
+    if not isinstance(data, dict):
+        raise Exception("Fused stage returned a non-object")
+    intent, prompt = data.get("intent"), data.get("prompt")
+    if not isinstance(intent, str) or not intent.strip() or not isinstance(prompt, str):
+        raise Exception("Fused stage output does not match the schema")
+    return intent.strip(), prepare_prompt(prompt)
+
+def generate_intent_and_prompt(input_text: str, cycle_num: int) -> Tuple[str, str]:
+    """
+    Determines intent and prompt of a cycle in one JSON-format call.
+    
+    Output that fails schema validation falls back to the separate
+    intent and prompt stages.
+    
+    :param input_text: User's text
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :return: Tuple[intent, cleaned prompt]
+    """
+    try:
+        return parse_fused_output(
+            generate_text(STAGE_FUSED, cycle_num, build_fused_prompt(input_text, cycle_num), format='json')
+        )
+    except ModelCallError:
+        raise
+    except Exception:
+        pass
+
+    intent = analyze_user_intent(input_text, cycle_num)
+    if not intent:
+        raise Exception("Failed to determine user intent")
+    return intent, generate_valid_prompt(input_text, intent, cycle_num)
+
+# Result field of each batched stage
+BATCH_FIELDS = {STAGE_INTENT: "intent", STAGE_PROMPT: "prompt"}
+
+def build_batch_prompt(stage: str, cycle_num: int, items: List[Tuple[str, Optional[str]]]) -> str:
+    """
+    Builds one JSON-format request for the intent or prompt stage of
+    several queries.
+    
+    :param stage: STAGE_INTENT or STAGE_PROMPT
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :param items: (user's text, intent) of each query; the intent is None for STAGE_INTENT
+    :return: Prompt text
+    """
+    depth, field = CYCLE_DEPTHS[cycle_num], BATCH_FIELDS[stage]
+    task = f"{depth} intent analysis" if stage == STAGE_INTENT else f"{depth} prompt generation"
+    entries = "\n".join(
+        f"        ### ITEM {number}\n        User text: {text}"
+        + (f"\n        Intent: {intent}" if intent is not None else "")
+        for number, (text, intent) in enumerate(items, 1)
+    )
+    return build_meta_instructions() + f"""Date: {get_current_date()}
+        
+        Task: {task} for each item below. Reply with a JSON object whose
+        "items" array holds one object per item, in order:
+        {{"id": <item number>, "{field}": "<{depth} {field}>"}}.
+        
+{entries}
+        
+        JSON:
+        """
+
+def parse_batch_output(text: str, field: str, count: int) -> List[Optional[str]]:
+    """
+    Reads the results of a batched call. Items missing from the output
+    or not matching {"id": int, field: non-empty string} are None.
+    
+    :param text: Raw model output
+    :param field: Result field ("intent" or "prompt")
+    :param count: Number of items in the batch
+    :return: Result per item, in item order
+    """
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return [None] * count
+    entries = data.get("items") if isinstance(data, dict) else data
+    results = [None] * count
+    for entry in entries if isinstance(entries, list) else []:
+        if not isinstance(entry, dict):
+            continue
+        number, value = entry.get("id"), entry.get(field)
+        if isinstance(number, int) and 1 <= number <= count and isinstance(value, str) and value.strip():
+            results[number - 1] = value.strip()
+    return results
+
+def get_batch_options(stage: str, cycle_num: int, size: int) -> Optional[Dict[str, Any]]:
+    """Returns the stage's generation options with num_predict raised for size items."""
+    options = get_stage_options(stage, cycle_num)
+    if not options or not options.get("num_predict") or options["num_predict"] < 0:
+        return options
+    return dict(options, num_predict=size * (options["num_predict"] + MICRO_BATCH_ITEM_TOKENS))
+
+def run_meta_batch(stage: str, cycle_num: int, items: List[Tuple[str, Optional[str]]]) -> List[Optional[str]]:
+    """
+    Runs the intent or prompt stage of several queries as one call.
+    
+    :param stage: STAGE_INTENT or STAGE_PROMPT
+    :param cycle_num: Cycle number (1, 2, or 3)
+    :param items: (user's text, intent) of each query
+    :return: Result per item; None where the batch gave none (the item
+        is then run on its own)
+    """
+    unique = list(dict.fromkeys(items))
+    if len(unique) < 2:
+        return [None] * len(items)
+    try:
+        text = generate_text(stage, cycle_num, build_batch_prompt(stage, cycle_num, unique), format='json',
+                             options=get_batch_options(stage, cycle_num, len(unique)))
+    except Exception:
+        return [None] * len(items)
+    results = dict(zip(unique, parse_batch_output(text, BATCH_FIELDS[stage], len(unique))))
+    _observe_batch_answers(stage, results)
+    return [results[item] for item in items]
+
+def _observe_batch_answers(stage: str, results: Dict[Any, Optional[str]]) -> None:
+    """Counts a batch by the items it answered; the others fall back to single calls."""
+    answered = sum(1 for result in results.values() if result)
+    if answered:
+        _metrics.observe_batch(stage, answered)
+
+def _batched_meta_call(stage: str, cycle_num: int, prompt: str, input_text: str,
+                       user_intent: str = None) -> Optional[str]:
+    """
+    Gets a stage result from a micro-batch (see enable_micro_batching).
+    
+    :param prompt: The prompt of the single call, whose cache entry the result fills
+    :return: The result, or None if the call is to be made on its own
+    """
+    batcher = _micro_batcher
+    if batcher is None:
+        return None
+    key = _cache_key(stage, cycle_num, get_stage_model(stage, cycle_num),
+                     get_stage_options(stage, cycle_num), prompt)
+    if _cache_has(key):
+        # The single call is answered from the cache (and counted there)
+        return None
+    text = batcher.do((stage, cycle_num), (input_text, user_intent),
+                      lambda items: run_meta_batch(stage, cycle_num, items))
+    if text:
+        _cache_put(key, text)
+    return text
+
+def calls_per_cycle() -> int:
+    """Returns the number of model calls one cycle makes."""
+    return 2 if FUSED_STAGES else 3
+
+class ResultRetention:
+    """
+    Bounds the memory held by finished results.
+    
+    The cycles of the keep_last most recent results stay as they are;
+    once a result falls out of that window its cycle texts are spilled
+    to the log or dropped, so memory stays flat however many results
+    the process (or its callers) keep around.
+    """
+
+    __slots__ = ("mode", "keep_last", "log", "_recent", "_lock")
+
+    def __init__(self, mode: str = "spill", keep_last: int = RESULT_KEEP_LAST,
+                 log_path: str = RESULT_LOG_PATH):
+        """
+        :param mode: "spill" (texts go to a gzip log) or "synthesis" (texts are dropped)
+        :param keep_last: Number of most recent results left untouched
+        :param log_path: Path to the spill log (mode "spill" only)
+        """
+        if mode not in RESULT_RETENTION_MODES:
+            raise Exception(f"Unknown retention mode: {mode}")
+        self.mode = mode
+        self.keep_last = max(0, keep_last)
+        self.log = ResultLog(log_path) if mode == "spill" else None
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def retain(self, result: PipelineResult) -> PipelineResult:
+        """Registers a finished result, compacting the ones it pushes out of the window."""
+        with self._lock:
+            self._recent.append(result.cycles)
+            expired = []
+            while len(self._recent) > self.keep_last:
+                expired.append(self._recent.popleft())
+        for cycles in expired:
+            self.compact(cycles)
+        return result
+
+    def compact(self, cycles: List[CycleResult]) -> None:
+        for cycle in cycles:
+            if not isinstance(cycle, CycleResult):
+                continue
+            if self.log is not None:
+                cycle.spill(self.log)
+            else:
+                cycle.drop()
+
+_result_retention = None
+
+def enable_result_retention(mode: str = "spill", keep_last: int = RESULT_KEEP_LAST,
+                            log_path: str = RESULT_LOG_PATH) -> ResultRetention:
+    """
+    Compacts finished results beyond the most recent ones.
+    
+    :param mode: "spill" (texts go to a gzip log) or "synthesis" (texts are dropped)
+    :param keep_last: Number of most recent results left untouched
+    :param log_path: Path to the spill log (mode "spill" only)
+    :return: The active policy
+    """
+    global _result_retention
+    _result_retention = ResultRetention(mode, keep_last, log_path)
+    return _result_retention
+
+def disable_result_retention() -> None:
+    """
+    Keeps finished results in memory as they are. Results spilled
+    earlier stay readable: their log is closed once they are gone.
+    """
+    global _result_retention
+    _result_retention = None
+
+def _retain_result(cycles: List[CycleResult], final_synthesis: str) -> PipelineResult:
+    """Wraps a finished result, registering it with the retention policy."""
+    result = PipelineResult(list(cycles), final_synthesis)
+    retention = _result_retention
+    return retention.retain(result) if retention is not None else result
+
+def failed_cycle(error: BaseException, intent: str = None, prompt: str = None) -> CycleResult:
+    """
+    Builds the result of a cycle that could not be completed.
+    
+    The "error" key marks the cycle as failed; synthesis skips it.
+    
+    :param error: Exception the cycle failed with
+    :param intent: Intent, if it was determined
+    :param prompt: Prompt, if it was generated
+    :return: Cycle result
+    """
+    return CycleResult(intent, prompt, error=str(error) or type(error).__name__)
+
+def is_failed_cycle(cycle: Mapping) -> bool:
+    return bool(cycle.get("error"))
+
+def check_cycles_succeeded(cycles: List[Dict[str, str]]) -> None:
+    """Raises an exception when no cycle produced a response to synthesize."""
+    if not any(not is_failed_cycle(cycle) for cycle in cycles):
+        errors = "; ".join(cycle.get("error", "") for cycle in cycles)
+        raise Exception(f"All cycles failed ({errors})" if errors else "No cycle results")
+
+def _prepare_single_cycle(user_input: str, cycle_num: int, progress: Dict[str, str],
+                          log) -> Tuple[str, str]:
+    """Runs the intent and prompt stages of a cycle; progress keeps what is ready."""
+    if FUSED_STAGES:
+        # Intent and prompt from a single structured call
+        log("Analyzing intent and generating prompt...")
+        intent, final_prompt = generate_intent_and_prompt(user_input, cycle_num)
+        log(f"Intent: {intent}")
+        log(f"Prompt: {final_prompt}")
+    else:
+        # Intent analysis considering cycle number
+        log("Analyzing intent...")
+        intent = analyze_user_intent(user_input, cycle_num)
+        if not intent:
+            raise Exception("Failed to determine user intent")
+        log(f"Intent: {intent}")
+        progress["intent"] = intent
+
+        # Prompt generation
+        log("Generating prompt...")
+        final_prompt = generate_valid_prompt(user_input, intent, cycle_num)
+        log(f"Prompt: {final_prompt}")
+    progress.update(intent=intent, prompt=final_prompt)
+    return intent, final_prompt
+
+def _respond_single_cycle(final_prompt: str, cycle_num: int, log) -> str:
+    """Runs the response stage of a cycle."""
+    log("Getting response...")
+    response = get_llm_response(final_prompt, cycle_num)
+    if not response:
+        raise Exception("Failed to get model response")
+    log(f"Response: {response}")
+    return response
+
+def process_single_cycle(user_input: str, cycle_num: int, verbose: bool = True) -> CycleResult:
+    """
+    Executes one complete request processing cycle.
+    
+    :param user_input: User's text
+    :param cycle_num: Cycle number
+    :param verbose: Print progress of each step
+    :return: Dictionary with cycle results (see failed_cycle if it failed)
+    """
+    log = print if verbose else (lambda *args: None)
+    log(f"\nCycle {cycle_num}:")
+
+    progress = {}
+    try:
+        intent, final_prompt = _prepare_single_cycle(user_input, cycle_num, progress, log)
+        response = _respond_single_cycle(final_prompt, cycle_num, log)
+    except Exception as e:
+        log(f"Cycle {cycle_num} failed: {e}")
+        return failed_cycle(e, progress.get("intent"), progress.get("prompt"))
+
+    return CycleResult(intent, final_prompt, response)
+
+def run_cycles_by_stage(user_input: str, verbose: bool = True) -> List[CycleResult]:
+    """
+    Executes the three cycles stage by stage: the intents and prompts of
+    all cycles first, then all responses. When the response stage uses
+    another model than the intent and prompt stages, the backend then
+    switches models once per query instead of once per cycle.
+    
+    :param user_input: User's text
+    :param verbose: Print progress of each step
+    :return: List of cycle results ordered by cycle number
+    """
+    log = print if verbose else (lambda *args: None)
+    cycles = {}
+    for cycle_num in (1, 2, 3):
+        log(f"\nCycle {cycle_num}:")
+        progress = {}
+        try:
+            _prepare_single_cycle(user_input, cycle_num, progress, log)
+        except Exception as e:
+            log(f"Cycle {cycle_num} failed: {e}")
+            progress = failed_cycle(e, progress.get("intent"), progress.get("prompt"))
+        cycles[cycle_num] = progress
+
+    for cycle_num, progress in cycles.items():
+        if is_failed_cycle(progress):
+            continue
+        log(f"\nCycle {cycle_num}:")
+        try:
+            response = _respond_single_cycle(progress["prompt"], cycle_num, log)
+        except Exception as e:
+            log(f"Cycle {cycle_num} failed: {e}")
+            cycles[cycle_num] = failed_cycle(e, progress["intent"], progress["prompt"])
+            continue
+        cycles[cycle_num] = CycleResult(progress["intent"], progress["prompt"], response)
+    return [cycles[cycle_num] for cycle_num in (1, 2, 3)]
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the token count of a text without a model tokenizer:
+    one token per punctuation mark and per started 4 characters of a word.
+    """
+    return sum(
+        (len(piece) + 3) // 4 if piece[0].isalnum() or piece[0] == "_" else 1
+        for piece in re.findall(r"\w+|[^\w\s]", text)
+    )
+
+def split_sentences(text: str) -> List[Tuple[int, str]]:
+    """
+    Splits a response into sentences, keeping the line each came from
+    so that markdown lists and headings can be rebuilt.
+    
+    :return: List of (line index, sentence)
+    """
+    units = []
+    for line_num, line in enumerate(text.splitlines()):
+        for sentence in re.split(r"(?<=[.!?])\s+", line.strip()):
+            if sentence:
+                units.append((line_num, sentence))
+    return units
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set:
+    """Returns the set of word n-grams of a text (the words themselves for short texts)."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def compress_cycle_responses(cycles: List[Dict[str, str]], original_query: str,
+                             token_budget: int = None) -> List[Dict[str, str]]:
+    """
+    Bounds the synthesis input: drops sentences repeated across (or
+    within) the cycle responses, ranks the rest and keeps the best ones
+    that fit the token budget, in their original order.
+    
+    Sentences are ranked by the mean TF-IDF weight of their content
+    words (term frequency over all responses, sentences as documents),
+    boosted by words of the query and by how early they appear in
+    their response. Responses already within the budget pass unchanged.
+    
+    :param cycles: List of dictionaries with results from each cycle
+    :param original_query: Original user query
+    :param token_budget: Token budget of all responses together
+        (defaults to SYNTHESIS_TOKEN_BUDGET)
+    :return: Copies of the cycles with compressed responses
+    """
+    token_budget = SYNTHESIS_TOKEN_BUDGET if token_budget is None else token_budget
+    if not token_budget or not cycles:
+        return cycles
+    if sum(estimate_tokens(cycle['response']) for cycle in cycles) <= token_budget:
+        return cycles
+
+    # Deduplicate in reading order, so the first occurrence survives.
+    # Only kept sentences sharing a shingle with the new one are compared.
+    units, kept_shingles, shingle_index = [], [], {}
+    for cycle_index, cycle in enumerate(cycles):
+        sentences = split_sentences(cycle['response'])
+        for position, (line_num, sentence) in enumerate(sentences):
+            sentence_shingles = shingles(sentence)
+            if not sentence_shingles:
+                continue
+            overlaps = {}
+            for shingle in sentence_shingles:
+                for other in shingle_index.get(shingle, ()):
+                    overlaps[other] = overlaps.get(other, 0) + 1
+            if any(common / (len(sentence_shingles) + len(kept_shingles[other]) - common)
+                   >= SYNTHESIS_DEDUP_THRESHOLD for other, common in overlaps.items()):
+                continue
+            for shingle in sentence_shingles:
+                shingle_index.setdefault(shingle, []).append(len(kept_shingles))
+            kept_shingles.append(sentence_shingles)
+            words = re.findall(r"\w+", sentence.lower())
+            units.append({
+                "cycle": cycle_index, "line": line_num, "text": sentence, "words": words,
+                "position": position / len(sentences), "tokens": estimate_tokens(sentence)
+            })
+
+    term_counts, sentence_counts = {}, {}
+    for cycle in cycles:
+        for word in re.findall(r"\w+", cycle['response'].lower()):
+            term_counts[word] = term_counts.get(word, 0) + 1
+    for unit in units:
+        for word in set(unit["words"]):
+            sentence_counts[word] = sentence_counts.get(word, 0) + 1
+    query_terms = set(re.findall(r"\w+", original_query.lower()))
+
+    def score(unit: Dict[str, Any]) -> float:
+        words = unit["words"]
+        if not words:
+            return 0.0
+        tf_idf = sum(
+            math.log(1 + term_counts[word]) * math.log(1 + len(units) / sentence_counts[word])
+            for word in words if len(word) > 3 or word.isdigit()
+        ) / len(words)
+        query_bonus = len(query_terms.intersection(words)) / (len(query_terms) or 1)
+        return tf_idf + query_bonus + (1.0 - unit["position"]) * 0.5
+
+    selected, used = set(), 0
+    for index in sorted(range(len(units)), key=lambda i: -score(units[i])):
+        if used + units[index]["tokens"] <= token_budget:
+            selected.add(index)
+            used += units[index]["tokens"]
+
+    compressed = []
+    for cycle_index, cycle in enumerate(cycles):
+        lines, current_line = [], None
+        for index, unit in enumerate(units):
+            if index not in selected or unit["cycle"] != cycle_index:
+                continue
+            if unit["line"] == current_line:
+                lines[-1] += " " + unit["text"]
+            else:
+                lines.append(unit["text"])
+                current_line = unit["line"]
+        compressed.append(dict(cycle, response="\n".join(lines)))
+    return compressed
+
+def build_synthesis_prompt(cycles: List[Dict[str, str]], original_query: str) -> str:
+    """
+    Builds the final synthesis prompt from the cycle responses,
+    compressed to the synthesis token budget.
+    
+    :param cycles: List of dictionaries with results from each cycle
+        (a prefix of the three cycles is accepted; failed cycles are skipped)
+    :param original_query: Original user query
+    :return: Prompt text
+    """
+    labels = ["Basic answer", "Detailed answer", "Complete analysis"]
+    labeled = [(label, cycle) for label, cycle in zip(labels, cycles) if not is_failed_cycle(cycle)]
+    compressed = compress_cycle_responses([cycle for _, cycle in labeled], original_query)
+    sources = "".join(
+        f"""
+    {label}:
+    {cycle['response']}
+    ---"""
+        for (label, _), cycle in zip(labeled, compressed)
+    )
+    return f"""
+    Based on the provided information, create a complete but well-structured response 
+    to the user's question: "{original_query}"
+
+    Answer creation rules:
+    1. Start with a brief, direct answer to the question (main figures/facts)
+    2. Structure information by sections:
+       - Basic information
+       - Chronology and evolution
+         * Early period
+         * Development period
+         * Modern stage
+       - Significant works and achievements
+       - Impact and significance
+       - Interesting facts and details
+    3. Provide detailed information in each section
+    4. Use subheadings for better navigation
+    5. Include all significant aspects from provided sources
+    
+    Information from sources:
+    ---{sources}
+
+    Answer requirements:
+    - Use markdown formatting for better readability
+    - Preserve all important information from sources
+    - Organize information logically
+    - Use lists and subheadings
+    - Highlight key points
+    
+    Don't mention the analysis process or information sources - 
+    just provide a complete, well-organized answer.
+    """
+
+def synthesize_final_answer(cycles: List[Dict[str, str]], original_query: str) -> str:
+    """
+    Creates final synthesized answer based on three cycles.
+    
+    :param cycles: List of dictionaries with results from each cycle
+        (only the successful ones are used)
+    :param original_query: Original user query
+    :return: Synthesized answer
+    """
+    try:
+        check_cycles_succeeded(cycles)
+        return generate_text(STAGE_SYNTHESIS, 0, build_synthesis_prompt(cycles, original_query))
+    except Exception as e:
+        return f"Error synthesizing final answer: {str(e)}"
+
+def stream_final_answer(cycles: List[Dict[str, str]], original_query: str) -> Iterator[str]:
+    """
+    Streaming variant of synthesize_final_answer.
+    
+    :param cycles: List of dictionaries with results from each cycle
+    :param original_query: Original user query
+    :return: Iterator over answer chunks as the model produces them
+    """
+    try:
+        check_cycles_succeeded(cycles)
+        yield from stream_text(STAGE_SYNTHESIS, 0, build_synthesis_prompt(cycles, original_query))
+    except Exception as e:
+        yield f"Error synthesizing final answer: {str(e)}"
+
+def run_cycles(user_input: str, max_concurrency: int = None, verbose: bool = True) -> List[CycleResult]:
+    """
+    Executes the three independent cycles, optionally in parallel.
+    
+    :param user_input: User's text
+    :param max_concurrency: Maximum number of cycles running at once
+        (defaults to MAX_CONCURRENT_CYCLES)
+    :param verbose: Print progress of sequentially executed cycles
+    :return: List of cycle results ordered by cycle number
+    """
+    cycle_nums = [1, 2, 3]
+    limit = max(1, min(max_concurrency or MAX_CONCURRENT_CYCLES, len(cycle_nums)))
+
+    if limit == 1:
+        residency = _residency
+        if residency is not None and stages_swap_models():
+            return run_cycles_by_stage(user_input, verbose)
+        return [process_single_cycle(user_input, n, verbose) for n in cycle_nums]
+
+    # Step-by-step progress would interleave, so cycles run quietly
+    # and the pool map keeps results in cycle order
+    with ThreadPoolExecutor(max_workers=limit) as executor:
+        return list(executor.map(
+            _bind_context(lambda n: process_single_cycle(user_input, n, verbose=False)),
+            cycle_nums
+        ))
+
+class StageTask:
+    """One model stage in a query graph."""
+
+    __slots__ = ("name", "stage", "model", "fn", "deps", "dependents", "waiting",
+                 "rank", "result", "run")
+
+    def __init__(self, name: str, stage: str, fn, deps: List["StageTask"] = (),
+                 model: str = None):
+        """
+        :param name: Task name, unique within the graph (e.g. "prompt_2")
+        :param stage: Pipeline stage (STAGE_* constant), selects the cost
+        :param fn: Callable receiving the results of deps as positional arguments
+        :param deps: Tasks that must finish first
+        :param model: Model the task calls (see StageScheduler._pop)
+        """
+        self.name = name
+        self.stage = stage
+        self.model = model
+        self.fn = fn
+        self.deps = list(deps)
+        self.dependents = []
+        self.waiting = len(self.deps)
+        self.rank = 0
+        self.result = None
+        self.run = None
+        for dep in self.deps:
+            dep.dependents.append(self)
+
+class _GraphRun:
+    """Bookkeeping of one submitted graph."""
+
+    __slots__ = ("future", "sink", "arrival", "critical_path", "priority", "failed")
+
+    def __init__(self, sink: StageTask, critical_path: int):
+        self.future = Future()
+        self.sink = sink
+        self.arrival = time.monotonic()
+        self.critical_path = critical_path
+        self.priority = PRIORITY_CLASSES.index(current_priority()[0])
+        self.failed = False
+
+class StageScheduler:
+    """
+    Runs query graphs of stage tasks on a shared pool of model workers.
+    
+    Any task whose dependencies are done is ready. Ready tasks are
+    dispatched by priority class (see call_priority), then by earliest
+    latest-start time: the query's arrival plus the slack left on its
+    critical path. Within a query, critical-path
+    work goes first. Across queries, older queries win unless a newer
+    one has much more work left. Several queries can then share one
+    backend while it is kept saturated.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS):
+        """
+        :param workers: Number of model calls executed at once
+        """
+        self._ready = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"deepchain-stage-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, tasks: List[StageTask]) -> Future:
+        """
+        Schedules a task graph.
+        
+        :param tasks: All tasks of the graph; exactly one has no dependents
+        :return: Future resolved with the result of the final task
+        """
+        sinks = [task for task in tasks if not task.dependents]
+        if len(sinks) != 1:
+            raise Exception("Task graph must have exactly one final task")
+
+        # Rank = cost of the longest path from the task to the end of the graph
+        for task in reversed(_topological_order(tasks)):
+            task.rank = STAGE_COSTS.get(task.stage, 1) + max(
+                (dependent.rank for dependent in task.dependents), default=0
+            )
+
+        run = _GraphRun(sinks[0], max(task.rank for task in tasks))
+        with self._cond:
+            if self._closed:
+                raise Exception("Scheduler is shut down")
+            for task in tasks:
+                # Workers see the submitter's context (e.g. its request trace)
+                task.fn = _bind_context(task.fn)
+                task.run = run
+                if task.waiting == 0:
+                    self._push(task)
+        return run.future
+
+    def run_query(self, user_input: str) -> Future:
+        """
+        Schedules the full pipeline for one query.
+        
+        :param user_input: User's text
+        :return: Future resolved with (cycles, final_synthesis)
+        """
+        return self.submit(build_query_graph(user_input))
+
+    def shutdown(self) -> None:
+        """
+        Stops the workers after the tasks already running. Queries with
+        tasks left fail, so that no caller waits on them forever.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        # Every unfinished query has a ready task: running ones pushed theirs
+        with self._cond:
+            pending, self._ready = self._ready, []
+        for _, _, _, task in pending:
+            run = task.run
+            if not run.future.done():
+                run.failed = True
+                run.future.set_exception(Exception("Scheduler is shut down"))
+
+    def _push(self, task: StageTask) -> None:
+        run = task.run
+        slack = (run.critical_path - task.rank) * SCHEDULER_COST_UNIT_SECONDS
+        self._seq += 1
+        heapq.heappush(self._ready, (run.priority, run.arrival + slack, self._seq, task))
+        self._cond.notify()
+
+    def _pop(self) -> StageTask:
+        """
+        Takes the most urgent ready task. With a residency manager, a task
+        of a loaded model goes before a more urgent task of a model that
+        is not loaded if it is of the same priority class and due at most
+        RESIDENCY_REORDER_SECONDS later.
+        """
+        residency = _residency
+        first_priority, first_start, _, first = self._ready[0]
+        if residency is not None and first.model and not residency.is_resident(first.model):
+            warm = [
+                index for index, (priority, start, _, task) in enumerate(self._ready)
+                if priority == first_priority and start <= first_start + RESIDENCY_REORDER_SECONDS
+                and task.model and residency.is_resident(task.model)
+            ]
+            if warm:
+                index = min(warm, key=lambda i: self._ready[i][:3])
+                task = self._ready[index][3]
+                self._ready[index] = self._ready[-1]
+                self._ready.pop()
+                heapq.heapify(self._ready)
+                return task
+        return heapq.heappop(self._ready)[3]
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                task = self._pop()
+            run = task.run
+            if run.failed:
+                continue
+
+            try:
+                task.result = task.fn(*(dep.result for dep in task.deps))
+            except Exception as e:
+                run.failed = True
+                run.future.set_exception(e)
+                continue
+
+            if task is run.sink:
+                run.future.set_result(task.result)
+                continue
+            with self._cond:
+                for dependent in task.dependents:
+                    dependent.waiting -= 1
+                    if dependent.waiting == 0:
+                        self._push(dependent)
+
+def _topological_order(tasks: List[StageTask]) -> List[StageTask]:
+    """Orders tasks so that every task follows its dependencies."""
+    order, seen = [], set()
+
+    def visit(task: StageTask) -> None:
+        if id(task) in seen:
+            return
+        seen.add(id(task))
+        for dep in task.deps:
+            visit(dep)
+        order.append(task)
+
+    for task in tasks:
+        visit(task)
+    return order
+
+def build_query_graph(user_input: str) -> List[StageTask]:
+    """
+    Expresses the pipeline of one query as a task graph:
+    intent_k -> prompt_k -> response_k for k = 1..3, all -> synthesis.
+    In fused stage mode intent_k and prompt_k are one intent_prompt_k task.
+    
+    :param user_input: User's text
+    :return: List of tasks; the synthesis task yields (cycles, final_synthesis)
+    """
+    # A failing stage turns its cycle into a failed_cycle, which the
+    # later stages of the cycle pass through to synthesis
+    def intent_fn(cycle_num: int):
+        def run() -> Dict[str, str]:
+            try:
+                intent = analyze_user_intent(user_input, cycle_num)
+                if not intent:
+                    raise Exception("Failed to determine user intent")
+            except Exception as e:
+                return failed_cycle(e)
+            return {"intent": intent}
+        return run
+
+    def prompt_fn(cycle_num: int):
+        def run(cycle: Dict[str, str]) -> Dict[str, str]:
+            if is_failed_cycle(cycle):
+                return cycle
+            try:
+                return dict(cycle, prompt=generate_valid_prompt(user_input, cycle["intent"], cycle_num))
+            except Exception as e:
+                return failed_cycle(e, cycle["intent"])
+        return run
+
+    def fused_fn(cycle_num: int):
+        def run() -> Dict[str, str]:
+            try:
+                intent, prompt = generate_intent_and_prompt(user_input, cycle_num)
+            except Exception as e:
+                return failed_cycle(e)
+            return {"intent": intent, "prompt": prompt}
+        return run
+
+    def response_fn(cycle_num: int):
+        def run(cycle: Dict[str, str]) -> Dict[str, str]:
+            if is_failed_cycle(cycle):
+                return cycle
+            try:
+                response = get_llm_response(cycle["prompt"], cycle_num)
+                if not response:
+                    raise Exception("Failed to get model response")
+            except Exception as e:
+                return failed_cycle(e, cycle["intent"], cycle["prompt"])
+            return CycleResult(cycle["intent"], cycle["prompt"], response)
+        return run
+
+    def synthesis_fn(*cycles: Dict[str, str]) -> Tuple[List[Dict[str, str]], str]:
+        cycles = list(cycles)
+        return cycles, synthesize_final_answer(cycles, user_input)
+
+    tasks, responses = [], []
+    for cycle_num in (1, 2, 3):
+        if FUSED_STAGES:
+            prompt = StageTask(f"intent_prompt_{cycle_num}", STAGE_FUSED, fused_fn(cycle_num),
+                               model=get_stage_model(STAGE_FUSED, cycle_num))
+            tasks.append(prompt)
+        else:
+            intent = StageTask(f"intent_{cycle_num}", STAGE_INTENT, intent_fn(cycle_num),
+                               model=get_stage_model(STAGE_INTENT, cycle_num))
+            prompt = StageTask(f"prompt_{cycle_num}", STAGE_PROMPT, prompt_fn(cycle_num), [intent],
+                               model=get_stage_model(STAGE_PROMPT, cycle_num))
+            tasks += [intent, prompt]
+        response = StageTask(f"response_{cycle_num}", STAGE_RESPONSE, response_fn(cycle_num), [prompt],
+                             model=get_stage_model(STAGE_RESPONSE, cycle_num))
+        tasks.append(response)
+        responses.append(response)
+    tasks.append(StageTask("synthesis", STAGE_SYNTHESIS, synthesis_fn, responses,
+                           model=get_stage_model(STAGE_SYNTHESIS)))
+    return tasks
+
+_scheduler = None
+
+def enable_scheduler(workers: int = SCHEDULER_WORKERS) -> StageScheduler:
+    """
+    Routes process_user_input through a shared StageScheduler.
+    
+    :param workers: Number of model calls executed at once
+    :return: The active scheduler
+    """
+    global _scheduler
+    disable_scheduler()
+    _scheduler = StageScheduler(workers)
+    return _scheduler
+
+def disable_scheduler() -> None:
+    """Stops the shared scheduler; queries run their cycles directly again."""
+    global _scheduler
+    if _scheduler is not None:
+        _scheduler.shutdown()
+        _scheduler = None
+
+class AdaptivePolicy:
+    """Budget and stopping rules for adaptive refinement."""
+
+    __slots__ = ("max_calls", "max_ms", "agreement_threshold", "self_rating", "rating_threshold")
+
+    def __init__(self, max_calls: int = None, max_ms: float = None,
+                 agreement_threshold: float = ADAPTIVE_AGREEMENT_THRESHOLD,
+                 self_rating: bool = False, rating_threshold: int = ADAPTIVE_RATING_THRESHOLD):
+        """
+        :param max_calls: Maximum model calls per query (None for no limit)
+        :param max_ms: Maximum wall time per query in milliseconds (None for no limit)
+        :param agreement_threshold: Cycle 1/2 overlap that skips cycle 3 and synthesis
+        :param self_rating: Ask the model to rate the cycle 1 answer before going deeper
+        :param rating_threshold: Rating (1-10) that accepts the cycle 1 answer
+        """
+        self.max_calls = max_calls
+        self.max_ms = max_ms
+        self.agreement_threshold = agreement_threshold
+        self.self_rating = self_rating
+        self.rating_threshold = rating_threshold
+
+def answer_agreement(first: str, second: str) -> float:
+    """
+    Estimates how much two answers agree as the Jaccard overlap of
+    their content words (4+ letters) and numbers.
+    
+    :return: Overlap between 0 and 1
+    """
+    def terms(text: str) -> set:
+        return {w for w in re.findall(r"\w+", text.lower()) if len(w) > 3 or w.isdigit()}
+
+    a, b = terms(first), terms(second)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def rate_answer(original_query: str, answer: str) -> int:
+    """
+    Asks the model for a short 1-10 rating of how well an answer
+    addresses the query.
+    
+    :return: Rating, or 0 when it could not be obtained
+    """
+    rating_prompt = f"""
+    Rate from 1 to 10 how completely and correctly the answer addresses the question.
+    Reply with the number only.
+
+    Question: {original_query}
+    Answer: {answer}
+    Rating:
+    """
+    try:
+        match = re.search(r"\d+", generate_text(STAGE_RATING, 1, rating_prompt))
+        return min(int(match.group()), 10) if match else 0
+    except Exception:
+        return 0
+
+def refine_adaptively(user_input: str, policy: AdaptivePolicy,
+                      verbose: bool = True) -> Tuple[List[Dict[str, str]], str]:
+    """
+    Runs only as many cycles as the query needs.
+    
+    Cycle 1 always runs. The optional self-rating can accept its answer
+    right away. Otherwise cycle 2 runs, and if cycles 1 and 2 agree, the
+    cycle 2 answer is returned without cycle 3 or synthesis. The budget
+    stops refinement whenever the next step would exceed the allowed
+    model calls or time; the most detailed answer so far is returned then.
+    
+    :param user_input: User's text
+    :param policy: Budget and stopping rules
+    :param verbose: Print progress and the stopping reason
+    :return: Tuple[list of cycle results, final answer]
+    """
+    log = print if verbose else (lambda *args: None)
+    started = time.monotonic()
+    calls = 0
+    cycles = []
+
+    def affordable(step_calls: int, step_ms: float) -> bool:
+        if policy.max_calls is not None and calls + step_calls > policy.max_calls:
+            return False
+        elapsed_ms = (time.monotonic() - started) * 1000
+        return policy.max_ms is None or elapsed_ms + step_ms <= policy.max_ms
+
+    def run_cycle(cycle_num: int) -> None:
+        nonlocal calls
+        cycles.append(process_single_cycle(user_input, cycle_num, verbose))
+        calls += calls_per_cycle()
+
+    def cycle_ms() -> float:
+        # Time of one more cycle, estimated from the cycles done so far
+        return (time.monotonic() - started) * 1000 / max(len(cycles), 1)
+
+    def best_answer(reason: str) -> Tuple[List[Dict[str, str]], str]:
+        log(f"\nStopping after {len(cycles)} cycle(s), {calls} model calls: {reason}")
+        answers = [cycle['response'] for cycle in cycles if not is_failed_cycle(cycle)]
+        if not answers:
+            return cycles, "Error synthesizing final answer: all cycles failed"
+        return cycles, answers[-1]
+
+    run_cycle(1)
+
+    if policy.self_rating and not is_failed_cycle(cycles[0]) and affordable(1, 0):
+        rating = rate_answer(user_input, cycles[0]['response'])
+        calls += 1
+        if rating >= policy.rating_threshold:
+            return best_answer(f"self-rating {rating}/10")
+
+    if not affordable(calls_per_cycle(), cycle_ms()):
+        return best_answer("budget exhausted")
+    run_cycle(2)
+
+    if is_failed_cycle(cycles[0]) or is_failed_cycle(cycles[1]):
+        # A failed cycle cannot agree; go on to cycle 3 and synthesis
+        agreement = 0.0
+    else:
+        agreement = answer_agreement(cycles[0]['response'], cycles[1]['response'])
+    if agreement >= policy.agreement_threshold:
+        return best_answer(f"cycles 1 and 2 agree ({agreement:.2f})")
+
+    if affordable(calls_per_cycle(), cycle_ms()):
+        run_cycle(3)
+
+    if not affordable(1, cycle_ms()):
+        return best_answer("budget exhausted")
+    calls += 1
+    log(f"\nSynthesizing {len(cycles)} cycles, {calls} model calls")
+    return cycles, synthesize_final_answer(cycles, user_input)
+
+_adaptive_policy = None
+
+def enable_adaptive_refinement(**kwargs) -> AdaptivePolicy:
+    """
+    Makes process_user_input refine adaptively.
+    
+    :param kwargs: AdaptivePolicy arguments
+    :return: The active policy
+    """
+    global _adaptive_policy
+    _adaptive_policy = AdaptivePolicy(**kwargs)
+    return _adaptive_policy
+
+def disable_adaptive_refinement() -> None:
+    """Restores the full three-cycle pipeline."""
+    global _adaptive_policy
+    _adaptive_policy = None
+
+def process_user_input(user_input: str, max_concurrency: int = None,
+                       verbose: bool = True) -> PipelineResult:
+    """
+    Processes user input with three responses and final synthesis.
+    
+    :param user_input: User's text
+    :param max_concurrency: Maximum number of cycles running at once
+        (ignored with the stage scheduler or adaptive refinement enabled)
+    :param verbose: Print progress of sequentially executed cycles
+        (an identical query already in flight is waited for silently)
+    :return: PipelineResult (unpacks as cycle results, synthesized answer)
+    """
+    if not user_input:
+        return PipelineResult([], "Please enter text for prompt creation.")
+
+    with trace_request(user_input) as trace:
+        if not COALESCE_CALLS:
+            return _answer_user_input(user_input, max_concurrency, verbose)
+
+        # Identical queries in flight share one pipeline run
+        result, shared = _query_flight.do(
+            (current_priority()[0], normalize_query(user_input)),
+            lambda: _answer_user_input(user_input, max_concurrency, verbose)
+        )
+        if shared:
+            # Cycle results are read-only; only the list is per caller
+            trace.coalesced = True
+            result = PipelineResult(list(result.cycles), result.synthesis)
+        return result
+
+def _answer_user_input(user_input: str, max_concurrency: int = None,
+                       verbose: bool = True) -> PipelineResult:
+    """Runs the pipeline of process_user_input for one query."""
+    # Answer paraphrases of already processed queries from the semantic cache
+    semantic_cache, query_vector = _semantic_cache, None
+    if semantic_cache is not None:
+        query_vector = semantic_cache.embed(user_input)
+        cached = semantic_cache.search(query_vector)
+        if cached is not None:
+            return _retain_result(*cached)
+
+    scheduler, policy = _scheduler, _adaptive_policy
+    if policy is not None:
+        # Cycles depend on each other's outcome, so they run one by one
+        cycles, final_synthesis = refine_adaptively(user_input, policy, verbose)
+    elif scheduler is not None:
+        # Stages of all in-flight queries share the scheduler's workers
+        cycles, final_synthesis = scheduler.run_query(user_input).result()
+    else:
+        # Execute three independent cycles
+        cycles = run_cycles(user_input, max_concurrency, verbose)
+
+        # Create final synthesis
+        final_synthesis = synthesize_final_answer(cycles, user_input)
+
+    if semantic_cache is not None and _is_complete_result(cycles, final_synthesis):
+        semantic_cache.add(query_vector, user_input, cycles, final_synthesis)
+
+    return _retain_result(cycles, final_synthesis)
+
+def _stream_cycle(user_input: str, cycle_num: int, emit) -> CycleResult:
+    """
+    Runs one cycle, reporting progress through emit(PipelineEvent).
+    A failure is reported as EVENT_CYCLE_FAILED and returned as a failed_cycle.
+    """
+    emit(PipelineEvent(EVENT_CYCLE_STARTED, cycle_num))
+
+    intent = final_prompt = None
+    try:
+        if FUSED_STAGES:
+            intent, final_prompt = generate_intent_and_prompt(user_input, cycle_num)
+            emit(PipelineEvent(EVENT_INTENT_READY, cycle_num, intent))
+        else:
+            intent = analyze_user_intent(user_input, cycle_num)
+            if not intent:
+                raise Exception("Failed to determine user intent")
+            emit(PipelineEvent(EVENT_INTENT_READY, cycle_num, intent))
+            final_prompt = generate_valid_prompt(user_input, intent, cycle_num)
+        emit(PipelineEvent(EVENT_PROMPT_READY, cycle_num, final_prompt))
+
+        chunks = []
+        for chunk in stream_llm_response(final_prompt, cycle_num):
+            chunks.append(chunk)
+            emit(PipelineEvent(EVENT_RESPONSE_TOKEN, cycle_num, chunk))
+        response = "".join(chunks).strip()
+        if not response:
+            raise Exception("Failed to get model response")
+    except Exception as e:
+        cycle = failed_cycle(e, intent, final_prompt)
+        emit(PipelineEvent(EVENT_CYCLE_FAILED, cycle_num, cycle["error"]))
+        return cycle
+    emit(PipelineEvent(EVENT_RESPONSE_READY, cycle_num, response))
+
+    return CycleResult(intent, final_prompt, response)
+
+def _replay_result(cycles: List[Dict[str, str]], final_synthesis: str) -> Iterator[PipelineEvent]:
+    """Emits the events of an already computed result."""
+    for cycle_num, cycle in enumerate(cycles, 1):
+        yield PipelineEvent(EVENT_CYCLE_STARTED, cycle_num)
+        if is_failed_cycle(cycle):
+            yield PipelineEvent(EVENT_CYCLE_FAILED, cycle_num, cycle['error'])
+            continue
+        yield PipelineEvent(EVENT_INTENT_READY, cycle_num, cycle['intent'])
+        yield PipelineEvent(EVENT_PROMPT_READY, cycle_num, cycle['prompt'])
+        yield PipelineEvent(EVENT_RESPONSE_TOKEN, cycle_num, cycle['response'])
+        yield PipelineEvent(EVENT_RESPONSE_READY, cycle_num, cycle['response'])
+    yield PipelineEvent(EVENT_SYNTHESIS_STARTED)
+    yield PipelineEvent(EVENT_SYNTHESIS_TOKEN, data=final_synthesis)
+    yield PipelineEvent(EVENT_DONE, data=_retain_result(cycles, final_synthesis))
+
+def stream_user_input(user_input: str, max_concurrency: int = None) -> Iterator[PipelineEvent]:
     """
-    Analyzes user intent based on input text.
-    Different approaches for different cycles.
+    Streaming variant of process_user_input.
     
-    :param input_text: User's text
-    :param cycle_num: Cycle number (1, 2, or 3)
-    :return: String with user intent
-    """
-    prompts = {
-        1: f"""
-        Analyze the user's text and determine their main intent.
-        Focus on the basic goal of the request.
-        
-        Main steps:
-        1. Find key words
-        2. Determine request type (informational, analytical, creative)
-        3. Determine main topic
-        4. Formulate goal in one sentence
-        
-        Don't repeat the request text, create a new intent formulation.
-        
-        User text: {input_text}
-        Intent:
-        """,
-        
-        2: f"""
-        Consider the following user text from an expert's perspective
-        and determine the deeper intent of the request.
-        
-        In analysis consider:
-        1. Request context
-        2. Possible implicit goals
-        3. Expected response format
-        4. Level of detail
-        5. Potential related interests
-        
-        Formulate intent differently than in the explicit request.
-        
-        User text: {input_text}
-        Deep intent:
-        """,
-        
-        3: f"""
-        Conduct a comprehensive analysis of the user's request.
-        Determine the broadest possible context of the request.
-        
-        Consider:
-        1. Explicit and implicit goals
-        2. Possible request prerequisites
-        3. Related topics
-        4. Potential follow-up questions
-        5. Practical application of information
-        
-        Provide an expanded interpretation of user intent.
-        
-        User text: {input_text}
-        Expanded intent:
-        """
-    }
+    Cycles run on a worker pool (bounded by max_concurrency) and their
+    events are yielded as soon as they happen; with several cycles in
+    flight, response tokens of different cycles interleave and are told
+    apart by PipelineEvent.cycle. The final event is EVENT_DONE carrying
+    (cycles, final_synthesis).
     
+    :param user_input: User's text
+    :param max_concurrency: Maximum number of cycles running at once
+    :return: Iterator of PipelineEvent
+    """
+    if not user_input:
+        yield PipelineEvent(EVENT_DONE, data=PipelineResult([], "Please enter text for prompt creation."))
+        return
+
+    semantic_cache, query_vector = _semantic_cache, None
+    if semantic_cache is not None:
+        query_vector = semantic_cache.embed(user_input)
+        cached = semantic_cache.search(query_vector)
+        if cached is not None:
+            yield from _replay_result(*cached)
+            return
+
+    # Model calls happen in worker threads and while this generator is
+    # resumed; both run in a private context holding the request trace
+    parent_trace = _current_trace.get()
+    trace = parent_trace or RequestTrace(user_input)
+    context = contextvars.copy_context()
+    context.run(_current_trace.set, trace)
+
+    # The trace is finished even when the consumer stops early or a step fails
     try:
-        intent_response = ollama.generate(
-            model='gemma2:9b', 
-            prompt=prompts[cycle_num]
-        )
-        return intent_response['response'].strip()
-    except Exception:
-        return None
+        cycle_nums = [1, 2, 3]
+        limit = max(1, min(max_concurrency or MAX_CONCURRENT_CYCLES, len(cycle_nums)))
+        events = queue.Queue()
+
+        executor = ThreadPoolExecutor(max_workers=limit)
+        futures = [
+            executor.submit(context.copy().run, _stream_cycle, user_input, n, events.put)
+            for n in cycle_nums
+        ]
+        try:
+            while not (all(f.done() for f in futures) and events.empty()):
+                try:
+                    yield events.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+            # Failed cycles come back marked, see failed_cycle
+            cycles = [f.result() for f in futures]
+        finally:
+            # A consumer that stops early does not wait for the cycles: those
+            # not started are dropped, running ones finish in the background
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
 
-def generate_llm_prompt(input_text: str, user_intent: str, cycle_num: int) -> str:
+        yield PipelineEvent(EVENT_SYNTHESIS_STARTED)
+        chunks = []
+        synthesis_chunks = stream_final_answer(cycles, user_input)
+        while True:
+            chunk = context.run(next, synthesis_chunks, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            yield PipelineEvent(EVENT_SYNTHESIS_TOKEN, data=chunk)
+        final_synthesis = "".join(chunks).strip()
+
+        if semantic_cache is not None and _is_complete_result(cycles, final_synthesis):
+            semantic_cache.add(query_vector, user_input, cycles, final_synthesis)
+    finally:
+        if parent_trace is None:
+            _finish_trace(trace)
+
+    yield PipelineEvent(EVENT_DONE, data=_retain_result(cycles, final_synthesis))
+
+def follow_up_cycles(question: str) -> List[int]:
     """
-    Generates an effective prompt for LLM.
-    Different generation approaches for different cycles.
-    
-    :param input_text: User's text
-    :param user_intent: User's intent
-    :param cycle_num: Cycle number (1, 2, or 3)
-    :return: Generated prompt
+    Picks the cycles a follow-up question needs: the deep cycle when it
+    asks for explanations or detail, the basic one otherwise.
+    """
+    words = set(re.findall(r"\w+", question.lower()))
+    return [2] if words.intersection(FOLLOW_UP_DETAIL_WORDS) else [1]
+
+def _content_terms(text: str) -> set:
+    """Returns the words of a text that carry meaning (no stopwords or question words)."""
+    return {w for w in re.findall(r"\w+", text.lower())
+            if w not in FOLLOW_UP_STOPWORDS and (len(w) > 2 or w.isdigit())}
+
+def _compress_texts(texts: List[str], query: str, token_budget: int) -> List[str]:
+    """Cuts texts to a joint token budget (see compress_cycle_responses)."""
+    compressed = compress_cycle_responses([{"response": text} for text in texts], query, token_budget)
+    return [item["response"] for item in compressed]
+
+class Session:
     """
-    current_date = datetime.now()
+    Conversation with the pipeline.
     
-    templates = {
-        1: f"""
-        Create a basic prompt to get a direct answer to the user's request.
-        
-        Rules:
-        1. Clear formulation of the main question
-        2. Specification of desired response format
-        3. Minimum necessary clarifications
-        
-        Text: {input_text}
-        Intent: {user_intent}
-        Date: {current_date.strftime("%Y-%m-%d")}
-        
-        Generate prompt:
-        """,
-        
-        2: f"""
-        Create a detailed prompt to get an elaborate response.
-        
-        Requirements:
-        1. Information structuring
-        2. Request for additional context
-        3. Clarification of related aspects
-        4. Indication of need for explanations
-        
-        Text: {input_text}
-        Intent: {user_intent}
-        Date: {current_date.strftime("%Y-%m-%d")}
-        
-        Generate prompt:
-        """,
-        
-        3: f"""
-        Create a comprehensive prompt for complete topic analysis.
-        
-        Include requirements:
-        1. Coverage of all topic aspects
-        2. Examples and illustrations
-        3. Practical application
-        4. Connection with other topics
-        5. Perspectives and trends
+    A new question runs the full pipeline; a follow-up only runs the
+    cycles it needs (see follow_up_cycles) on the question and the
+    context of the previous turns, and a single cycle's response is the
+    answer, without synthesis: three model calls instead of ten. Turns
+    keep their question, cycle intents and answer, compressed, so a
+    session's memory is bounded and independent of result retention.
+    """
+
+    def __init__(self, max_turns: int = SESSION_TURNS, context_tokens: int = SESSION_CONTEXT_TOKENS):
+        """
+        :param max_turns: Previous turns kept as context
+        :param context_tokens: Token budget of the previous answer in the context
+        """
+        self.context_tokens = context_tokens
+        self.turns = deque(maxlen=max(1, max_turns))
+
+    def reset(self) -> None:
+        """Starts a new conversation."""
+        self.turns.clear()
+
+    def is_follow_up(self, question: str) -> bool:
+        """
+        Tells whether a question continues the conversation rather than
+        starting a new one: it opens with a continuation word ("and
+        which of those sold best?"), or its pronoun can only point back
+        to the previous turn ("why did it sell so well?").
+        """
+        if not self.turns:
+            return False
+        words = re.findall(r"\w+", question)
+        if not words or len(words) > FOLLOW_UP_MAX_WORDS:
+            return False
+        text = " ".join(words).lower()
+        if any(text == opener or text.startswith(opener + " ") for opener in FOLLOW_UP_OPENERS):
+            return True
+        if not any(word.lower() in FOLLOW_UP_PRONOUNS for word in words):
+            return False
+        # A question naming its own subject ("what is it like in Paris?") is a new one
+        if any(word.isdigit() or (word[0].isupper() and word.lower() not in FOLLOW_UP_STOPWORDS)
+               for word in words[1:]):
+            return False
+        last = self.turns[-1]
+        known = _content_terms(" ".join([last["question"], last["answer"]] + last["intents"]))
+        return len(_content_terms(question) - known) <= FOLLOW_UP_MAX_NEW_TERMS
+
+    def build_context(self, question: str) -> str:
+        """
+        Builds the user text of a follow-up: the previous questions, the
+        previous turn's basic intent and answer, and the follow-up question.
+        """
+        earlier = "".join(f"Q: {turn['question']}\n" for turn in list(self.turns)[:-1])
+        last = self.turns[-1]
+        topic = f"Intent: {last['intents'][0]}\n" if last["intents"] else ""
+        return (f"Conversation so far:\n{earlier}Q: {last['question']}\n{topic}A: {last['answer']}\n"
+                f"Follow-up question (resolve its references from the conversation): {question}")
+
+    def record(self, question: str, result: PipelineResult) -> None:
+        """
+        Adds a finished turn. When synthesis failed, the last cycle
+        response is its answer; turns without any response are not kept.
+        """
+        succeeded = [cycle for cycle in result.cycles if not is_failed_cycle(cycle)]
+        if not succeeded:
+            return
+        answer = result.synthesis
+        if not answer or answer.startswith("Error "):
+            answer = succeeded[-1]['response']
+        self.turns.append({
+            "question": question,
+            "intents": _compress_texts([cycle['intent'] for cycle in succeeded], question,
+                                       self.context_tokens // 2),
+            "answer": _compress_texts([answer], question, self.context_tokens)[0]
+        })
+
+    def answer_follow_up(self, question: str, verbose: bool = True) -> PipelineResult:
+        """
+        Answers a follow-up question from the cycles it needs and the context.
         
-        Text: {input_text}
-        Intent: {user_intent}
-        Date: {current_date.strftime("%Y-%m-%d")}
+        :param question: User's follow-up question
+        :param verbose: Print progress of each step
+        :return: PipelineResult of the follow-up (recorded as a turn)
+        """
+        user_input = self.build_context(question)
+        with trace_request(question):
+            cycles = [process_single_cycle(user_input, n, verbose) for n in follow_up_cycles(question)]
+            answers = [cycle['response'] for cycle in cycles if not is_failed_cycle(cycle)]
+            if len(cycles) > 1 and answers:
+                final_synthesis = synthesize_final_answer(cycles, user_input)
+            elif answers:
+                final_synthesis = answers[0]
+            else:
+                # A failed follow-up is not worth another model call
+                final_synthesis = "Error synthesizing final answer: all cycles failed"
+        result = _retain_result(cycles, final_synthesis)
+        self.record(question, result)
+        return result
+
+    def ask(self, question: str, verbose: bool = True) -> PipelineResult:
+        """
+        Answers a question of the conversation.
         
-        Generate prompt:
+        :param question: User's text
+        :param verbose: Print progress of each step
+        :return: PipelineResult (unpacks as cycle results, final answer)
         """
-    }
-    
-    try:
-        prompt_response = ollama.generate(
-            model='gemma2:9b',
-            prompt=templates[cycle_num]
-        )
-        return prompt_response['response'].strip()
-    except Exception:
-        return None
+        if self.is_follow_up(question):
+            return self.answer_follow_up(question, verbose)
+        result = process_user_input(question, verbose=verbose)
+        self.record(question, result)
+        return result
 
-def get_llm_response(prompt: str, cycle_num: int) -> str:
+class AsyncDeepChain:
     """
-    Gets response from the language model.
-    Different approaches for different cycles.
+    Asyncio version of the refinement pipeline.
     
-    :param prompt: Prepared prompt
-    :param cycle_num: Cycle number
-    :return: Model response
+    All stages share one ollama.AsyncClient, so many queries can be
+    processed concurrently from a single event loop over a pool of
+    keep-alive connections.
     """
-    try:
-        # Add cycle-specific instructions
-        cycle_instructions = {
-            1: "Provide a direct and concise answer to the question.",
-            2: "Provide a detailed response with explanations.",
-            3: "Create a complete topic analysis with examples and context."
-        }
+
+    def __init__(self, host: str = None, model: str = None,
+                 max_concurrency: int = None, limits: httpx.Limits = None,
+                 client=None, call_limit: int = None):
+        """
+        :param host: Ollama server address (defaults to the backend pool if
+            one is enabled, else OLLAMA_HOST)
+        :param model: Model used by every stage (defaults to per-stage routing)
+        :param max_concurrency: Maximum number of cycles of one query running at once
+        :param limits: Connection pool limits (defaults to CONNECTION_LIMITS)
+        :param client: Ready-made async client to use instead (host and limits are ignored)
+        :param call_limit: Maximum number of model calls in flight to the backend
+            across all queries (unlimited by default); see AsyncCallQueue
+        """
+        self.model = model
+        self.max_concurrency = max_concurrency or MAX_CONCURRENT_CYCLES
+        self.call_limit = call_limit
+        self._call_queue = AsyncCallQueue(call_limit) if call_limit else None
+        self._query_flight = AsyncSingleFlight()
+        self._call_flight = AsyncSingleFlight()
+        batcher = _micro_batcher
+        self._batcher = AsyncMicroBatcher(batcher.max_batch, batcher.max_wait) if batcher is not None else None
+        if client is None and host is None and _backend_pool is not None:
+            client = AsyncBackendPool(_backend_pool)
+        self.client = client or ollama.AsyncClient(
+            host=host or OLLAMA_HOST,
+            limits=limits or CONNECTION_LIMITS,
+            timeout=CONNECTION_TIMEOUT
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Closes the pooled connections."""
+        if isinstance(self.client, AsyncBackendPool):
+            await self.client.aclose()
+            return
+        http_client = getattr(self.client, "_client", None)
+        if http_client is not None:
+            await http_client.aclose()
+
+    @asynccontextmanager
+    async def _call_slot(self) -> AsyncIterator[None]:
+        """
+        Holds one of the backend's call slots (if call_limit is set);
+        waiting calls start by priority class and tenant (see call_priority).
+        """
+        if self._call_queue is None:
+            yield
+            return
+        async with self._call_queue.slot():
+            yield
+
+    async def _embed(self, text: str) -> "np.ndarray":
+        async with self._call_slot():
+            response = await self.client.embeddings(model=_semantic_cache.model, prompt=text)
+        return SemanticCache.normalize(response['embedding'])
+
+    async def _generate(self, stage: str, cycle_num: int, prompt: str, model: str = None,
+                        format: str = '', options: Dict[str, Any] = None) -> str:
+        model = model or self.model or get_stage_model(stage, cycle_num)
+        if options is None:
+            options = get_stage_options(stage, cycle_num)
+        started = time.monotonic()
+        key = _cache_key(stage, cycle_num, model, options, prompt)
+        cached = _cache_get(key)
+        if cached is not None:
+            _record_call(stage, cycle_num, model, started, cached=True)
+            return cached
+
+        async def call() -> str:
+            response = await acall_model(stage, lambda: agenerate_hedged(
+                self.client, stage, call_queue=self._call_queue, model=model, prompt=prompt,
+                format=format, options=options, keep_alive=KEEP_ALIVE
+            ), self._call_queue)
+            _record_call(stage, cycle_num, model, started, response)
+            text = response['response'].strip()
+            _cache_put(key, text)
+            return text
+
+        if not COALESCE_CALLS:
+            return await call()
+        text, shared = await self._call_flight.do(
+            (current_priority()[0], model, format, json.dumps(options, sort_keys=True), prompt), call
+        )
+        if shared:
+            _record_call(stage, cycle_num, model, started, coalesced=True)
+        return text
+
+    async def analyze_user_intent(self, input_text: str, cycle_num: int) -> str:
+        """Async counterpart of analyze_user_intent."""
+        try:
+            prompt = build_intent_prompt(input_text, cycle_num)
+            return (await self._batched_meta_call(STAGE_INTENT, cycle_num, prompt, input_text)
+                    or await self._generate(STAGE_INTENT, cycle_num, prompt))
+        except ModelCallError:
+            raise
+        except Exception:
+            return None
+
+    async def generate_llm_prompt(self, input_text: str, user_intent: str, cycle_num: int,
+                                  model: str = None) -> str:
+        """Async counterpart of generate_llm_prompt."""
+        try:
+            prompt = build_generation_prompt(input_text, user_intent, cycle_num)
+            if model is None:
+                batched = await self._batched_meta_call(STAGE_PROMPT, cycle_num, prompt, input_text, user_intent)
+                if batched:
+                    return batched
+            return await self._generate(STAGE_PROMPT, cycle_num, prompt, model)
+        except ModelCallError:
+            raise
+        except Exception:
+            return None
+
+    async def run_meta_batch(self, stage: str, cycle_num: int,
+                             items: List[Tuple[str, Optional[str]]]) -> List[Optional[str]]:
+        """Async counterpart of run_meta_batch."""
+        unique = list(dict.fromkeys(items))
+        if len(unique) < 2:
+            return [None] * len(items)
+        try:
+            text = await self._generate(stage, cycle_num, build_batch_prompt(stage, cycle_num, unique),
+                                        format='json', options=get_batch_options(stage, cycle_num, len(unique)))
+        except Exception:
+            return [None] * len(items)
+        results = dict(zip(unique, parse_batch_output(text, BATCH_FIELDS[stage], len(unique))))
+        _observe_batch_answers(stage, results)
+        return [results[item] for item in items]
+
+    async def _batched_meta_call(self, stage: str, cycle_num: int, prompt: str, input_text: str,
+                                 user_intent: str = None) -> Optional[str]:
+        """Async counterpart of _batched_meta_call."""
+        if self._batcher is None:
+            return None
+        key = _cache_key(stage, cycle_num, self.model or get_stage_model(stage, cycle_num),
+                         get_stage_options(stage, cycle_num), prompt)
+        if _cache_has(key):
+            return None
+        text = await self._batcher.do((stage, cycle_num), (input_text, user_intent),
+                                      lambda items: self.run_meta_batch(stage, cycle_num, items))
+        if text:
+            _cache_put(key, text)
+        return text
+
+    async def generate_valid_prompt(self, input_text: str, user_intent: str, cycle_num: int) -> str:
+        """Async counterpart of generate_valid_prompt."""
+        llm_prompt = await self.generate_llm_prompt(input_text, user_intent, cycle_num)
+        try:
+            return prepare_prompt(llm_prompt)
+        except Exception:
+            fallback = None if self.model else get_fallback_model(STAGE_PROMPT, cycle_num)
+            if fallback is None:
+                raise
+        return prepare_prompt(await self.generate_llm_prompt(input_text, user_intent, cycle_num, fallback))
+
+    async def get_llm_response(self, prompt: str, cycle_num: int) -> str:
+        """Async counterpart of get_llm_response."""
+        return await self._generate(
+            STAGE_RESPONSE, cycle_num, build_response_prompt(prompt, cycle_num)
+        )
+
+    async def synthesize_final_answer(self, cycles: List[Dict[str, str]], original_query: str) -> str:
+        """Async counterpart of synthesize_final_answer."""
+        try:
+            check_cycles_succeeded(cycles)
+            return await self._generate(
+                STAGE_SYNTHESIS, 0, build_synthesis_prompt(cycles, original_query)
+            )
+        except Exception as e:
+            return f"Error synthesizing final answer: {str(e)}"
+
+    async def generate_intent_and_prompt(self, input_text: str, cycle_num: int) -> Tuple[str, str]:
+        """Async counterpart of generate_intent_and_prompt."""
+        try:
+            return parse_fused_output(await self._generate(
+                STAGE_FUSED, cycle_num, build_fused_prompt(input_text, cycle_num), format='json'
+            ))
+        except ModelCallError:
+            raise
+        except Exception:
+            pass
+
+        intent = await self.analyze_user_intent(input_text, cycle_num)
+        if not intent:
+            raise Exception("Failed to determine user intent")
+        return intent, await self.generate_valid_prompt(input_text, intent, cycle_num)
+
+    async def _prepare_cycle(self, user_input: str, cycle_num: int,
+                             progress: Dict[str, str]) -> Tuple[str, str]:
+        # progress keeps the intent if the prompt stage fails
+        if FUSED_STAGES:
+            return await self.generate_intent_and_prompt(user_input, cycle_num)
+        intent = await self.analyze_user_intent(user_input, cycle_num)
+        if not intent:
+            raise Exception("Failed to determine user intent")
+        progress["intent"] = intent
+        return intent, await self.generate_valid_prompt(user_input, intent, cycle_num)
+
+    async def process_single_cycle(self, user_input: str, cycle_num: int) -> CycleResult:
+        """Async counterpart of process_single_cycle (without progress output)."""
+        progress = {}
+        try:
+            intent, final_prompt = await self._prepare_cycle(user_input, cycle_num, progress)
+            progress["prompt"] = final_prompt
+
+            response = await self.get_llm_response(final_prompt, cycle_num)
+            if not response:
+                raise Exception("Failed to get model response")
+        except Exception as e:
+            return failed_cycle(e, progress.get("intent"), progress.get("prompt"))
+
+        return CycleResult(intent, final_prompt, response)
+
+    async def process_user_input(self, user_input: str,
+                                 max_concurrency: int = None) -> PipelineResult:
+        """
+        Processes user input with three responses and final synthesis.
         
-        full_prompt = f"{cycle_instructions[cycle_num]}\n\n{prompt}"
+        :param user_input: User's text
+        :param max_concurrency: Maximum number of cycles running at once
+        :return: PipelineResult (unpacks as cycle results, synthesized answer)
+        """
+        if not user_input:
+            return PipelineResult([], "Please enter text for prompt creation.")
+
+        with trace_request(user_input) as trace:
+            if not COALESCE_CALLS:
+                return await self._answer_user_input(user_input, max_concurrency)
+
+            result, shared = await self._query_flight.do(
+                (current_priority()[0], normalize_query(user_input)),
+                lambda: self._answer_user_input(user_input, max_concurrency)
+            )
+            if shared:
+                trace.coalesced = True
+                result = PipelineResult(list(result.cycles), result.synthesis)
+            return result
+
+    async def _answer_user_input(self, user_input: str,
+                                 max_concurrency: int = None) -> PipelineResult:
+        semantic_cache, query_vector = _semantic_cache, None
+        if semantic_cache is not None:
+            query_vector = await self._embed(user_input)
+            cached = semantic_cache.search(query_vector)
+            if cached is not None:
+                return _retain_result(*cached)
+
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or self.max_concurrency))
+
+        async def run_cycle(cycle_num: int) -> CycleResult:
+            async with semaphore:
+                return await self.process_single_cycle(user_input, cycle_num)
+
+        # gather keeps results in cycle order
+        cycles = list(await asyncio.gather(*(run_cycle(n) for n in (1, 2, 3))))
+        final_synthesis = await self.synthesize_final_answer(cycles, user_input)
+
+        if semantic_cache is not None and _is_complete_result(cycles, final_synthesis):
+            semantic_cache.add(query_vector, user_input, cycles, final_synthesis)
+
+        return _retain_result(cycles, final_synthesis)
+
+    async def _stream(self, stage: str, cycle_num: int, prompt: str) -> AsyncIterator[str]:
+        model = self.model or get_stage_model(stage, cycle_num)
+        options = get_stage_options(stage, cycle_num)
+        started = time.monotonic()
+        key = _cache_key(stage, cycle_num, model, options, prompt)
+        cached = _cache_get(key)
+        if cached is not None:
+            _record_call(stage, cycle_num, model, started, cached=True)
+            yield cached
+            return
+
+        chunks = []
+        async for chunk in astream_model(stage, lambda: astream_hedged(
+            self.client, stage, call_queue=self._call_queue, model=model, prompt=prompt,
+            options=options, keep_alive=KEEP_ALIVE
+        ), self._call_queue):
+            if chunk['response']:
+                chunks.append(chunk['response'])
+                yield chunk['response']
+            if chunk.get('done'):
+                _record_call(stage, cycle_num, model, started, chunk)
+        _cache_put(key, "".join(chunks).strip())
+
+    async def _stream_cycle(self, user_input: str, cycle_num: int, events: asyncio.Queue) -> CycleResult:
+        await events.put(PipelineEvent(EVENT_CYCLE_STARTED, cycle_num))
+
+        progress = {}
+        try:
+            intent, final_prompt = await self._prepare_cycle(user_input, cycle_num, progress)
+            progress["prompt"] = final_prompt
+            await events.put(PipelineEvent(EVENT_INTENT_READY, cycle_num, intent))
+            await events.put(PipelineEvent(EVENT_PROMPT_READY, cycle_num, final_prompt))
+
+            chunks = []
+            async for chunk in self._stream(
+                STAGE_RESPONSE, cycle_num, build_response_prompt(final_prompt, cycle_num)
+            ):
+                chunks.append(chunk)
+                await events.put(PipelineEvent(EVENT_RESPONSE_TOKEN, cycle_num, chunk))
+            response = "".join(chunks).strip()
+            if not response:
+                raise Exception("Failed to get model response")
+        except Exception as e:
+            cycle = failed_cycle(e, progress.get("intent"), progress.get("prompt"))
+            await events.put(PipelineEvent(EVENT_CYCLE_FAILED, cycle_num, cycle["error"]))
+            return cycle
+        await events.put(PipelineEvent(EVENT_RESPONSE_READY, cycle_num, response))
+
+        return CycleResult(intent, final_prompt, response)
+
+    async def stream_user_input(self, user_input: str,
+                                max_concurrency: int = None) -> AsyncIterator[PipelineEvent]:
+        """
+        Async counterpart of stream_user_input.
         
-        response = ollama.generate(
-            model='gemma2:9b',
-            prompt=full_prompt
+        :param user_input: User's text
+        :param max_concurrency: Maximum number of cycles running at once
+        :return: Async iterator of PipelineEvent
+        """
+        if not user_input:
+            yield PipelineEvent(EVENT_DONE, data=PipelineResult([], "Please enter text for prompt creation."))
+            return
+
+        # The pipeline runs in a producer task whose context holds the
+        # request trace; this generator only relays its events
+        parent_trace = _current_trace.get()
+        trace = parent_trace or RequestTrace(user_input)
+        context = contextvars.copy_context()
+        context.run(_current_trace.set, trace)
+
+        events = asyncio.Queue()
+        producer = context.run(
+            asyncio.ensure_future,
+            self._produce_events(user_input, max_concurrency, events)
         )
-        return response['response'].strip()
-    except Exception as e:
-        return f"Error getting response from model: {str(e)}"
+        try:
+            while not (producer.done() and events.empty()):
+                getter = asyncio.ensure_future(events.get())
+                await asyncio.wait([getter, producer], return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            producer.result()
+        finally:
+            producer.cancel()
 
-def post_process_prompt(prompt: str) -> str:
-    """Processes the received prompt."""
-    prompt = prompt.strip('"').strip("'")
-    prompt = re.sub(r'^(prompt:)\s*', '', prompt, flags=re.IGNORECASE)
-    prompt = re.sub(r'\s+', ' ', prompt)
-    return prompt.strip()
+        if parent_trace is None:
+            _finish_trace(trace)
 
-def validate_prompt(prompt: str) -> bool:
-    """Checks prompt validity."""
-    return bool(prompt) and len(prompt.split()) >= 3
+    async def _produce_events(self, user_input: str, max_concurrency: int,
+                              events: asyncio.Queue) -> None:
+        semantic_cache, query_vector = _semantic_cache, None
+        if semantic_cache is not None:
+            query_vector = await self._embed(user_input)
+            cached = semantic_cache.search(query_vector)
+            if cached is not None:
+                for event in _replay_result(*cached):
+                    await events.put(event)
+                return
+
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or self.max_concurrency))
+
+        async def run_cycle(cycle_num: int) -> CycleResult:
+            async with semaphore:
+                return await self._stream_cycle(user_input, cycle_num, events)
+
+        cycles = list(await asyncio.gather(*(run_cycle(n) for n in (1, 2, 3))))
+
+        await events.put(PipelineEvent(EVENT_SYNTHESIS_STARTED))
+        chunks = []
+        try:
+            check_cycles_succeeded(cycles)
+            async for chunk in self._stream(
+                STAGE_SYNTHESIS, 0, build_synthesis_prompt(cycles, user_input)
+            ):
+                chunks.append(chunk)
+                await events.put(PipelineEvent(EVENT_SYNTHESIS_TOKEN, data=chunk))
+        except Exception as e:
+            chunks.append(f"Error synthesizing final answer: {str(e)}")
+        final_synthesis = "".join(chunks).strip()
+
+        if semantic_cache is not None and _is_complete_result(cycles, final_synthesis):
+            semantic_cache.add(query_vector, user_input, cycles, final_synthesis)
+
+        await events.put(PipelineEvent(EVENT_DONE, data=_retain_result(cycles, final_synthesis)))
 
-def process_single_cycle(user_input: str, cycle_num: int) -> Dict[str, str]:
+# One shared pipeline per event loop: httpx async connections
+# cannot be reused across loops.
+_async_chains = weakref.WeakKeyDictionary()
+
+async def process_user_input_async(user_input: str,
+                                   max_concurrency: int = None) -> PipelineResult:
     """
-    Executes one complete request processing cycle.
+    Async counterpart of process_user_input using a shared AsyncDeepChain.
     
     :param user_input: User's text
-    :param cycle_num: Cycle number
-    :return: Dictionary with cycle results
+    :param max_concurrency: Maximum number of cycles running at once
+    :return: PipelineResult (unpacks as cycle results, synthesized answer)
     """
-    print(f"\nCycle {cycle_num}:")
-    
-    # Intent analysis considering cycle number
-    print("Analyzing intent...")
-    intent = analyze_user_intent(user_input, cycle_num)
-    if not intent:
-        raise Exception("Failed to determine user intent")
-    print(f"Intent: {intent}")
+    loop = asyncio.get_running_loop()
+    chain = _async_chains.get(loop)
+    if chain is None:
+        chain = _async_chains[loop] = AsyncDeepChain()
+    return await chain.process_user_input(user_input, max_concurrency)
 
-    # Prompt generation
-    print("Generating prompt...")
-    llm_prompt = generate_llm_prompt(user_input, intent, cycle_num)
-    if not llm_prompt:
-        raise Exception("Failed to generate prompt")
-    final_prompt = post_process_prompt(llm_prompt)
-    if not validate_prompt(final_prompt):
-        raise Exception("Generated prompt is incorrect")
-    print(f"Prompt: {final_prompt}")
+def read_batch_queries(path: str) -> Iterator[Tuple[str, str]]:
+    """
+    Reads queries from a JSONL file.
+    
+    Each line is either a JSON string or an object with a "query" (or
+    "prompt") field and an optional "id"; lines without an id are
+    identified by their line number.
+    
+    :param path: Path to the queries file
+    :return: Iterator of (query id, query text)
+    """
+    with open(path, encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                yield str(line_num), record
+            else:
+                query = record.get("query") or record.get("prompt") or ""
+                yield str(record.get("id", line_num)), query
 
-    # Getting response
-    print("Getting response...")
-    response = get_llm_response(final_prompt, cycle_num)
-    if not response:
-        raise Exception("Failed to get model response")
-    print(f"Response: {response}")
+def load_batch_checkpoint(out_path: str) -> set:
+    """
+    Returns ids of queries already completed in an output file.
+    
+    The JSONL output doubles as the checkpoint: records with an error
+    are not counted, so failed queries are retried on resume.
+    
+    :param out_path: Path to the results file
+    :return: Set of completed query ids
+    """
+    done = set()
+    if not Path(out_path).exists():
+        return done
+    with open(out_path, encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # Truncated last line of an interrupted run
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in record:
+                done.add(str(record["id"]))
+    return done
 
-    return {
-        "intent": intent,
-        "prompt": final_prompt,
-        "response": response
-    }
+def _trim_partial_record(out_path: str) -> None:
+    """Cuts a results file back to its last newline, dropping a truncated last record."""
+    path = Path(out_path)
+    if not path.exists():
+        return
+    with open(path, "rb+") as f:
+        size = end = f.seek(0, 2)
+        while end > 0:
+            start = max(0, end - 4096)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            f.truncate(end)
 
-def synthesize_final_answer(cycles: List[Dict[str, str]], original_query: str) -> str:
+def run_batch(queries_path: str, out_path: str, workers: int = 2,
+              max_concurrency: int = None, tenant: str = DEFAULT_TENANT) -> Dict[str, int]:
     """
-    Creates final synthesized answer based on three cycles.
+    Processes a file of queries with bounded parallelism.
     
-    :param cycles: List of dictionaries with results from each cycle
-    :param original_query: Original user query
-    :return: Synthesized answer
+    Results are appended to out_path as JSONL as soon as each query
+    finishes, so an interrupted run resumes where it stopped. The model
+    calls run in the BATCH_PRIORITY class, so interactive queries
+    sharing the call queue or the stage scheduler go first.
+    
+    :param queries_path: JSONL file with queries
+    :param out_path: JSONL file receiving results
+    :param workers: Number of queries processed at once
+    :param max_concurrency: Maximum number of cycles of one query running at once
+    :param tenant: Tenant the calls are queued for (see call_priority)
+    :return: Counters of processed, skipped and failed queries
     """
-    synthesis_prompt = f"""
-    Based on the provided information, create a complete but well-structured response 
-    to the user's question: "{original_query}"
+    done = load_batch_checkpoint(out_path)
+    # New records must not be appended to a truncated one
+    _trim_partial_record(out_path)
+    counts = {"processed": 0, "skipped": 0, "failed": 0}
+    workers = max(1, workers)
 
-    Answer creation rules:
-    1. Start with a brief, direct answer to the question (main figures/facts)
-    2. Structure information by sections:
-       - Basic information
-       - Chronology and evolution
-         * Early period
-         * Development period
-         * Modern stage
-       - Significant works and achievements
-       - Impact and significance
-       - Interesting facts and details
-    3. Provide detailed information in each section
-    4. Use subheadings for better navigation
-    5. Include all significant aspects from provided sources
-    
-    Information from sources:
-    ---
-    Basic answer:
-    {cycles[0]['response']}
-    ---
-    Detailed answer:
-    {cycles[1]['response']}
-    ---
-    Complete analysis:
-    {cycles[2]['response']}
-    ---
+    def process(query_id: str, query: str) -> Dict[str, Any]:
+        record = {"id": query_id, "query": query}
+        try:
+            with call_priority(BATCH_PRIORITY, tenant):
+                result = process_user_input(query, max_concurrency, verbose=False)
+            record.update(result.to_dict())
+            cycles, final_synthesis = result
+            if not _is_complete_result(cycles, final_synthesis):
+                # Keep the partial result, but retry the query on resume
+                failed = [str(n) for n, cycle in enumerate(cycles, 1) if is_failed_cycle(cycle)]
+                record["error"] = f"cycle(s) {', '.join(failed)} failed" if failed else final_synthesis
+        except Exception as e:
+            record["error"] = str(e)
+        return record
 
-    Answer requirements:
-    - Use markdown formatting for better readability
-    - Preserve all important information from sources
-    - Organize information logically
-    - Use lists and subheadings
-    - Highlight key points
+    with open(out_path, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def write(record: Dict[str, Any]) -> None:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            counts["failed" if "error" in record else "processed"] += 1
+            print(f"[{record['id']}] {'failed: ' + record['error'] if 'error' in record else 'done'}")
+
+        # Keep only a small window of queries in flight so huge input
+        # files are streamed rather than loaded up front
+        pending = set()
+        for query_id, query in read_batch_queries(queries_path):
+            if query_id in done:
+                counts["skipped"] += 1
+                continue
+            if len(pending) >= workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write(future.result())
+            pending.add(executor.submit(process, query_id, query))
+
+        for future in wait(pending).done:
+            write(future.result())
+
+    return counts
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """Parses command line arguments."""
+    parser = argparse.ArgumentParser(description="DeepChain Refinement LLM")
+    parser.add_argument("--prompt", help="Process a single query and exit")
+    parser.add_argument("--config", metavar="PATH", help="JSON config file (model routing, generation options, backends)")
+    parser.add_argument("--hosts", help="Comma-separated Ollama hosts to balance calls over")
+    parser.add_argument("--balance", choices=BACKEND_STRATEGIES,
+                        help=f"Balancing strategy for --hosts (default: {BACKEND_STRATEGY})")
+    parser.add_argument("--no-preload", action="store_true",
+                        help="Do not load the models at start or keep them loaded with pings")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Duplicate model calls slower than their recent p95 (see HEDGE_PERCENTILES)")
+    parser.add_argument("--micro-batch", nargs="?", type=int, const=MICRO_BATCH_SIZE, metavar="N",
+                        help=f"Batch the intent and prompt calls of up to N concurrent queries "
+                             f"(default: {MICRO_BATCH_SIZE})")
+    parser.add_argument("--call-limit", type=int, metavar="N",
+                        help="Model calls in flight at once; the others queue by priority and tenant")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT,
+                        help=f"Tenant the --batch calls are queued for (default: {DEFAULT_TENANT})")
+    parser.add_argument("--session", action="store_true",
+                        help="Answer interactive follow-up questions in the context of the previous ones")
+    parser.add_argument("--batch", metavar="QUERIES", help="Process a JSONL file of queries")
+    parser.add_argument("--out", default="results.jsonl", help="Results file for --batch (default: results.jsonl)")
+    parser.add_argument("--workers", type=int, default=2, help="Queries processed at once in --batch mode")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_CYCLES,
+                        help="Refinement cycles of one query running at once (1-3)")
+    parser.add_argument("--fused", action="store_true",
+                        help="Get intent and prompt of a cycle from one JSON call (7 calls per query)")
+    parser.add_argument("--synthesis-budget", type=int, metavar="TOKENS",
+                        help=f"Token budget of the cycle responses passed to synthesis "
+                             f"(default: {SYNTHESIS_TOKEN_BUDGET}, 0 disables compression)")
+    parser.add_argument("--scheduler-workers", type=int, metavar="N",
+                        help="Run stages of all queries on a shared scheduler with N model workers")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Stop refining once the answer converges")
+    parser.add_argument("--max-calls", type=int, help="Model call budget per query (implies --adaptive)")
+    parser.add_argument("--max-ms", type=float, help="Time budget per query in ms (implies --adaptive)")
+    parser.add_argument("--self-rating", action="store_true",
+                        help="Let the model rate the first answer (implies --adaptive)")
+    parser.add_argument("--trace-file", metavar="PATH", help="Append a JSONL trace of every query")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="Write Prometheus text metrics on exit")
+    parser.add_argument("--cache", nargs="?", const=CACHE_PATH, metavar="PATH",
+                        help="Enable the persistent stage cache")
+    parser.add_argument("--semantic-cache", nargs="?", const=SEMANTIC_CACHE_DIR, metavar="DIR",
+                        help="Enable the semantic query cache")
+    parser.add_argument("--retention", choices=RESULT_RETENTION_MODES,
+                        help="Spill or drop cycle texts of results older than --keep-last")
+    parser.add_argument("--keep-last", type=int, default=RESULT_KEEP_LAST, metavar="N",
+                        help=f"Results whose cycle texts stay in memory (default: {RESULT_KEEP_LAST})")
+    parser.add_argument("--result-log", default=RESULT_LOG_PATH, metavar="PATH",
+                        help=f"Gzip log for --retention spill (default: {RESULT_LOG_PATH})")
+    return parser.parse_args(argv)
+
+def render_event(event: PipelineEvent, stream_tokens: bool = True) -> None:
+    """
+    Prints a streaming pipeline event to the console.
     
-    Don't mention the analysis process or information sources - 
-    just provide a complete, well-organized answer.
+    :param event: Event to print
+    :param stream_tokens: Print cycle responses token by token; with
+        concurrent cycles the tokens would interleave, so each response
+        is printed once complete instead
     """
+    if event.type == EVENT_CYCLE_STARTED:
+        if stream_tokens:
+            print(f"\nCycle {event.cycle}:")
+    elif event.type == EVENT_INTENT_READY:
+        if stream_tokens:
+            print(f"Intent: {event.data}")
+    elif event.type == EVENT_PROMPT_READY:
+        if stream_tokens:
+            print(f"Prompt: {event.data}")
+            print("Response: ", end="", flush=True)
+    elif event.type == EVENT_RESPONSE_TOKEN:
+        if stream_tokens:
+            print(event.data, end="", flush=True)
+    elif event.type == EVENT_RESPONSE_READY:
+        if stream_tokens:
+            print()
+        else:
+            print(f"\nCycle {event.cycle}:")
+            print(f"Response: {event.data}")
+    elif event.type == EVENT_CYCLE_FAILED:
+        print(f"\nCycle {event.cycle} failed: {event.data}")
+    elif event.type == EVENT_SYNTHESIS_STARTED:
+        print("\nFinal synthesized answer:\n")
+    elif event.type == EVENT_SYNTHESIS_TOKEN:
+        print(event.data, end="", flush=True)
+    elif event.type == EVENT_DONE:
+        print()
 
-    try:
-        synthesis_response = ollama.generate(model='gemma2:9b', prompt=synthesis_prompt)
-        return synthesis_response['response'].strip()
-    except Exception as e:
-        return f"Error synthesizing final answer: {str(e)}"
-
-def process_user_input(user_input: str) -> Tuple[List[Dict[str, str]], str]:
+def answer_query(user_input: str, session: Session = None) -> None:
     """
-    Processes user input with three responses and final synthesis.
+    Processes one query and prints the results to the console.
     
     :param user_input: User's text
-    :return: Tuple[list of cycle results, synthesized answer]
+    :param session: Conversation the query belongs to, if any
     """
-    if not user_input:
-        return [], "Please enter text for prompt creation."
+    if session is not None and session.is_follow_up(user_input):
+        result = session.answer_follow_up(user_input)
+        print("\nFinal answer:\n")
+        print(result.synthesis)
+        return
 
-    # Execute three independent cycles
-    cycles = []
-    for i in range(3):
-        cycle_results = process_single_cycle(user_input, i + 1)
-        cycles.append(cycle_results)
-
-    # Create final synthesis
-    final_synthesis = synthesize_final_answer(cycles, user_input)
+    if _adaptive_policy is not None or _scheduler is not None:
+        # These modes decide the stage order themselves and don't stream
+        result = process_user_input(user_input)
+        print("\nFinal answer:\n")
+        print(result.synthesis)
+    else:
+        # Render cycle results and final synthesis as they arrive
+        result = None
+        for event in stream_user_input(user_input):
+            render_event(event, stream_tokens=MAX_CONCURRENT_CYCLES == 1)
+            if event.type == EVENT_DONE:
+                result = event.data
+    if session is not None and result is not None:
+        session.record(user_input, result)
 
-    return cycles, final_synthesis
+def run_cli(args: argparse.Namespace) -> None:
+    """Runs the mode selected on the command line."""
+    if args.batch:
+        counts = run_batch(args.batch, args.out, args.workers, tenant=args.tenant)
+        print(f"Processed: {counts['processed']}, skipped: {counts['skipped']}, failed: {counts['failed']}")
+        return
 
-def main():
+    if args.prompt:
+        answer_query(args.prompt)
+        return
         
     print("\nDeepChain Refinement LLM v1.0.0:")
     print("Using chain-of-thought, multi-step prompting,")
     print("progressive refinement and response synthesis")
     print("Built on Ollama architecture. Powered by 'Gemma2:9B'\n")
     
+    # Follow-up questions are answered in the context of the previous ones
+    session = Session() if args.session else None
+    hint = "'new' for a new topic, 'exit' to quit" if session is not None else "or 'exit' to quit"
     while True:
         try:
-            user_input = input("\nEnter text to create prompt (or 'exit' to quit): ").strip()
+            user_input = input(f"\nEnter text to create prompt ({hint}): ").strip()
             if user_input.lower() == 'exit':
                 print("Terminating program.")
                 break
+            if session is not None and user_input.lower() == 'new':
+                session.reset()
+                print("Starting a new conversation.")
+                continue
                 
-            # Get cycle results and final synthesis
-            cycles, final_synthesis = process_user_input(user_input)
-            
-            # Output results of each cycle
-            for i, cycle in enumerate(cycles, 1):
-                print(f"\nCycle {i}:")
-                print(f"Intent: {cycle['intent']}")
-                print(f"Prompt: {cycle['prompt']}")
-                print(f"Response: {cycle['response']}")
-            
-            # Output final synthesis
-            print("\nFinal synthesized answer:\n")
-            print(final_synthesis)
+            answer_query(user_input, session)
                 
         except KeyboardInterrupt:
             print("\nTerminating program.")
@@ -337,5 +5217,46 @@ def main():
         except Exception as e:
             print(f"An error occurred: {str(e)}. Please try again.")
 
+def main():
+    global MAX_CONCURRENT_CYCLES, FUSED_STAGES, SYNTHESIS_TOKEN_BUDGET
+
+    args = parse_args()
+    if args.config:
+        load_config(args.config)
+    MAX_CONCURRENT_CYCLES = max(1, args.concurrency)
+    FUSED_STAGES = FUSED_STAGES or args.fused
+    if args.synthesis_budget is not None:
+        SYNTHESIS_TOKEN_BUDGET = max(0, args.synthesis_budget)
+    if args.cache:
+        enable_stage_cache(args.cache)
+    if args.semantic_cache:
+        enable_semantic_cache(args.semantic_cache)
+    if args.retention:
+        enable_result_retention(args.retention, args.keep_last, args.result_log)
+    hosts = [h.strip() for h in args.hosts.split(",") if h.strip()] if args.hosts else BACKEND_HOSTS
+    if hosts:
+        enable_backend_pool(hosts, strategy=args.balance or BACKEND_STRATEGY)
+    if RESIDENCY and not args.no_preload:
+        enable_residency(interval=RESIDENCY_PING_INTERVAL)
+    if args.hedge or HEDGING:
+        enable_hedging(max_rate=HEDGE_MAX_RATE)
+    if args.call_limit or CALL_QUEUE:
+        enable_call_queue(args.call_limit or CALL_CAPACITY)
+    if args.micro_batch or MICRO_BATCHING:
+        enable_micro_batching(args.micro_batch or MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_SECONDS)
+    if args.scheduler_workers:
+        enable_scheduler(args.scheduler_workers)
+    if args.adaptive or args.max_calls or args.max_ms or args.self_rating:
+        enable_adaptive_refinement(max_calls=args.max_calls, max_ms=args.max_ms,
+                                   self_rating=args.self_rating)
+
+    if args.trace_file:
+        enable_trace_file(args.trace_file)
+    try:
+        run_cli(args)
+    finally:
+        if args.metrics_file:
+            Path(args.metrics_file).write_text(_metrics.to_prometheus())
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,472 @@
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import main
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+
+# Admission control defaults. At most SERVER_WORKERS queries are processed
+# at once and at most SERVER_QUEUE_SIZE wait for a worker; a query that
+# would wait (or has waited) longer than SERVER_MAX_QUEUE_SECONDS is
+# rejected with 429 instead of piling up latency.
+SERVER_WORKERS = 4
+SERVER_QUEUE_SIZE = 32
+SERVER_MAX_QUEUE_SECONDS = 10.0
+# Model calls in flight per Ollama host
+SERVER_CALL_LIMIT = 4
+# Default and maximum time a query may take, including queueing
+SERVER_DEADLINE_SECONDS = 120.0
+SERVER_MAX_DEADLINE_SECONDS = 600.0
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+    503: "Service Unavailable", 504: "Gateway Timeout"
+}
+
+class HttpError(Exception):
+    """Request error answered with the given status code."""
+
+    def __init__(self, status: int, message: str, headers: Dict[str, str] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+class AdmissionController:
+    """
+    Bounded FIFO queue in front of a fixed number of workers.
+
+    A query is rejected on arrival when the queue is full or when its
+    predicted queue time (queue length / workers * mean service time)
+    exceeds max_queue_seconds, and after arrival when it has actually
+    waited that long.
+    """
+
+    def __init__(self, workers: int = SERVER_WORKERS, queue_size: int = SERVER_QUEUE_SIZE,
+                 max_queue_seconds: float = SERVER_MAX_QUEUE_SECONDS):
+        """
+        :param workers: Queries processed at once
+        :param queue_size: Queries allowed to wait for a worker
+        :param max_queue_seconds: Longest acceptable queue time
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_queue_seconds = max_queue_seconds
+        self.waiting = 0
+        self.active = 0
+        self.service_seconds = None
+        self._slots = asyncio.Semaphore(workers)
+
+    def predicted_wait(self) -> float:
+        """Estimates how long a newly arriving query would queue."""
+        if self.active < self.workers or not self.service_seconds:
+            return 0.0
+        return (self.waiting + 1) / self.workers * self.service_seconds
+
+    async def acquire(self, deadline: float) -> float:
+        """
+        Waits for a worker slot.
+
+        :param deadline: time.monotonic() by which the query must finish
+        :return: Seconds spent in the queue
+        """
+        if self.waiting >= self.queue_size:
+            raise HttpError(429, "Request queue is full", self._retry_after(self.predicted_wait()))
+        predicted = self.predicted_wait()
+        if predicted > self.max_queue_seconds:
+            raise HttpError(429, "Server overloaded", self._retry_after(predicted))
+
+        started = time.monotonic()
+        timeout = min(self.max_queue_seconds, deadline - started)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            if deadline - time.monotonic() <= 0:
+                raise HttpError(504, "Deadline exceeded while queued")
+            raise HttpError(429, "Queue wait limit exceeded", self._retry_after(self.max_queue_seconds))
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return time.monotonic() - started
+
+    def release(self, service_seconds: float) -> None:
+        """Frees a worker slot and updates the mean service time."""
+        self.active -= 1
+        self._slots.release()
+        if self.service_seconds is None:
+            self.service_seconds = service_seconds
+        else:
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * service_seconds
+
+    @staticmethod
+    def _retry_after(seconds: float) -> Dict[str, str]:
+        return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+class DeepChainServer:
+    """
+    HTTP/1.1 front end for AsyncDeepChain (one request per connection).
+
+    POST /answer   {"query": "...", "deadline_ms": 60000,
+                    "priority": "interactive", "tenant": "..."} -> JSON result
+    POST /stream   same body -> NDJSON pipeline events
+    GET  /health   queue state
+    GET  /metrics  Prometheus metrics of the pipeline and the server
+
+    A query's deadline covers queueing and processing; when it passes,
+    the query's in-flight Ollama calls are cancelled. Its model calls
+    wait for a call slot in its priority class, on behalf of its tenant
+    (see main.call_priority).
+    """
+
+    def __init__(self, chain: main.AsyncDeepChain, admission: AdmissionController,
+                 deadline_seconds: float = SERVER_DEADLINE_SECONDS):
+        """
+        :param chain: Pipeline shared by all requests
+        :param admission: Queue and worker limits
+        :param deadline_seconds: Deadline of queries that don't set one
+        """
+        self.chain = chain
+        self.admission = admission
+        self.deadline_seconds = deadline_seconds
+        self.responses = {}
+        self.queue_histogram = main.Histogram(main.LATENCY_BUCKETS)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Serves one connection."""
+        try:
+            try:
+                method, path, body = await self._read_request(reader)
+                await self._route(method, path, body, writer)
+            except HttpError as e:
+                await self._send_json(writer, e.status, {"error": str(e)}, e.headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except Exception as e:
+                await self._send_json(writer, 500, {"error": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "Request headers too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HttpError(400, "Invalid Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise HttpError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), path.split("?", 1)[0], body
+
+    async def _route(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter) -> None:
+        routes = {
+            "/answer": ("POST", self._answer),
+            "/stream": ("POST", self._stream),
+            "/health": ("GET", self._health),
+            "/metrics": ("GET", self._metrics)
+        }
+        if path not in routes:
+            raise HttpError(404, f"Unknown path {path}")
+        allowed, handler = routes[path]
+        if method != allowed:
+            raise HttpError(405, f"Use {allowed} for {path}", {"Allow": allowed})
+        await handler(body, writer)
+
+    def _parse_query(self, body: bytes) -> Tuple[str, float, str, str]:
+        """
+        :return: Tuple[query, deadline as time.monotonic(), priority class, tenant]
+        """
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            raise HttpError(400, "Body must be JSON")
+        query = payload.get("query") if isinstance(payload, dict) else None
+        if not isinstance(query, str) or not query.strip():
+            raise HttpError(400, 'Body must contain a non-empty "query" string')
+
+        deadline_seconds = self.deadline_seconds
+        if payload.get("deadline_ms") is not None:
+            try:
+                deadline_seconds = float(payload["deadline_ms"]) / 1000
+            except (TypeError, ValueError):
+                raise HttpError(400, '"deadline_ms" must be a number')
+        deadline_seconds = min(max(deadline_seconds, 0.0), SERVER_MAX_DEADLINE_SECONDS)
+
+        priority = payload.get("priority", main.DEFAULT_PRIORITY)
+        if priority not in main.PRIORITY_CLASSES:
+            raise HttpError(400, f'"priority" must be one of {", ".join(main.PRIORITY_CLASSES)}')
+        tenant = payload.get("tenant", main.DEFAULT_TENANT)
+        if not isinstance(tenant, str) or not tenant:
+            raise HttpError(400, '"tenant" must be a non-empty string')
+        return query.strip(), time.monotonic() + deadline_seconds, priority, tenant
+
+    async def _admit(self, deadline: float) -> float:
+        try:
+            queue_seconds = await self.admission.acquire(deadline)
+        except HttpError as e:
+            self._count(e.status)
+            raise
+        self.queue_histogram.observe(queue_seconds)
+        return queue_seconds
+
+    async def _answer(self, body: bytes, writer: asyncio.StreamWriter) -> None:
+        query, deadline, priority, tenant = self._parse_query(body)
+        queue_seconds = await self._admit(deadline)
+        started = time.monotonic()
+        try:
+            with main.call_priority(priority, tenant):
+                cycles, final_synthesis = await asyncio.wait_for(
+                    self.chain.process_user_input(query), max(0.0, deadline - started)
+                )
+        except asyncio.TimeoutError:
+            self._count(504)
+            raise HttpError(504, "Deadline exceeded")
+        finally:
+            self.admission.release(time.monotonic() - started)
+
+        self._count(200)
+        await self._send_json(writer, 200, {
+            "query": query,
+            "cycles": [dict(cycle) for cycle in cycles],
+            "final_synthesis": final_synthesis,
+            "queue_ms": round(queue_seconds * 1000, 1),
+            "processing_ms": round((time.monotonic() - started) * 1000, 1)
+        })
+
+    async def _stream(self, body: bytes, writer: asyncio.StreamWriter) -> None:
+        query, deadline, priority, tenant = self._parse_query(body)
+        queue_seconds = await self._admit(deadline)
+        started = time.monotonic()
+        # Held while iterating: each step runs in a task that copies this context
+        with main.call_priority(priority, tenant):
+            events = self.chain.stream_user_input(query)
+            try:
+                self._write_head(writer, 200, {
+                    "Content-Type": "application/x-ndjson",
+                    "Transfer-Encoding": "chunked"
+                })
+                await self._write_chunk(writer, {"type": "queued", "data": {"queue_ms": round(queue_seconds * 1000, 1)}})
+                status = 200
+                while True:
+                    try:
+                        event = await asyncio.wait_for(events.__anext__(), max(0.0, deadline - time.monotonic()))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        status = 504
+                        await self._write_chunk(writer, {"type": "error", "data": "Deadline exceeded"})
+                        break
+                    except Exception as e:
+                        # The status line is already sent, so errors go into the stream
+                        status = 500
+                        await self._write_chunk(writer, {"type": "error", "data": str(e)})
+                        break
+                    await self._write_chunk(writer, event_to_dict(event))
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+                self._count(status)
+            finally:
+                # Cancels the pipeline (and its Ollama calls) on deadline or disconnect
+                await events.aclose()
+                self.admission.release(time.monotonic() - started)
+
+    async def _health(self, body: bytes, writer: asyncio.StreamWriter) -> None:
+        breaker = main.get_circuit_breaker()
+        health = {
+            "status": "ok" if breaker.state == "closed" else "degraded",
+            "circuit": breaker.state,
+            "active": self.admission.active,
+            "queued": self.admission.waiting,
+            "workers": self.admission.workers,
+            "queue_size": self.admission.queue_size,
+            "predicted_queue_ms": round(self.admission.predicted_wait() * 1000, 1)
+        }
+        pool = main.get_backend_pool()
+        if pool is not None:
+            health["backends"] = pool.stats()
+        residency = main.get_residency()
+        if residency is not None:
+            health["models"] = residency.stats()
+        if self.chain._call_queue is not None:
+            health["calls"] = self.chain._call_queue.stats()
+        await self._send_json(writer, 200, health)
+
+    async def _metrics(self, body: bytes, writer: asyncio.StreamWriter) -> None:
+        text = main.get_metrics().to_prometheus() + self.to_prometheus()
+        data = text.encode("utf-8")
+        self._write_head(writer, 200, {
+            "Content-Type": "text/plain; version=0.0.4",
+            "Content-Length": str(len(data))
+        })
+        writer.write(data)
+        await writer.drain()
+
+    def to_prometheus(self) -> str:
+        """Renders the server's own metrics in the Prometheus text format."""
+        lines = [
+            "# HELP deepchain_server_responses_total Query responses by status code",
+            "# TYPE deepchain_server_responses_total counter"
+        ]
+        for status, count in sorted(self.responses.items()):
+            lines.append(f'deepchain_server_responses_total{{status="{status}"}} {count}')
+        for name, help_text, value in (
+            ("deepchain_server_queued", "Queries waiting for a worker", self.admission.waiting),
+            ("deepchain_server_active", "Queries being processed", self.admission.active)
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+        name = "deepchain_server_queue_seconds"
+        lines += [f"# HELP {name} Time admitted queries waited for a worker", f"# TYPE {name} histogram"]
+        lines += self.queue_histogram.render(name, "")
+        return "\n".join(lines) + "\n"
+
+    def _count(self, status: int) -> None:
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+    @staticmethod
+    def _write_head(writer: asyncio.StreamWriter, status: int, headers: Dict[str, str]) -> None:
+        lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in dict(headers, Connection="close").items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _write_chunk(self, writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
+        line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+        writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+        await writer.drain()
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any],
+                         headers: Dict[str, str] = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self._write_head(writer, status, dict(headers or {}, **{
+            "Content-Type": "application/json",
+            "Content-Length": str(len(data))
+        }))
+        writer.write(data)
+        await writer.drain()
+
+def event_to_dict(event: main.PipelineEvent) -> Dict[str, Any]:
+    """Converts a pipeline event to its JSON form."""
+    data = event.data
+    if event.type == main.EVENT_DONE:
+        cycles, final_synthesis = data
+        data = {"cycles": [dict(cycle) for cycle in cycles], "final_synthesis": final_synthesis}
+    return {"type": event.type, "cycle": event.cycle, "data": data}
+
+async def serve(host: str = SERVER_HOST, port: int = SERVER_PORT,
+                chain: Optional[main.AsyncDeepChain] = None, ready: asyncio.Event = None,
+                **kwargs) -> None:
+    """
+    Runs the HTTP server until cancelled.
+
+    :param host: Address to listen on
+    :param port: Port to listen on
+    :param chain: Pipeline to serve (defaults to a new AsyncDeepChain
+        limited to SERVER_CALL_LIMIT model calls in flight)
+    :param ready: Event set once the server is listening
+    :param kwargs: AdmissionController arguments and deadline_seconds
+    """
+    deadline_seconds = kwargs.pop("deadline_seconds", SERVER_DEADLINE_SECONDS)
+    chain = chain or main.AsyncDeepChain(call_limit=SERVER_CALL_LIMIT)
+    app = DeepChainServer(chain, AdmissionController(**kwargs), deadline_seconds)
+    server = await asyncio.start_server(app.handle, host, port, limit=MAX_HEADER_BYTES)
+    print(f"DeepChain server listening on http://{host}:{port}")
+    if ready is not None:
+        ready.set()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await chain.aclose()
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses command line arguments."""
+    parser = argparse.ArgumentParser(description="DeepChain HTTP server")
+    parser.add_argument("--host", default=SERVER_HOST, help=f"Address to listen on (default: {SERVER_HOST})")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help=f"Port (default: {SERVER_PORT})")
+    parser.add_argument("--config", help="JSON config file (see main.py --config)")
+    parser.add_argument("--hosts", help="Comma-separated Ollama hosts to balance calls over")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help=f"Queries processed at once (default: {SERVER_WORKERS})")
+    parser.add_argument("--queue-size", type=int, default=SERVER_QUEUE_SIZE,
+                        help=f"Queries allowed to wait for a worker (default: {SERVER_QUEUE_SIZE})")
+    parser.add_argument("--max-queue-ms", type=float, default=SERVER_MAX_QUEUE_SECONDS * 1000,
+                        help="Queue time after which queries are rejected with 429")
+    parser.add_argument("--call-limit", type=int, default=SERVER_CALL_LIMIT,
+                        help=f"Model calls in flight per Ollama host (default: {SERVER_CALL_LIMIT})")
+    parser.add_argument("--deadline-ms", type=float, default=SERVER_DEADLINE_SECONDS * 1000,
+                        help="Default query deadline including queueing")
+    parser.add_argument("--concurrency", type=int, default=3, help="Cycles of one query run in parallel")
+    parser.add_argument("--no-preload", action="store_true", help="Do not load the models at start")
+    parser.add_argument("--micro-batch", nargs="?", type=int, const=main.MICRO_BATCH_SIZE, metavar="N",
+                        help="Batch the intent and prompt calls of up to N concurrent queries")
+    parser.add_argument("--hedge", action="store_true", help="Duplicate model calls slower than their recent p95")
+    parser.add_argument("--cache", action="store_true", help="Enable the persistent stage cache")
+    parser.add_argument("--semantic-cache", action="store_true", help="Answer paraphrased queries from earlier results")
+    parser.add_argument("--retention", choices=main.RESULT_RETENTION_MODES,
+                        help="Spill or drop cycle texts of results older than --keep-last")
+    parser.add_argument("--keep-last", type=int, default=main.RESULT_KEEP_LAST,
+                        help=f"Results whose cycle texts stay in memory (default: {main.RESULT_KEEP_LAST})")
+    parser.add_argument("--result-log", default=main.RESULT_LOG_PATH,
+                        help=f"Gzip log for --retention spill (default: {main.RESULT_LOG_PATH})")
+    return parser.parse_args(argv)
+
+def main_server(argv=None) -> int:
+    args = parse_args(argv)
+    if args.config:
+        main.load_config(args.config)
+    hosts = [h.strip() for h in args.hosts.split(",") if h.strip()] if args.hosts else main.BACKEND_HOSTS
+    if hosts:
+        main.enable_backend_pool(hosts)
+    if main.RESIDENCY and not args.no_preload:
+        main.enable_residency(interval=main.RESIDENCY_PING_INTERVAL)
+    if args.micro_batch or main.MICRO_BATCHING:
+        main.enable_micro_batching(args.micro_batch or main.MICRO_BATCH_SIZE, main.MICRO_BATCH_WAIT_SECONDS)
+    if args.hedge or main.HEDGING:
+        main.enable_hedging(max_rate=main.HEDGE_MAX_RATE)
+    if args.cache:
+        main.enable_stage_cache()
+    if args.semantic_cache:
+        main.enable_semantic_cache()
+    if args.retention:
+        main.enable_result_retention(args.retention, args.keep_last, args.result_log)
+
+    call_limit = max(1, args.call_limit) * max(1, len(hosts))
+    chain = main.AsyncDeepChain(max_concurrency=args.concurrency, call_limit=call_limit)
+    try:
+        asyncio.run(serve(
+            args.host, args.port, chain,
+            workers=max(1, args.workers),
+            queue_size=max(0, args.queue_size),
+            max_queue_seconds=args.max_queue_ms / 1000,
+            deadline_seconds=args.deadline_ms / 1000
+        ))
+    except KeyboardInterrupt:
+        print("\nServer stopped")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main_server())